@@ -2363,7 +2363,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         if ok and txid:
             txid = str(txid).strip()
             try:
-                r = self.network.get_transaction(txid)
+                r = self.network.get_transaction(txid, use_cache=self.wallet.use_shared_caches())
             except BaseException as e:
                 self.show_message(str(e))
                 return
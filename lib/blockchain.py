@@ -21,7 +21,14 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import hashlib
+import json
+import mmap
+import re
+import struct
 import threading
+import zlib
+from collections import OrderedDict
 
 from . import util
 from . import bitcoin
@@ -60,6 +67,16 @@ def deserialize_header(s, height):
     h['block_height'] = height
     return h
 
+def compact_headers(data):
+    '''Compact transport format of raw headers: each header without its
+    previous block hash (48 bytes), zlib-compressed.  The client restores
+    the hashes while verifying.'''
+    data = memoryview(data)
+    records = b''.join(data[i:i+4].tobytes() + data[i+36:i+80].tobytes()
+                       for i in range(0, len(data), 80))
+    return zlib.compress(records)
+
+
 def hash_header(header):
     if header is None:
         return '0' * 64
@@ -70,28 +87,135 @@ def hash_header(header):
 
 blockchains = {}
 
+# block hash -> checkpoint of the branch storing it, for the recent
+# headers of all forks
+recent_hashes = OrderedDict()
+MAX_RECENT_HASHES = 2016
+# number of headers indexed at the tip of each fork
+RECENT_HEADERS = 144
+
+def index_hash(block_hash, checkpoint):
+    recent_hashes[block_hash] = checkpoint
+    recent_hashes.move_to_end(block_hash)
+    if len(recent_hashes) > MAX_RECENT_HASHES:
+        recent_hashes.popitem(last=False)
+
+def unindex_branch(checkpoint):
+    '''Removes the hashes of the branch at checkpoint from recent_hashes.'''
+    for block_hash in [k for k, v in recent_hashes.items() if v == checkpoint]:
+        del recent_hashes[block_hash]
+
+# forks ending this many blocks below our longest chain are removed at startup
+PRUNE_DEPTH = 2016
+
+def index_path(config):
+    return os.path.join(util.get_headers_dir(config), 'forks', 'index.json')
+
+def save_blockchains(config):
+    '''Writes the segments of every branch to the fork index.'''
+    path = index_path(config)
+    util.make_dir(os.path.dirname(path))
+    index = [{'checkpoint': b.checkpoint, 'parent_id': b.parent_id, 'segments': b.segments}
+             for b in sorted(blockchains.values(), key=lambda b: b.checkpoint)]
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(index))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
 def read_blockchains(config):
-    blockchains[0] = Blockchain(config, 0, None)
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     util.make_dir(fdir)
-    l = filter(lambda x: x.startswith('fork_'), os.listdir(fdir))
-    l = sorted(l, key = lambda x: int(x.split('_')[1]))
-    for filename in l:
-        checkpoint = int(filename.split('_')[2])
-        parent_id = int(filename.split('_')[1])
-        b = Blockchain(config, checkpoint, parent_id)
-        h = b.read_header(b.checkpoint)
-        if b.parent().can_connect(h, check_height=False):
+    try:
+        with open(index_path(config)) as f:
+            index = json.loads(f.read())
+    except FileNotFoundError:
+        index = None
+    if index is None:
+        # fork files named after their parent and checkpoint; the
+        # segment files of new_file cannot be used without the index
+        blockchains[0] = Blockchain(config, 0, None)
+        forks = []
+        for filename in os.listdir(fdir):
+            m = re.fullmatch(r'fork_(\d+)_(\d+)', filename)
+            if m:
+                forks.append((int(m.group(1)), int(m.group(2)), filename))
+        for parent_id, checkpoint, filename in sorted(forks):
+            if parent_id not in blockchains or checkpoint <= parent_id:
+                util.print_error("cannot connect", filename)
+                continue
+            b = Blockchain(config, checkpoint, parent_id)
+            h = b.read_header(b.checkpoint) if b.size() else None
+            if h is not None and b.parent().can_connect(h, check_height=False):
+                blockchains[b.checkpoint] = b
+            else:
+                util.print_error("cannot connect", filename)
+    else:
+        # the index is written after the headers, no need to verify them
+        for x in sorted(index, key=lambda x: x['checkpoint']):
+            if x['parent_id'] is not None and x['parent_id'] not in blockchains:
+                continue
+            b = Blockchain(config, x['checkpoint'], x['parent_id'], x['segments'])
+            if x['parent_id'] is not None and not all(os.path.exists(b.file_path(seg[0])) for seg in b.segments):
+                util.print_error("missing headers file for fork", b.checkpoint)
+                continue
             blockchains[b.checkpoint] = b
-        else:
-            util.print_error("cannot connect", filename)
+        if 0 not in blockchains:
+            blockchains[0] = Blockchain(config, 0, None)
+    prune_blockchains(config)
+    for b in blockchains.values():
+        b.index_recent(b.height() - RECENT_HEADERS + 1)
     return blockchains
 
+def prune_blockchains(config, depth=PRUNE_DEPTH):
+    '''Removes the forks without forks of their own that end more than
+    depth blocks below our longest chain, and the files no branch reads.'''
+    tip = max(b.height() for b in blockchains.values())
+    while True:
+        obsolete = [b for b in blockchains.values()
+                    if b.parent_id is not None and b.height() < tip - depth
+                    and not any(x.parent_id == b.checkpoint for x in blockchains.values())]
+        if not obsolete:
+            break
+        for b in obsolete:
+            util.print_error("pruning fork", b.checkpoint, b.height())
+            with b.lock:
+                b.close_mmap()
+            del blockchains[b.checkpoint]
+            unindex_branch(b.checkpoint)
+    used = set(seg[0] for b in blockchains.values() for seg in b.segments)
+    fdir = os.path.join(util.get_headers_dir(config), 'forks')
+    for filename in os.listdir(fdir):
+        if filename.startswith(('fork_', 'seg_')) and os.path.join('forks', filename) not in used:
+            os.remove(os.path.join(fdir, filename))
+    save_blockchains(config)
+
+def split_segments(segments, height):
+    '''Splits segments into the ones below height and the ones from
+    height on.'''
+    below, above = [], []
+    for name, base, start, end in segments:
+        if end is not None and end < height:
+            below.append([name, base, start, end])
+        elif start >= height:
+            above.append([name, base, start, end])
+        else:
+            below.append([name, base, start, height - 1])
+            above.append([name, base, height, end])
+    return below, above
+
 def check_header(header):
     if type(header) is not dict:
         return False
+    header_hash = hash_header(header)
+    height = header.get('block_height')
+    # recent headers are found without asking every fork
+    b = blockchains.get(recent_hashes.get(header_hash))
+    if b is not None and b.get_hash(height) == header_hash:
+        return b
     for b in blockchains.values():
-        if b.check_header(header):
+        if b.get_hash(height) == header_hash:
             return b
     return False
 
@@ -105,15 +229,37 @@ def can_connect(header):
 class Blockchain(util.PrintError):
     """
     Manages blockchain headers and their verification
+
+    The headers of a branch, from its checkpoint on, are stored in a list
+    of segments [filename, base, start, end]: the headers from height
+    start to end are at (height - base) * 80 in filename.  Only the last
+    segment can be open (end is None) and extend to the end of its file.
+    Branches share files, so that switching the main chain moves segments
+    between branches instead of copying headers.  The segments of all
+    branches are saved in forks/index.json.
+
+    Headers are read through read-only mmaps of the headers files.
+    Block hashes after the last checkpoint are cached in a bytearray
+    (32 bytes per header, zero if not computed yet), and deserialized
+    headers in an LRU.
     """
 
-    def __init__(self, config, checkpoint, parent_id):
+    MAX_CACHED_HEADERS = 4096
+
+    def __init__(self, config, checkpoint, parent_id, segments=None):
         self.config = config
-        self.catch_up = None # interface catching up
+        self.catch_up = None # server string of the interface catching up
         self.checkpoint = checkpoint
         self.checkpoints = constants.net.CHECKPOINTS
         self.parent_id = parent_id
+        if segments is None:
+            filename = 'blockchain_headers' if parent_id is None else os.path.join('forks', 'fork_%d_%d'%(parent_id, checkpoint))
+            segments = [[filename, checkpoint, checkpoint, None]]
+        self.segments = segments
         self.lock = threading.Lock()
+        self._mmaps = {}  # filename -> mmap
+        self._hashes = bytearray()  # delta - hash_base -> block hash
+        self._headers = OrderedDict()  # delta -> header dict
         with self.lock:
             self.update_size()
 
@@ -139,10 +285,15 @@ class Blockchain(util.PrintError):
         height = header.get('block_height')
         return header_hash == self.get_hash(height)
 
+    def index_recent(self, height):
+        '''Adds the hashes of our headers from height on to recent_hashes.'''
+        for h in range(max(height, self.checkpoint, self.hash_base() + self.checkpoint), self.height() + 1):
+            index_hash(self.get_hash(h), self.checkpoint)
+
     def fork(parent, header):
         checkpoint = header.get('block_height')
-        self = Blockchain(parent.config, checkpoint, parent.checkpoint)
-        open(self.path(), 'w+').close()
+        self = Blockchain(parent.config, checkpoint, parent.checkpoint, [])
+        blockchains[checkpoint] = self
         self.save_header(header)
         return self
 
@@ -154,8 +305,60 @@ class Blockchain(util.PrintError):
             return self._size
 
     def update_size(self):
-        p = self.path()
-        self._size = os.path.getsize(p)//80 if os.path.exists(p) else 0
+        size = 0
+        for name, base, start, end in self.segments:
+            if end is None:
+                p = self.file_path(name)
+                end = base + os.path.getsize(p) // 80 - 1 if os.path.exists(p) else start - 1
+            size += max(0, end - start + 1)
+        self._size = size
+        self.close_mmap()
+
+    def close_mmap(self, name=None):
+        # note: on Windows, a mapped file cannot be truncated or renamed
+        for n in [name] if name is not None else list(self._mmaps):
+            m = self._mmaps.pop(n, None)
+            if m is not None:
+                m.close()
+
+    def get_segment(self, height):
+        '''Returns the segment holding height, if any.'''
+        for seg in reversed(self.segments):
+            if seg[2] <= height:
+                return seg if seg[3] is None or height <= seg[3] else None
+
+    def invalidate_cache(self, delta=0):
+        '''Forget cached data for headers from delta on.
+        Call with self.lock.'''
+        self.close_mmap()
+        del self._hashes[max(0, delta - self.hash_base())*32:]
+        for d in [d for d in self._headers if d >= delta]:
+            del self._headers[d]
+
+    def hash_base(self):
+        # hashes up to the last checkpoint are not needed
+        return max(0, len(self.checkpoints) * 2016 - self.checkpoint)
+
+    def _read_raw(self, delta):
+        '''Returns the 80 bytes stored at delta. Call with self.lock.'''
+        height = self.checkpoint + delta
+        seg = self.get_segment(height)
+        if seg is None:
+            raise Exception('Expected to read a full header.')
+        name, base = seg[0], seg[1]
+        offset = (height - base) * 80
+        m = self._mmaps.get(name)
+        if m is None:
+            path = self.file_path(name)
+            self.assert_headers_file_available(path)
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < offset + 80:
+                    raise Exception('Expected to read a full header.')
+                m = self._mmaps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        h = m[offset:offset+80]
+        if len(h) < 80:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        return h
 
     def verify_header(self, header, prev_hash, target):
         _hash = hash_header(header)
@@ -169,29 +372,80 @@ class Blockchain(util.PrintError):
         if int('0x' + _hash, 16) > target:
             raise Exception("insufficient proof of work: %s vs target %s" % (int('0x' + _hash, 16), target))
 
-    def verify_chunk(self, index, data):
-        num = len(data) // 80
-        prev_hash = self.get_hash(index * 2016 - 1)
+    def verify_chunk(self, index, data, height=None, compact=False):
+        '''Verifies the headers of chunk index starting at height (by
+        default the start of the chunk), and returns them.  If compact,
+        data is in the format of compact_headers: the previous block hashes
+        are restored from the hashes computed during verification.'''
+        # works on the raw headers: no deserialization, one sha256d per header
+        height = index * 2016 if height is None else height
+        if compact:
+            data = zlib.decompress(data)
+            if len(data) % 48:
+                raise Exception("bad compact headers length: %d" % len(data))
+            num = len(data) // 48
+            out = []
+        else:
+            num = len(data) // 80
+        prev_hash = self.get_hash(height - 1)
         target = self.get_target(index-1)
+        check_pow = not constants.net.TESTNET
+        if check_pow:
+            bits = self.target_to_bits(target)
+        chunk = data
+        if not compact:
+            data = memoryview(data)
+        prev = hash_decode(prev_hash)
+        sha256 = hashlib.sha256
         for i in range(num):
-            raw_header = data[i*80:(i+1) * 80]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target)
-            prev_hash = hash_header(header)
-
-    def path(self):
-        d = util.get_headers_dir(self.config)
-        filename = 'blockchain_headers' if self.parent_id is None else os.path.join('forks', 'fork_%d_%d'%(self.parent_id, self.checkpoint))
-        return os.path.join(d, filename)
-
-    def save_chunk(self, index, chunk):
-        filename = self.path()
-        d = (index * 2016 - self.checkpoint) * 80
+            if compact:
+                raw_header = data[i*48:i*48+4] + prev + data[i*48+4:(i+1)*48]
+                out.append(raw_header)
+            else:
+                raw_header = data[i*80:(i+1)*80]
+                if raw_header[4:36] != prev:
+                    raise Exception("prev hash mismatch: %s vs %s" % (hash_encode(prev), hash_encode(bytes(raw_header[4:36]))))
+            _hash = sha256(sha256(raw_header).digest()).digest()
+            if check_pow:
+                header_bits = struct.unpack_from('<I', raw_header, 72)[0]
+                if bits != header_bits:
+                    raise Exception("bits mismatch: %s vs %s" % (bits, header_bits))
+                if int.from_bytes(_hash, 'little') > target:
+                    raise Exception("insufficient proof of work: %s vs target %s" % (int.from_bytes(_hash, 'little'), target))
+            prev = _hash
+        return b''.join(out) if compact else chunk
+
+    def file_path(self, name):
+        return os.path.join(util.get_headers_dir(self.config), name)
+
+    def path(self, height=None):
+        '''Path of the file holding height, by default of the last
+        segment.'''
+        seg = self.get_segment(height) if height is not None else (self.segments or [None])[-1]
+        return self.file_path(seg[0]) if seg else None
+
+    def new_file(self, height):
+        '''Creates an empty headers file for a segment starting at height.'''
+        n = 0
+        while True:
+            name = os.path.join('forks', 'seg_%d_%d' % (height, n))
+            if not os.path.exists(self.file_path(name)):
+                break
+            n += 1
+        util.make_dir(os.path.dirname(self.file_path(name)))
+        open(self.file_path(name), 'wb').close()
+        return name
+
+    def save_chunk(self, index, chunk, height=None):
+        height = index * 2016 if height is None else height
+        d = (height - self.checkpoint) * 80
         if d < 0:
             chunk = chunk[-d:]
             d = 0
         truncate = index >= len(self.checkpoints)
         self.write(chunk, d, truncate)
+        if truncate:
+            self.index_recent(self.height() - RECENT_HEADERS + 1)
         self.swap_with_parent()
 
     def swap_with_parent(self):
@@ -204,31 +458,36 @@ class Blockchain(util.PrintError):
         parent_id = self.parent_id
         checkpoint = self.checkpoint
         parent = self.parent()
-        self.assert_headers_file_available(self.path())
-        with open(self.path(), 'rb') as f:
-            my_data = f.read()
-        self.assert_headers_file_available(parent.path())
-        with open(parent.path(), 'rb') as f:
-            f.seek((checkpoint - parent.checkpoint)*80)
-            parent_data = f.read(parent_branch_size*80)
-        self.write(parent_data, 0)
-        parent.write(my_data, (checkpoint - parent.checkpoint)*80)
-        # store file path
-        for b in blockchains.values():
-            b.old_path = b.path()
-        # swap parameters
-        self.parent_id = parent.parent_id; parent.parent_id = parent_id
-        self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
-        self._size = parent._size; parent._size = parent_branch_size
-        # move files
-        for b in blockchains.values():
-            if b in [self, parent]: continue
-            if b.old_path != b.path():
-                self.print_error("renaming", b.old_path, b.path())
-                os.rename(b.old_path, b.path())
+        # forks of either branch follow the segments they fork from
+        my_children = [b for b in blockchains.values() if b.parent_id == checkpoint]
+        parent_children = [b for b in blockchains.values()
+                           if b.parent_id == parent_id and b.checkpoint > checkpoint]
+        below, above = split_segments(parent.segments, checkpoint)
+        with self.lock:
+            self.invalidate_cache()
+            self.segments = below + self.segments
+            self.parent_id = parent.parent_id
+            self.checkpoint = parent_id
+            self.update_size()
+        with parent.lock:
+            parent.invalidate_cache()
+            parent.segments = above
+            parent.parent_id = parent_id
+            parent.checkpoint = checkpoint
+            parent.update_size()
+        for b in my_children:
+            b.parent_id = self.checkpoint
+        for b in parent_children:
+            b.parent_id = parent.checkpoint
         # update pointers
         blockchains[self.checkpoint] = self
         blockchains[parent.checkpoint] = parent
+        # the checkpoints of both branches changed
+        unindex_branch(parent_id)
+        unindex_branch(checkpoint)
+        self.index_recent(self.height() - RECENT_HEADERS + 1)
+        parent.index_recent(parent.height() - RECENT_HEADERS + 1)
+        save_blockchains(self.config)
 
     def assert_headers_file_available(self, path):
         if os.path.exists(path):
@@ -239,18 +498,48 @@ class Blockchain(util.PrintError):
             raise FileNotFoundError('Cannot find headers file but headers_dir is there. Should be at {}'.format(path))
 
     def write(self, data, offset, truncate=True):
-        filename = self.path()
+        height = self.checkpoint + offset // 80
+        seg = self.get_segment(height)
+        if truncate and seg is not None:
+            # other branches may have the file mapped
+            for b in list(blockchains.values()):
+                if b is not self:
+                    with b.lock:
+                        b.close_mmap(seg[0])
         with self.lock:
-            self.assert_headers_file_available(filename)
-            with open(filename, 'rb+') as f:
-                if truncate and offset != self._size*80:
-                    f.seek(offset)
-                    f.truncate()
-                f.seek(offset)
-                f.write(data)
-                f.flush()
-                os.fsync(f.fileno())
+            self.invalidate_cache(offset // 80)
+            new_segments = False
+            if seg is not None and seg[3] is not None:
+                if not truncate:
+                    assert height + len(data) // 80 - 1 <= seg[3]
+                else:
+                    # the following headers of the file may belong to
+                    # another branch: continue in a new file
+                    self.segments = split_segments(self.segments, height)[0]
+                    seg = None
+                    new_segments = True
+            elif seg is None:
+                # the last segment is closed, or there is none
+                self.segments = split_segments(self.segments, height)[0]
+                new_segments = True
+            if seg is None and data:
+                seg = [self.new_file(height), height, height, None]
+                self.segments.append(seg)
+            if seg is not None:
+                filename = self.file_path(seg[0])
+                self.assert_headers_file_available(filename)
+                pos = (height - seg[1]) * 80
+                with open(filename, 'rb+') as f:
+                    if truncate and height != self.checkpoint + self._size:
+                        f.seek(pos)
+                        f.truncate()
+                    f.seek(pos)
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
             self.update_size()
+        if new_segments:
+            save_blockchains(self.config)
 
     def save_header(self, header):
         delta = header.get('block_height') - self.checkpoint
@@ -258,6 +547,7 @@ class Blockchain(util.PrintError):
         assert delta == self.size()
         assert len(data) == 80
         self.write(data, delta*80)
+        index_hash(hash_header(header), self.checkpoint)
         self.swap_with_parent()
 
     def read_header(self, height):
@@ -269,16 +559,19 @@ class Blockchain(util.PrintError):
         if height > self.height():
             return
         delta = height - self.checkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * 80)
-            h = f.read(80)
-            if len(h) < 80:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*80:
-            return None
-        return deserialize_header(h, height)
+        with self.lock:
+            header = self._headers.get(delta)
+            if header is not None:
+                self._headers.move_to_end(delta)
+                return dict(header)
+            h = self._read_raw(delta)
+            if h == bytes(80):
+                return None
+            header = deserialize_header(h, height)
+            self._headers[delta] = header
+            if len(self._headers) > self.MAX_CACHED_HEADERS:
+                self._headers.popitem(last=False)
+        return dict(header)
 
     def get_hash(self, height):
         if height == -1:
@@ -290,8 +583,23 @@ class Blockchain(util.PrintError):
             index = height // 2016
             h, t = self.checkpoints[index]
             return h
-        else:
-            return hash_header(self.read_header(height))
+        elif height < self.checkpoint:
+            return self.parent().get_hash(height)
+        elif height > self.height():
+            return hash_header(None)
+        delta = height - self.checkpoint
+        i = (delta - self.hash_base()) * 32
+        with self.lock:
+            h = self._hashes[i:i+32]
+            if len(h) < 32 or h == bytes(32):
+                raw = self._read_raw(delta)
+                if raw == bytes(80):
+                    return hash_header(None)
+                h = Hash(raw)
+                if len(self._hashes) < i + 32:
+                    self._hashes.extend(bytes(i + 32 - len(self._hashes)))
+                self._hashes[i:i+32] = h
+        return hash_encode(h)
 
     def get_target(self, index):
         # compute target from chunk x, used in chunk x+1
@@ -360,12 +668,13 @@ class Blockchain(util.PrintError):
             return False
         return True
 
-    def connect_chunk(self, idx, hexdata):
+    def connect_chunk(self, idx, data, height=None, compact=False):
         try:
-            data = bfh(hexdata)
-            self.verify_chunk(idx, data)
+            if isinstance(data, str):
+                data = bfh(data)
+            data = self.verify_chunk(idx, data, height, compact)
             #self.print_error("validated chunk %d" % idx)
-            self.save_chunk(idx, data)
+            self.save_chunk(idx, data, height)
             return True
         except BaseException as e:
             self.print_error('verify_chunk %d failed'%idx, str(e))
@@ -30,6 +30,9 @@ import argparse
 import json
 import ast
 import base64
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from functools import wraps
 from decimal import Decimal
 
@@ -45,6 +48,27 @@ from .plugins import run_hook
 known_commands = {}
 
 
+# signing processes, created on first use and kept for later commands.
+# They are not forked from the daemon, which has threads running.
+MIN_PARALLEL_INPUTS = 16
+_sign_executor = None
+_sign_executor_processes = None
+_sign_executor_lock = threading.Lock()
+
+def get_sign_executor(processes):
+    global _sign_executor, _sign_executor_processes
+    with _sign_executor_lock:
+        if _sign_executor is not None and _sign_executor_processes != processes:
+            _sign_executor.shutdown(wait=False)
+            _sign_executor = None
+        if _sign_executor is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _sign_executor = ProcessPoolExecutor(processes, mp_context=context)
+            _sign_executor_processes = processes
+        return _sign_executor
+
+
 def satoshis(amount):
     # satoshi conversion must not be performed by the parser
     return int(COIN*Decimal(amount)) if amount not in ['!', None] else amount
@@ -232,17 +256,22 @@ class Commands:
         return tx.as_dict()
 
     @command('wp')
-    def signtransaction(self, tx, privkey=None, password=None):
+    def signtransaction(self, tx, privkey=None, password=None, processes=None):
         """Sign a transaction. The wallet keys will be used unless a private key is provided."""
         tx = Transaction(tx)
+        # small transactions are signed faster than a pool starts
+        if processes and processes > 1 and len(tx.inputs()) >= MIN_PARALLEL_INPUTS:
+            executor = get_sign_executor(processes)
+        else:
+            executor = None
         if privkey:
             txin_type, privkey2, compressed = bitcoin.deserialize_privkey(privkey)
             pubkey_bytes = ecc.ECPrivkey(privkey2).get_public_key_bytes(compressed=compressed)
             h160 = bitcoin.hash_160(pubkey_bytes)
             x_pubkey = 'fd' + bh2u(b'\x00' + h160)
-            tx.sign({x_pubkey:(privkey2, compressed)})
+            tx.sign({x_pubkey:(privkey2, compressed)}, executor)
         else:
-            self.wallet.sign_transaction(tx, password)
+            self.wallet.sign_transaction(tx, password, executor)
         return tx.as_dict()
 
     @command('')
@@ -338,6 +367,12 @@ class Commands:
         """Return the list of available servers"""
         return self.network.get_servers()
 
+    @command('n')
+    def getnetworkstats(self):
+        """Return request counts, latencies and queue depths of the network
+        and of each server"""
+        return self.network.get_metrics()
+
     @command('')
     def version(self):
         """Return the version of Electrum."""
@@ -467,6 +502,13 @@ class Commands:
         transaction ID"""
         self.wallet.set_label(key, label)
 
+    @command('w')
+    def journalwallet(self, disable=False):
+        """Save wallet changes to an append-only journal, instead of rewriting
+        the whole wallet file. The wallet file is compacted once."""
+        self.wallet.storage.set_journal_enabled(not disable)
+        return True
+
     @command('w')
     def listcontacts(self):
         """Show your list of contacts"""
@@ -517,7 +559,8 @@ class Commands:
         if self.wallet and txid in self.wallet.transactions:
             tx = self.wallet.transactions[txid]
         else:
-            raw = self.network.get_transaction(txid)
+            use_cache = self.wallet.use_shared_caches() if self.wallet else True
+            raw = self.network.get_transaction(txid, use_cache=use_cache)
             if raw:
                 tx = Transaction(raw)
             else:
@@ -725,6 +768,7 @@ command_options = {
     'memo':        ("-m", "Description of the request"),
     'expiration':  (None, "Time in seconds"),
     'timeout':     (None, "Timeout in seconds"),
+    'disable':     (None, "Disable instead of enable"),
     'force':       (None, "Create new address beyond gap limit, if no more addresses are available."),
     'pending':     (None, "Show only pending requests."),
     'expired':     (None, "Show only expired requests."),
@@ -733,7 +777,8 @@ command_options = {
     'show_fiat':   (None, "Show fiat value of transactions"),
     'year':        (None, "Show history for a given year"),
     'fee_method':  (None, "Fee estimation method to use"),
-    'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position")
+    'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position"),
+    'processes':   (None, "Number of processes used to sign"),
 }
 
 
@@ -755,6 +800,7 @@ arg_types = {
     'locktime': int,
     'fee_method': str,
     'fee_level': json_loads,
+    'processes': int,
 }
 
 config_variables = {
@@ -853,7 +899,7 @@ def get_parser():
     add_global_options(parser_gui)
     # daemon
     parser_daemon = subparsers.add_parser('daemon', help="Run Daemon")
-    parser_daemon.add_argument("subcommand", choices=['start', 'status', 'stop', 'load_wallet', 'close_wallet'], nargs='?')
+    parser_daemon.add_argument("subcommand", choices=['start', 'status', 'stop', 'load_wallet', 'close_wallet', 'metrics'], nargs='?')
     #parser_daemon.set_defaults(func=run_daemon)
     add_network_options(parser_daemon)
     add_global_options(parser_daemon)
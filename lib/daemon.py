@@ -33,7 +33,7 @@ import jsonrpclib
 from .jsonrpc import VerifyingJSONRPCServer
 
 from .version import ELECTRUM_VERSION
-from .network import Network
+from .network import Network, metrics_to_prometheus
 from .util import json_decode, DaemonThread
 from .util import print_error, to_string
 from .wallet import Wallet
@@ -167,7 +167,7 @@ class Daemon(DaemonThread):
     def run_daemon(self, config_options):
         config = SimpleConfig(config_options)
         sub = config.get('subcommand')
-        assert sub in [None, 'start', 'stop', 'status', 'load_wallet', 'close_wallet']
+        assert sub in [None, 'start', 'stop', 'status', 'load_wallet', 'close_wallet', 'metrics']
         if sub in [None, 'start']:
             response = "Daemon already running"
         elif sub == 'load_wallet':
@@ -205,6 +205,11 @@ class Daemon(DaemonThread):
                 }
             else:
                 response = "Daemon offline"
+        elif sub == 'metrics':
+            if self.network:
+                response = metrics_to_prometheus(self.network.get_metrics())
+            else:
+                response = "Daemon offline"
         elif sub == 'stop':
             self.stop()
             response = "Daemon stopped"
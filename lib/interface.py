@@ -30,6 +30,7 @@ import sys
 import threading
 import time
 import traceback
+from collections import defaultdict
 
 import requests
 
@@ -42,6 +43,18 @@ from . import x509
 from . import pem
 
 
+# bounds of the adaptive limit of unanswered requests
+MIN_UNANSWERED_REQUESTS = 10
+MAX_UNANSWERED_REQUESTS = 2000
+# queueing delay above which the limit is decreased
+MAX_QUEUE_DELAY = 1.0
+# time after which an unanswered batch probe means no batch support
+BATCH_PROBE_TIMEOUT = 10
+# JSON-RPC error codes of an overloaded server
+EXCESSIVE_RESOURCE_USAGE = -101
+SERVER_BUSY = -102
+
+
 def Connection(server, queue, config_path):
     """Makes asynchronous connections to a remote Electrum server.
     Returns the running thread that is making the connection.
@@ -245,8 +258,14 @@ class Interface(util.PrintError):
     Electrum server.  Its exposed API is:
 
     - Member functions close(), fileno(), get_responses(), has_timed_out(),
-      ping_required(), queue_request(), send_requests()
+      ping_required(), probe_batch(), check_batch_probe(), queue_request(),
+      send_requests()
     - Member variable server.
+
+    Requests are sent as JSON-RPC batches once the server has answered
+    a batch probe with a batch, and one by one if it does not answer it
+    in time.  The number of unanswered requests is
+    adapted to the round-trip time and to busy errors of the server.
     """
 
     def __init__(self, server, socket):
@@ -260,6 +279,21 @@ class Interface(util.PrintError):
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
+        self.max_unanswered_requests = 100
+        # JSON-RPC batches: None until the probe is answered
+        self.batch = None
+        self.batch_probe = None
+        self.expired_batch_probe = None  # its answer is ignored
+        # headers without previous block hashes, if the server supports it
+        self.compact_headers = False
+        # send time of unanswered requests, round-trip times
+        self.send_times = {}
+        self.min_rtt = None
+        self.rtt = None
+        self.last_decrease = 0
+        # per method: request, response and error counts, latencies
+        self.method_counts = defaultdict(lambda: {'requests': 0, 'responses': 0, 'errors': 0})
+        self.latencies = defaultdict(util.Histogram)
         self.last_send = time.time()
         self.closed_remotely = False
 
@@ -286,18 +320,44 @@ class Interface(util.PrintError):
         self.unsent_requests.append(args)
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
+        '''Keep unanswered requests below max_unanswered_requests'''
+        n = self.max_unanswered_requests - len(self.unanswered_requests)
         return min(n, len(self.unsent_requests))
 
+    def probe_batch(self, message_id):
+        '''The request message_id, already queued, will be sent as a
+        batch of one.  Batches are used if the response is a batch.'''
+        if self.batch is None:
+            self.batch_probe = message_id
+
+    def check_batch_probe(self):
+        '''Gives up on batches if the probe has not been answered in
+        time.  Returns True if it did.'''
+        if self.batch_probe is None or self.batch_probe not in self.send_times:
+            return False
+        if time.time() - self.send_times[self.batch_probe] < BATCH_PROBE_TIMEOUT:
+            return False
+        self.print_error("batch probe not answered, not using batch requests")
+        self.batch = False
+        self.unanswered_requests.pop(self.batch_probe, None)
+        self.send_times.pop(self.batch_probe, None)
+        self.expired_batch_probe = self.batch_probe
+        self.batch_probe = None
+        return True
+
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
         self.last_send = time.time()
         make_dict = lambda m, p, i: {'method': m, 'params': p, 'id': i}
         n = self.num_requests()
         wire_requests = self.unsent_requests[0:n]
+        messages = [make_dict(*r) for r in wire_requests]
+        if self.batch and len(messages) > 1:
+            messages = [messages]
+        elif self.batch_probe is not None:
+            messages = [[m] if m['id'] == self.batch_probe else m for m in messages]
         try:
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
+            self.pipe.send_all(messages)
         except BaseException as e:
             self.print_error("pipe send error:", e)
             return False
@@ -306,8 +366,50 @@ class Interface(util.PrintError):
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = self.last_send
+            self.method_counts[request[0]]['requests'] += 1
         return True
 
+    def record_response(self, method, send_time, error):
+        now = time.time()
+        counts = self.method_counts[method]
+        counts['responses'] += 1
+        if error:
+            counts['errors'] += 1
+        self.latencies[method].add(now - send_time)
+        self.update_max_requests(now - send_time, error)
+
+    def update_max_requests(self, rtt, error):
+        '''Additive increase of max_unanswered_requests for each timely
+        response, halving at most once per round trip if the server is
+        busy or requests queue up.'''
+        now = time.time()
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+        code = error.get('code') if isinstance(error, dict) else None
+        if code in (EXCESSIVE_RESOURCE_USAGE, SERVER_BUSY) or rtt - self.min_rtt > MAX_QUEUE_DELAY:
+            if now - self.last_decrease > self.rtt:
+                self.max_unanswered_requests = max(MIN_UNANSWERED_REQUESTS, self.max_unanswered_requests // 2)
+                self.last_decrease = now
+                self.print_error("max unanswered requests", self.max_unanswered_requests)
+        elif len(self.unanswered_requests) + 1 >= self.max_unanswered_requests:
+            self.max_unanswered_requests = min(MAX_UNANSWERED_REQUESTS, self.max_unanswered_requests + 1)
+
+    def get_metrics(self):
+        return {
+            'server': self.server,
+            'bytes_sent': self.pipe.bytes_sent,
+            'bytes_received': self.pipe.bytes_received,
+            'unsent_requests': len(self.unsent_requests),
+            'unanswered_requests': len(self.unanswered_requests),
+            'max_unanswered_requests': self.max_unanswered_requests,
+            'rtt': self.rtt,
+            'min_rtt': self.min_rtt,
+            'batch': self.batch,
+            'methods': {method: dict(counts, latency=self.latencies[method].to_dict())
+                        for method, counts in list(self.method_counts.items())},
+        }
+
     def ping_required(self):
         '''Returns True if a ping should be sent.'''
         return time.time() - self.last_send > 300
@@ -330,12 +432,32 @@ class Interface(util.PrintError):
         corresponding request.  If the connection was closed remotely
         or the remote server is misbehaving, a (None, None) will appear.
         '''
+        messages = []
+        for message in self.pipe.get_all():
+            if (type(message) is list and len(message) == 1 and type(message[0]) is dict
+                    and self.expired_batch_probe is not None
+                    and message[0].get('id') == self.expired_batch_probe):
+                # late answer to the batch probe
+                continue
+            if type(message) is list and message and self.batch is not False:
+                if not self.batch:
+                    self.print_error("using batch requests")
+                    self.batch = True
+                    self.batch_probe = None
+                messages.extend(message)
+            else:
+                messages.append(message)
         responses = []
-        while True:
-            try:
-                response = self.pipe.get()
-            except util.timeout:
-                break
+        for response in messages:
+            if type(response) is dict and self.batch_probe is not None:
+                # the probe was not answered with a batch
+                wire_id = response.get('id')
+                if wire_id == self.batch_probe or (wire_id is None and 'error' in response):
+                    self.print_error("batch requests not supported")
+                    self.batch = False
+                    self.batch_probe = None
+                    if wire_id is None:
+                        continue
             if not type(response) is dict:
                 responses.append((None, None))
                 if response is None:
@@ -347,9 +469,12 @@ class Interface(util.PrintError):
             wire_id = response.get('id', None)
             if wire_id is None:  # Notification
                 responses.append((None, response))
+            elif self.expired_batch_probe is not None and wire_id == self.expired_batch_probe:
+                continue
             else:
                 request = self.unanswered_requests.pop(wire_id, None)
                 if request:
+                    self.record_response(request[0], self.send_times.pop(wire_id), response.get('error'))
                     responses.append((request, response))
                 else:
                     self.print_error("unknown wire ID", wire_id)
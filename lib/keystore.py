@@ -24,6 +24,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from contextlib import contextmanager
 from unicodedata import normalize
 
 from . import bitcoin, ecc
@@ -101,18 +102,30 @@ class Software_KeyStore(KeyStore):
         decrypted = ec.decrypt_message(message)
         return decrypted
 
-    def sign_transaction(self, tx, password):
+    @contextmanager
+    def signing_session(self, password):
+        """Check the password, and yield a session object to pass to
+        get_session_private_key.  Subclasses may keep decrypted keys in
+        the session object, never in the keystore, so that every session
+        checks its password."""
+        self.check_password(password)
+        yield None
+
+    def get_session_private_key(self, session, sequence, password):
+        return self.get_private_key(sequence, password)
+
+    def sign_transaction(self, tx, password, executor=None):
         if self.is_watching_only():
             return
         # Raise if password is not correct.
-        self.check_password(password)
-        # Add private keys
-        keypairs = self.get_tx_derivations(tx)
-        for k, v in keypairs.items():
-            keypairs[k] = self.get_private_key(v, password)
+        with self.signing_session(password) as session:
+            # Add private keys
+            keypairs = self.get_tx_derivations(tx)
+            for k, v in keypairs.items():
+                keypairs[k] = self.get_session_private_key(session, v, password)
         # Sign
         if keypairs:
-            tx.sign(keypairs)
+            tx.sign(keypairs, executor)
 
 
 class Imported_KeyStore(Software_KeyStore):
@@ -328,6 +341,40 @@ class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
         xprv, xpub = bip32_private_derivation(xprv, "m/", derivation)
         self.add_xprv(xprv)
 
+    @contextmanager
+    def signing_session(self, password):
+        """Decrypt the master private key once, and yield a session
+        holding it with the branch nodes derived from it (branch ->
+        (k, c)).  With the session, get_session_private_key neither
+        decrypts nor derives the branch again.  The cached keys are
+        overwritten on exit; this is best effort, since copies made by
+        the derivation code are immutable bytes.
+        """
+        xprv = self.get_master_private_key(password)
+        _, _, _, _, c, k = deserialize_xprv(xprv)
+        if c != deserialize_xpub(self.xpub)[4]:
+            raise InvalidPassword()
+        session = {(): (bytearray(k), bytearray(c))}
+        try:
+            yield session
+        finally:
+            for k, c in session.values():
+                k[:] = bytes(len(k))
+                c[:] = bytes(len(c))
+
+    def get_session_private_key(self, session, sequence, password):
+        branch = tuple(sequence[:-1])
+        node = session.get(branch)
+        if node is None:
+            k, c = session[()]
+            k, c = bytes(k), bytes(c)
+            for i in branch:
+                k, c = CKD_priv(k, c, i)
+            node = session[branch] = (bytearray(k), bytearray(c))
+        k, c = node
+        pk = bip32_private_key(sequence[-1:], bytes(k), bytes(c))
+        return pk, True
+
     def get_private_key(self, sequence, password):
         xprv = self.get_master_private_key(password)
         _, _, _, _, c, k = deserialize_xprv(xprv)
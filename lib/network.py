@@ -20,14 +20,14 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import asyncio
+import base64
 import time
 import queue
 import os
 import stat
-import errno
 import random
 import re
-import select
 from collections import defaultdict
 import threading
 import socket
@@ -43,6 +43,8 @@ from . import bitcoin
 from .bitcoin import *
 from . import constants
 from .interface import Connection, Interface
+from .tx_cache import TxCache, check_raw_tx
+from .synchronizer import history_status
 from . import blockchain
 from .version import ELECTRUM_VERSION, PROTOCOL_VERSION
 from .i18n import _
@@ -50,6 +52,33 @@ from .i18n import _
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+MAINTENANCE_INTERVAL = 1
+# read-only requests that can be sent to any server, with parallel_queries
+PARALLEL_METHODS = {
+    'blockchain.scripthash.get_history',
+    'blockchain.transaction.get',
+    'blockchain.transaction.get_merkle',
+}
+# a read request is sent again to another server after this many
+# round-trip times, at most MAX_READ_COPIES times in total
+HEDGE_RTTS = 4
+MIN_HEDGE_DELAY = 1.0
+MAX_READ_COPIES = 3
+# headers requested at once below a tip that does not connect, to find
+# the fork point of short reorgs without a binary search
+LOCATOR_SIZE = 144
+
+
+class WakeupQueue(queue.Queue):
+    '''A queue that calls wakeup() when an item is put into it.'''
+
+    def __init__(self, wakeup):
+        queue.Queue.__init__(self)
+        self.wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        queue.Queue.put(self, item, block, timeout)
+        self.wakeup()
 
 
 def parse_servers(result):
@@ -108,6 +137,38 @@ from .simple_config import SimpleConfig
 proxy_modes = ['socks4', 'socks5', 'http']
 
 
+def metrics_to_prometheus(metrics):
+    '''Format the output of Network.get_metrics() in the Prometheus text
+    exposition format.'''
+    lines = []
+    def label(**kwargs):
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                              for k, v in sorted(kwargs.items())) + '}'
+    def histogram(name, h, **kwargs):
+        for bound, n in h['buckets']:
+            lines.append('%s_bucket%s %d' % (name, label(le='%g' % bound, **kwargs), n))
+        lines.append('%s_bucket%s %d' % (name, label(le='+Inf', **kwargs), h['count']))
+        lines.append('%s_sum%s %f' % (name, label(**kwargs), h['sum']))
+        lines.append('%s_count%s %d' % (name, label(**kwargs), h['count']))
+    for key in ['pending_sends', 'unanswered_requests', 'read_requests',
+                'requested_chunks', 'subscriptions']:
+        lines.append('electrum_network_%s %d' % (key, metrics[key]))
+    for event, h in sorted(metrics['callbacks'].items()):
+        histogram('electrum_callback_seconds', h, event=event)
+    for i in metrics['interfaces']:
+        server = i['server']
+        for key in ['bytes_sent', 'bytes_received', 'unsent_requests',
+                    'unanswered_requests', 'max_unanswered_requests']:
+            lines.append('electrum_interface_%s%s %d' % (key, label(server=server), i[key]))
+        if i['rtt'] is not None:
+            lines.append('electrum_interface_rtt_seconds%s %f' % (label(server=server), i['rtt']))
+        for method, m in sorted(i['methods'].items()):
+            for key in ['requests', 'responses', 'errors']:
+                lines.append('electrum_%s_total%s %d' % (key, label(server=server, method=method), m[key]))
+            histogram('electrum_request_seconds', m['latency'], server=server, method=method)
+    return '\n'.join(lines) + '\n'
+
+
 def serialize_proxy(p):
     if not isinstance(p, dict):
         return None
@@ -160,11 +221,15 @@ class Network(util.DaemonThread):
     Connections are initiated by a Connection() thread which stops once
     the connection succeeds or fails.
 
+    The network thread runs an asyncio event loop.  Sockets are read
+    and written when they are ready; other threads call wakeup() to
+    have the loop run a pass of maintenance, jobs and pending sends.
+
     Our external API:
 
     - Member functions get_header(), get_interfaces(), get_local_height(),
           get_parameters(), get_server_height(), get_status_value(),
-          is_connected(), set_parameters(), stop()
+          is_connected(), set_parameters(), stop(), wakeup()
     """
 
     def __init__(self, config=None):
@@ -204,15 +269,33 @@ class Network(util.DaemonThread):
         self.sub_cache = {}
         # callbacks set by the GUI
         self.callbacks = defaultdict(list)
+        # time spent in callbacks, per event or response method
+        self.callback_times = defaultdict(util.Histogram)
 
         dir_path = os.path.join( self.config.path, 'certs')
         util.make_dir(dir_path)
 
+        # raw transactions, shared by wallets
+        self.tx_cache = TxCache(os.path.join(self.config.path, 'tx_cache'),
+                                self.config.get('tx_cache_size', 50) * 1000000)
+        # merkle proofs used to be shared too; they are now kept per wallet
+        # by the verifier, in a directory of the same name
+        legacy_proofs = os.path.join(self.config.path, 'merkle_proofs')
+        if os.path.isfile(legacy_proofs):
+            os.unlink(legacy_proofs)
+
         # subscriptions and requests
         self.subscribed_addresses = set()
         self.h2addr = {}
         # Requests from client we've not seen a response to
         self.unanswered_requests = {}
+        # with parallel_queries, read-only requests are spread over the
+        # servers that follow our chain
+        self.parallel_queries = self.config.get('parallel_queries', False)
+        self.read_requests = {}  # message_id -> (interface, time, ids of all copies)
+        # servers that went down while probing for JSON-RPC batches;
+        # they are not probed again
+        self.batch_unsupported = set()
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
@@ -223,8 +306,16 @@ class Network(util.DaemonThread):
         self.interfaces = {}
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
-        self.requested_chunks = set()
-        self.socket_queue = queue.Queue()
+        # chunks are downloaded in parallel from the interfaces on the
+        # chain being caught up, and connected in order
+        self.requested_chunks = {}  # index -> (interface, blockchain, time, height)
+        self.received_chunks = {}  # index -> (interface, blockchain, height, data, compact)
+        # event loop, created in the network thread
+        self.loop = None
+        self.wakeup_pending = False
+        self.watched = {}  # interface -> fileno
+        self.writers = set()
+        self.socket_queue = WakeupQueue(self.wakeup)
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
 
@@ -242,7 +333,11 @@ class Network(util.DaemonThread):
     def trigger_callback(self, event, *args):
         with self.lock:
             callbacks = self.callbacks[event][:]
+        t0 = time.time()
         [callback(event, *args) for callback in callbacks]
+        if callbacks:
+            with self.lock:
+                self.callback_times[event].add(time.time() - t0)
 
     def read_recent_servers(self):
         if not self.config.path:
@@ -308,12 +403,23 @@ class Network(util.DaemonThread):
     def send_subscriptions(self):
         self.print_error('sending subscriptions to', self.interface.server, len(self.unanswered_requests), len(self.subscribed_addresses))
         self.sub_cache.clear()
-        # Resend unanswered requests
-        requests = self.unanswered_requests.values()
+        # Resend unanswered requests; the copies of a read request are
+        # sent again as a single request
+        requests = self.unanswered_requests
+        read_requests = self.read_requests
         self.unanswered_requests = {}
-        for request in requests:
-            message_id = self.queue_request(request[0], request[1])
-            self.unanswered_requests[message_id] = request
+        self.read_requests = {}
+        resent = set()
+        for message_id, request in requests.items():
+            read = read_requests.get(message_id)
+            if read is not None:
+                if id(read[2]) in resent:
+                    continue
+                resent.add(id(read[2]))
+                self.send_read_request(request, [])
+            else:
+                message_id = self.queue_request(request[0], request[1])
+                self.unanswered_requests[message_id] = request
         self.queue_request('server.banner', [])
         self.queue_request('server.donation_address', [])
         self.queue_request('server.peers.subscribe', [])
@@ -356,6 +462,24 @@ class Network(util.DaemonThread):
         host, port, protocol = deserialize_server(self.default_server)
         return host, port, protocol, self.proxy, self.auto_connect
 
+    def get_metrics(self):
+        '''Queue depths of the network and of each interface, request
+        counts and latency histograms per method, and time spent in
+        callbacks.'''
+        with self.lock:
+            callback_times = {k: h.to_dict() for k, h in self.callback_times.items()}
+            pending_sends = len(self.pending_sends)
+        return {
+            'server': self.interface.server if self.interface else None,
+            'pending_sends': pending_sends,
+            'unanswered_requests': len(self.unanswered_requests),
+            'read_requests': len(self.read_requests),
+            'requested_chunks': len(self.requested_chunks),
+            'subscriptions': len(self.subscriptions),
+            'callbacks': callback_times,
+            'interfaces': [i.get_metrics() for i in list(self.interfaces.values())],
+        }
+
     def get_donation_address(self):
         if self.is_connected():
             return self.donation_address
@@ -454,7 +578,7 @@ class Network(util.DaemonThread):
         assert not self.interfaces
         self.connecting = set()
         # Get a new queue - no old pending connections thanks!
-        self.socket_queue = queue.Queue()
+        self.socket_queue = WakeupQueue(self.wakeup)
 
     def set_parameters(self, host, port, protocol, proxy, auto_connect):
         proxy_str = serialize_proxy(proxy)
@@ -484,6 +608,7 @@ class Network(util.DaemonThread):
         else:
             self.switch_lagging_interface()
             self.notify('updated')
+        self.wakeup()
 
     def switch_to_random_interface(self):
         '''Switch to a random connected server other than the current one'''
@@ -530,6 +655,9 @@ class Network(util.DaemonThread):
                 self.interfaces.pop(interface.server)
             if interface.server == self.default_server:
                 self.interface = None
+            if threading.current_thread() is self:
+                # before the file descriptor can be reused
+                self.unwatch_socket(interface)
             interface.close()
 
     def add_recent_server(self, server):
@@ -551,6 +679,15 @@ class Network(util.DaemonThread):
         # We handle some responses; return the rest to the client.
         if method == 'server.version':
             interface.server_version = result
+            if interface.server in self.batch_unsupported:
+                interface.batch = False
+            elif error is None and self.config.get('batch_requests', True):
+                interface.probe_batch(self.queue_request('server.ping', [], interface))
+            if error is None and self.config.get('compact_headers', True):
+                self.queue_request('server.features', [], interface)
+        elif method == 'server.features':
+            if error is None and isinstance(result, dict):
+                interface.compact_headers = 'compact' in result.get('header_formats', [])
         elif method == 'blockchain.headers.subscribe':
             if error is None:
                 self.on_notify_header(interface, result)
@@ -586,8 +723,12 @@ class Network(util.DaemonThread):
         elif method == 'blockchain.block.get_header':
             self.on_get_header(interface, response)
 
+        t0 = time.time()
         for callback in callbacks:
             callback(response)
+        if callbacks:
+            with self.lock:
+                self.callback_times[method].add(time.time() - t0)
 
     def get_index(self, method, params):
         """ hashable index for subscriptions and cache"""
@@ -603,7 +744,21 @@ class Network(util.DaemonThread):
                 # callback, are only sent to the current interface,
                 # and are placed in the unanswered_requests dictionary
                 client_req = self.unanswered_requests.pop(message_id, None)
-                if client_req:
+                read = self.read_requests.pop(message_id, None)
+                if client_req and read:
+                    if interface != self.interface and not self.check_read_response(request, response):
+                        # ask our main server instead
+                        message_id = self.queue_request(method, params)
+                        self.unanswered_requests[message_id] = client_req
+                        read[2].append(message_id)
+                        self.read_requests[message_id] = (self.interface, time.time(), read[2])
+                        continue
+                    # the other copies are no longer needed
+                    for i in read[2]:
+                        self.unanswered_requests.pop(i, None)
+                        self.read_requests.pop(i, None)
+                    callbacks = [client_req[2]]
+                elif client_req:
                     assert interface == self.interface
                     callbacks = [client_req[2]]
                 else:
@@ -645,6 +800,7 @@ class Network(util.DaemonThread):
         messages = list(messages)
         with self.lock:
             self.pending_sends.append((messages, callback))
+        self.wakeup()
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -672,10 +828,76 @@ class Network(util.DaemonThread):
                 if r is not None:
                     self.print_error("cache hit", k)
                     callback(r)
+                elif self.parallel_queries and method in PARALLEL_METHODS:
+                    self.send_read_request((method, params, callback), [])
                 else:
                     message_id = self.queue_request(method, params)
                     self.unanswered_requests[message_id] = method, params, callback
 
+    def pick_read_interface(self, exclude=()):
+        '''The least loaded interface that follows the chain of our main
+        interface, weighted by round-trip time.'''
+        main = self.interface
+        candidates = [i for i in self.interfaces.values()
+                      if i not in exclude and i.mode == 'default'
+                      and main.blockchain is not None and i.blockchain == main.blockchain
+                      and i.tip >= main.tip]
+        if main not in candidates and main not in exclude:
+            candidates.append(main)
+        if not candidates:
+            return main
+        default_rtt = main.rtt or 1.0
+        return min(candidates, key=lambda i: (len(i.unanswered_requests) + len(i.unsent_requests) + 1)
+                                             * (i.rtt or default_rtt))
+
+    def send_read_request(self, request, ids, exclude=()):
+        '''Send a copy of a read-only request.  ids is the list of the
+        message ids of its copies.'''
+        interface = self.pick_read_interface(exclude)
+        message_id = self.queue_request(request[0], request[1], interface)
+        self.unanswered_requests[message_id] = request
+        ids.append(message_id)
+        self.read_requests[message_id] = (interface, time.time(), ids)
+
+    def check_read_response(self, request, response):
+        '''Returns False if a response from another server than our main
+        one should not be trusted: errors, histories that do not match
+        the status announced by our main server, and transactions that
+        do not match their txid.'''
+        method, params, message_id = request
+        if response.get('error'):
+            return False
+        if method == 'blockchain.transaction.get':
+            return check_raw_tx(params[0], response.get('result'))
+        if method == 'blockchain.scripthash.get_history':
+            k = self.get_index('blockchain.scripthash.subscribe', params)
+            status = self.sub_cache.get(k)
+            if status is not None:
+                hist = [(item['tx_hash'], item['height']) for item in response.get('result') or []]
+                return history_status(hist) == status.get('result')
+        return True
+
+    def hedge_read_requests(self):
+        '''Send read requests again to another server if their server is
+        gone or slow to answer.'''
+        now = time.time()
+        for message_id, (interface, t, ids) in list(self.read_requests.items()):
+            if ids[-1] != message_id:
+                continue
+            gone = interface.server not in self.interfaces
+            delay = max(MIN_HEDGE_DELAY, HEDGE_RTTS * interface.rtt) if interface.rtt else 2 * MIN_HEDGE_DELAY
+            if not gone and (now - t < delay or len(ids) >= MAX_READ_COPIES):
+                continue
+            request = self.unanswered_requests.get(message_id)
+            if request is None:
+                self.read_requests.pop(message_id)
+                continue
+            exclude = {self.read_requests[i][0] for i in ids if i in self.read_requests}
+            self.send_read_request(request, ids, exclude)
+            if gone:
+                self.unanswered_requests.pop(message_id, None)
+                self.read_requests.pop(message_id)
+
     def unsubscribe(self, callback):
         '''Unsubscribe a callback to free object references to enable GC.'''
         # Note: we can't unsubscribe from the server, so if we receive
@@ -693,7 +915,13 @@ class Network(util.DaemonThread):
         if server == self.default_server:
             self.set_status('disconnected')
         if server in self.interfaces:
-            self.close_interface(self.interfaces[server])
+            interface = self.interfaces[server]
+            if interface.batch_probe is not None:
+                # the server might close connections that send batches,
+                # or not answer them
+                interface.print_error("disconnected during batch probe, not using batch requests")
+                self.batch_unsupported.add(server)
+            self.close_interface(interface)
             self.notify('interfaces')
         for b in self.blockchains.values():
             if b.catch_up == server:
@@ -703,6 +931,7 @@ class Network(util.DaemonThread):
         # todo: get tip first, then decide which checkpoint to use.
         self.add_recent_server(server)
         interface = Interface(server, socket)
+        interface.max_unanswered_requests = self.config.get('max_unanswered_requests', 100)
         interface.blockchain = None
         interface.tip_header = None
         interface.tip = 0
@@ -732,6 +961,8 @@ class Network(util.DaemonThread):
         # Send pings and shut down stale interfaces
         # must use copy of values
         for interface in list(self.interfaces.values()):
+            if interface.check_batch_probe():
+                self.batch_unsupported.add(interface.server)
             if interface.has_timed_out():
                 self.connection_down(interface.server)
             elif interface.ping_required():
@@ -762,46 +993,113 @@ class Network(util.DaemonThread):
             if self.config.is_fee_estimates_update_required():
                 self.request_fee_estimates()
 
-    def request_chunk(self, interface, index):
-        if index in self.requested_chunks:
+    def request_chunk(self, interface, index, blockchain=None):
+        if index in self.requested_chunks or index in self.received_chunks:
             return
         interface.print_error("requesting chunk %d" % index)
-        self.requested_chunks.add(index)
+        blockchain = blockchain or interface.blockchain
         height = index * 2016
-        self.queue_request('blockchain.block.headers', [height, 2016],
-                           interface)
+        if index >= len(blockchain.checkpoints):
+            # resume a chunk we have the beginning of
+            height = max(height, blockchain.height() + 1)
+        self.requested_chunks[index] = interface, blockchain, time.time(), height
+        params = [height, (index + 1) * 2016 - height]
+        if interface.compact_headers:
+            params += [0, 'compact']
+        self.queue_request('blockchain.block.headers', params, interface)
+
+    def request_chunks(self, blockchain, catch_up, exclude=()):
+        '''Request the chunks following the tip of blockchain, up to the
+        tip of the catch_up interface. Complete chunks are spread over
+        all interfaces on that blockchain.'''
+        first = (blockchain.height() + 1) // 2016
+        last = min(catch_up.tip // 2016, first + self.config.get('max_parallel_chunks', 10) - 1)
+        for index in range(first, last + 1):
+            if index in self.requested_chunks or index in self.received_chunks:
+                continue
+            candidates = [i for i in self.interfaces.values()
+                          if i.blockchain == blockchain and i.tip >= index * 2016 + 2015
+                          and i not in exclude]
+            if catch_up not in candidates:
+                candidates.append(catch_up)
+            load = lambda i: len([x for x in self.requested_chunks.values() if x[0] == i])
+            interface = min(candidates, key=lambda i: (load(i), i != catch_up))
+            self.request_chunk(interface, index, blockchain)
 
     def on_block_headers(self, interface, response):
         '''Handle receiving a chunk of block headers'''
         error = response.get('error')
         result = response.get('result')
         params = response.get('params')
-        blockchain = interface.blockchain
         if result is None or params is None or error is not None:
             interface.print_error(error or 'bad response')
             return
         # Ignore unsolicited chunks
         height = params[0]
         index = height // 2016
-        if index * 2016 != height or index not in self.requested_chunks:
+        request = self.requested_chunks.get(index)
+        if request is None or request[0] != interface or request[3] != height:
+            if interface.mode == 'locator' and interface.request == height:
+                self.on_locator_headers(interface, response)
+                return
             interface.print_error("received chunk %d (unsolicited)" % index)
             return
         else:
             interface.print_error("received chunk %d" % index)
-        self.requested_chunks.remove(index)
-        hexdata = result['hex']
-        connect = blockchain.connect_chunk(index, hexdata)
-        if not connect:
-            self.connection_down(interface.server)
-            return
-        # If not finished, get the next chunk
-        if index >= len(blockchain.checkpoints) and blockchain.height() < interface.tip:
-            self.request_chunk(interface, index+1)
+        blockchain = request[1]
+        del self.requested_chunks[index]
+        if 'compact' in result:
+            data, compact = base64.b64decode(result['compact']), True
         else:
-            interface.mode = 'default'
-            interface.print_error('catch up done', blockchain.height())
+            data, compact = bfh(result['hex']), False
+        self.received_chunks[index] = interface, blockchain, height, data, compact
+        self.connect_received_chunks(blockchain, index)
+
+    def connect_received_chunks(self, blockchain, index):
+        catch_up = self.interfaces.get(blockchain.catch_up)
+        if index < len(blockchain.checkpoints):
+            # requested by the verifier, connect it as is
+            next_index = index
+        else:
+            next_index = (blockchain.height() + 1) // 2016
+            for i, x in list(self.received_chunks.items()):
+                if x[1] == blockchain and len(blockchain.checkpoints) <= i < next_index:
+                    del self.received_chunks[i]
+        while next_index in self.received_chunks:
+            interface, b, height, data, compact = self.received_chunks.pop(next_index)
+            if b != blockchain:
+                # downloaded for another branch: drop it and ask for ours
+                interface.print_error("chunk %d is for another blockchain, requesting it again" % next_index)
+                requester = catch_up if catch_up is not None else interface
+                if requester.server in self.interfaces:
+                    self.request_chunk(requester, next_index, blockchain)
+                break
+            if not blockchain.connect_chunk(next_index, data, height, compact):
+                interface.print_error("bad chunk %d" % next_index)
+                self.connection_down(interface.server)
+                if interface == catch_up or catch_up is None:
+                    return
+                # get its other chunks from the remaining servers
+                for i, x in list(self.requested_chunks.items()):
+                    if x[0] == interface:
+                        del self.requested_chunks[i]
+                for i, x in list(self.received_chunks.items()):
+                    if x[0] == interface:
+                        del self.received_chunks[i]
+                break
+            self.notify('updated')
+            if next_index < len(blockchain.checkpoints):
+                break
+            next_index = (blockchain.height() + 1) // 2016
+        # If not finished, get the next chunks
+        if (catch_up is not None and next_index >= len(blockchain.checkpoints)
+                and blockchain.height() < catch_up.tip):
+            self.request_chunks(blockchain, catch_up)
+        elif catch_up is None or not any(x[1] == blockchain for x in self.requested_chunks.values()):
+            if catch_up is not None:
+                catch_up.mode = 'default'
+                catch_up.print_error('catch up done', blockchain.height())
             blockchain.catch_up = None
-        self.notify('updated')
 
     def on_get_header(self, interface, response):
         '''Handle receiving a single block header'''
@@ -851,48 +1149,8 @@ class Network(util.DaemonThread):
             if interface.bad != interface.good + 1:
                 next_height = (interface.bad + interface.good) // 2
                 assert next_height >= self.max_checkpoint()
-            elif not interface.blockchain.can_connect(interface.bad_header, check_height=False):
-                self.connection_down(interface.server)
-                next_height = None
             else:
-                branch = self.blockchains.get(interface.bad)
-                if branch is not None:
-                    if branch.check_header(interface.bad_header):
-                        interface.print_error('joining chain', interface.bad)
-                        next_height = None
-                    elif branch.parent().check_header(header):
-                        interface.print_error('reorg', interface.bad, interface.tip)
-                        interface.blockchain = branch.parent()
-                        next_height = None
-                    else:
-                        interface.print_error('checkpoint conflicts with existing fork', branch.path())
-                        branch.write(b'', 0)
-                        branch.save_header(interface.bad_header)
-                        interface.mode = 'catch_up'
-                        interface.blockchain = branch
-                        next_height = interface.bad + 1
-                        interface.blockchain.catch_up = interface.server
-                else:
-                    bh = interface.blockchain.height()
-                    next_height = None
-                    if bh > interface.good:
-                        if not interface.blockchain.check_header(interface.bad_header):
-                            b = interface.blockchain.fork(interface.bad_header)
-                            self.blockchains[interface.bad] = b
-                            interface.blockchain = b
-                            interface.print_error("new chain", b.checkpoint)
-                            interface.mode = 'catch_up'
-                            next_height = interface.bad + 1
-                            interface.blockchain.catch_up = interface.server
-                    else:
-                        assert bh == interface.good
-                        if interface.blockchain.catch_up is None and bh < interface.tip:
-                            interface.print_error("catching up from %d"% (bh + 1))
-                            interface.mode = 'catch_up'
-                            next_height = bh + 1
-                            interface.blockchain.catch_up = interface.server
-
-                self.notify('updated')
+                next_height = self.on_fork_point(interface, header)
 
         elif interface.mode == 'catch_up':
             can_connect = interface.blockchain.can_connect(header)
@@ -916,10 +1174,13 @@ class Network(util.DaemonThread):
 
         else:
             raise Exception(interface.mode)
+        self.request_next_header(interface, next_height)
+
+    def request_next_header(self, interface, next_height):
         # If not finished, get the next header
         if next_height:
             if interface.mode == 'catch_up' and interface.tip > next_height + 50:
-                self.request_chunk(interface, next_height // 2016)
+                self.request_chunks(interface.blockchain, interface)
             else:
                 self.request_header(interface, next_height)
         else:
@@ -929,38 +1190,214 @@ class Network(util.DaemonThread):
         # refresh network dialog
         self.notify('interfaces')
 
+    def request_locator(self, interface, height):
+        '''Request in one go the headers below height, to find where the
+        chain of the server joins ours.'''
+        start = max(self.max_checkpoint(), height - self.config.get('locator_size', LOCATOR_SIZE) + 1)
+        interface.mode = 'locator'
+        interface.request = start
+        interface.req_time = time.time()
+        self.queue_request('blockchain.block.headers', [start, height - start + 1], interface)
+
+    def on_locator_headers(self, interface, response):
+        '''Handle the headers requested by request_locator: find the last
+        one we have, and connect the following ones.'''
+        result = response['result']
+        start = response['params'][0]
+        data = bfh(result['hex'])
+        headers = [blockchain.deserialize_header(data[i*80:(i+1)*80], start + i)
+                   for i in range(len(data) // 80)]
+        if interface.tip_header and interface.tip == start + len(headers):
+            headers.append(interface.tip_header)
+        for prev, header in zip(headers, headers[1:]):
+            if header['prev_block_hash'] != blockchain.hash_header(prev):
+                interface.print_error("locator headers do not connect")
+                self.connection_down(interface.server)
+                return
+        for i in range(len(headers) - 1, -1, -1):
+            chain = blockchain.check_header(headers[i])
+            if chain:
+                break
+        else:
+            if not headers or start == self.max_checkpoint():
+                self.connection_down(interface.server)
+                return
+            # the fork is deeper: search it as before
+            interface.print_error("fork below", start)
+            interface.mode = 'backward'
+            interface.bad = start
+            interface.bad_header = headers[0]
+            delta = interface.tip - start
+            self.request_next_header(interface, max(self.max_checkpoint(), interface.tip - 2 * delta))
+            return
+        interface.blockchain = chain
+        interface.good = start + i
+        if i == len(headers) - 1:
+            self.request_next_header(interface, None)
+            return
+        interface.mode = 'binary'
+        interface.bad = interface.good + 1
+        interface.bad_header = headers[i + 1]
+        interface.print_error("fork point", interface.good)
+        next_height = self.on_fork_point(interface, interface.bad_header)
+        if interface.mode == 'catch_up':
+            # connect the headers we already have
+            b = interface.blockchain
+            for header in headers[i + 1:]:
+                if header['block_height'] <= b.height():
+                    continue
+                if not b.can_connect(header):
+                    break
+                b.save_header(header)
+            next_height = b.height() + 1 if b.height() < interface.tip else None
+            if next_height is None:
+                interface.print_error('catch up done', b.height())
+                b.catch_up = None
+                self.switch_lagging_interface()
+                self.notify('updated')
+        self.request_next_header(interface, next_height)
+
+    def on_fork_point(self, interface, header):
+        '''The server agrees with interface.blockchain up to interface.good
+        and disagrees at interface.bad = interface.good + 1.  Join or
+        create the branch of the server, or catch up with it.  Returns the
+        next height to request, if any.'''
+        if not interface.blockchain.can_connect(interface.bad_header, check_height=False):
+            self.connection_down(interface.server)
+            return None
+        branch = self.blockchains.get(interface.bad)
+        if branch is not None:
+            if branch.check_header(interface.bad_header):
+                interface.print_error('joining chain', interface.bad)
+                next_height = None
+            elif branch.parent().check_header(header):
+                interface.print_error('reorg', interface.bad, interface.tip)
+                interface.blockchain = branch.parent()
+                next_height = None
+            else:
+                interface.print_error('checkpoint conflicts with existing fork', branch.path())
+                branch.write(b'', 0)
+                branch.save_header(interface.bad_header)
+                interface.mode = 'catch_up'
+                interface.blockchain = branch
+                next_height = interface.bad + 1
+                interface.blockchain.catch_up = interface.server
+        else:
+            bh = interface.blockchain.height()
+            next_height = None
+            if bh > interface.good:
+                if not interface.blockchain.check_header(interface.bad_header):
+                    b = interface.blockchain.fork(interface.bad_header)
+                    self.blockchains[interface.bad] = b
+                    interface.blockchain = b
+                    interface.print_error("new chain", b.checkpoint)
+                    interface.mode = 'catch_up'
+                    next_height = interface.bad + 1
+                    interface.blockchain.catch_up = interface.server
+            else:
+                assert bh == interface.good
+                if interface.blockchain.catch_up is None and bh < interface.tip:
+                    interface.print_error("catching up from %d"% (bh + 1))
+                    interface.mode = 'catch_up'
+                    next_height = bh + 1
+                    interface.blockchain.catch_up = interface.server
+
+        self.notify('updated')
+        return next_height
+
     def maintain_requests(self):
         for interface in list(self.interfaces.values()):
             if interface.request and time.time() - interface.request_time > 20:
                 interface.print_error("blockchain request timed out")
                 self.connection_down(interface.server)
                 continue
-
-    def wait_on_sockets(self):
-        # Python docs say Windows doesn't like empty selects.
-        # Sleep to prevent busy looping
-        if not self.interfaces:
-            time.sleep(0.1)
+        # request again the chunks of servers that are gone or too slow
+        for index, (interface, blockchain, t, height) in list(self.requested_chunks.items()):
+            if interface.server in self.interfaces and time.time() - t < 20:
+                continue
+            interface.print_error("chunk %d timed out" % index)
+            del self.requested_chunks[index]
+            catch_up = self.interfaces.get(blockchain.catch_up)
+            if catch_up is not None:
+                self.request_chunks(blockchain, catch_up, {interface})
+        if self.read_requests and self.interface:
+            self.hedge_read_requests()
+
+    def wakeup(self):
+        '''Schedule a pass of the main loop.  Can be called from any thread.'''
+        if self.loop is None or self.wakeup_pending:
             return
-        rin = [i for i in self.interfaces.values()]
-        win = [i for i in self.interfaces.values() if i.num_requests()]
+        self.wakeup_pending = True
         try:
-            rout, wout, xout = select.select(rin, win, [], 0.1)
-        except socket.error as e:
-            # TODO: py3, get code from e
-            code = None
-            if code == errno.EINTR:
-                return
-            raise
-        assert not xout
-        for interface in wout:
-            interface.send_requests()
-        for interface in rout:
+            self.loop.call_soon_threadsafe(self.run_once)
+        except RuntimeError:
+            # loop closed
+            pass
+
+    def add_jobs(self, jobs):
+        util.DaemonThread.add_jobs(self, jobs)
+        self.wakeup()
+
+    def stop(self):
+        util.DaemonThread.stop(self)
+        self.wakeup()
+
+    def watch_sockets(self):
+        '''Register the sockets of our interfaces with the event loop;
+        sockets with requests to send are also watched for writing.'''
+        for interface in list(self.watched):
+            if self.interfaces.get(interface.server) is not interface:
+                self.unwatch_socket(interface)
+        for interface in self.interfaces.values():
+            if interface not in self.watched:
+                fd = self.watched[interface] = interface.fileno()
+                self.loop.add_reader(fd, self.on_readable, interface)
+            if interface.num_requests() and interface not in self.writers:
+                self.loop.add_writer(self.watched[interface], self.on_writable, interface)
+                self.writers.add(interface)
+
+    def unwatch_socket(self, interface):
+        fd = self.watched.pop(interface, None)
+        if fd is not None:
+            self.loop.remove_reader(fd)
+            self.loop.remove_writer(fd)
+        self.writers.discard(interface)
+
+    def on_readable(self, interface):
+        if interface in self.watched:
             self.process_responses(interface)
+            self.wakeup()
+
+    def on_writable(self, interface):
+        if interface in self.watched:
+            if not interface.send_requests():
+                self.connection_down(interface.server)
+                self.wakeup()
+                return
+            if interface.num_requests():
+                return
+            self.loop.remove_writer(self.watched[interface])
+        self.writers.discard(interface)
+
+    def on_timer(self):
+        '''Periodic maintenance: pings, timeouts and reconnections.'''
+        self.run_once()
+        self.loop.call_later(MAINTENANCE_INTERVAL, self.on_timer)
+
+    def run_once(self):
+        self.wakeup_pending = False
+        if not self.is_running():
+            self.loop.stop()
+            return
+        self.maintain_sockets()
+        self.maintain_requests()
+        self.run_jobs()    # Synchronizer and Verifier
+        self.process_pending_sends()
+        self.watch_sockets()
 
     def init_headers_file(self):
         b = self.blockchains[0]
-        filename = b.path()
+        filename = b.path(0)
         length = 80 * len(constants.net.CHECKPOINTS) * 2016
         if not os.path.exists(filename) or os.path.getsize(filename) < length:
             with open(filename, 'wb') as f:
@@ -972,13 +1409,13 @@ class Network(util.DaemonThread):
 
     def run(self):
         self.init_headers_file()
-        while self.is_running():
-            self.maintain_sockets()
-            self.wait_on_sockets()
-            self.maintain_requests()
-            self.run_jobs()    # Synchronizer and Verifier
-            self.process_pending_sends()
+        # add_reader is not available on the proactor loop of Windows
+        self.loop = asyncio.SelectorEventLoop()
+        self.loop.call_soon(self.on_timer)
+        self.loop.run_forever()
         self.stop_network()
+        self.watch_sockets()
+        self.loop.close()
         self.on_stop()
 
     def on_notify_header(self, interface, header_dict):
@@ -1008,20 +1445,19 @@ class Network(util.DaemonThread):
             return
         tip = max([x.height() for x in self.blockchains.values()])
         if tip >=0:
-            interface.mode = 'backward'
             interface.bad = height
             interface.bad_header = header
-            self.request_header(interface, min(tip +1, height - 1))
+            self.request_locator(interface, min(tip +1, height - 1))
         else:
             chain = self.blockchains[0]
             if chain.catch_up is None:
-                chain.catch_up = interface
+                chain.catch_up = interface.server
                 interface.mode = 'catch_up'
                 interface.blockchain = chain
                 self.print_error("switching to catchup mode", tip,  self.blockchains)
                 self.request_header(interface, 0)
             else:
-                self.print_error("chain already catching up with", chain.catch_up.server)
+                self.print_error("chain already catching up with", chain.catch_up)
 
     def blockchain(self):
         if self.interface and self.interface.blockchain is not None:
@@ -1160,16 +1596,57 @@ class Network(util.DaemonThread):
 
         return Network.__with_default_synchronous_callback(invocation, callback)
 
-    def get_transaction(self, transaction_hash, callback=None):
+    def cache_transactions(self, callback, retries=1, use_cache=True):
+        '''Wrap callback so that transactions are added to the tx cache,
+        unless use_cache is False.  A transaction that does not match
+        its txid is requested again, up to retries times, then becomes
+        an error.'''
+        def cb(response):
+            if not response.get('error'):
+                tx_hash = response['params'][0]
+                if use_cache:
+                    ok = self.tx_cache.put(tx_hash, response['result'])
+                else:
+                    ok = check_raw_tx(tx_hash, response['result'])
+                if not ok:
+                    if retries > 0:
+                        self.print_error("transaction does not match txid, requesting it again", tx_hash)
+                        self.send([('blockchain.transaction.get', [tx_hash])],
+                                  self.cache_transactions(callback, retries - 1, use_cache))
+                        return
+                    response = dict(response, result=None,
+                                    error='transaction does not match txid %s' % tx_hash)
+            callback(response)
+        return cb
+
+    def get_transaction(self, transaction_hash, callback=None, use_cache=True):
         command = 'blockchain.transaction.get'
-        invocation = lambda c: self.send([(command, [transaction_hash])], c)
+        raw = self.tx_cache.get(transaction_hash) if use_cache else None
+        if raw is not None:
+            if not callback:
+                return raw
+            callback({'method': command, 'params': [transaction_hash], 'result': raw})
+            return
+        invocation = lambda c: self.send([(command, [transaction_hash])],
+                                         self.cache_transactions(c, use_cache=use_cache))
 
         return Network.__with_default_synchronous_callback(invocation, callback)
 
-    def get_transactions(self, transaction_hashes, callback=None):
+    def get_transactions(self, transaction_hashes, callback=None, use_cache=True):
+        '''Transactions found in the tx cache are passed to callback
+        right away.  With use_cache False, the tx cache is neither read
+        nor written.'''
         command = 'blockchain.transaction.get'
-        messages = [(command, [tx_hash]) for tx_hash in transaction_hashes]
-        invocation = lambda c: self.send(messages, c)
+        def invocation(c):
+            messages = []
+            for tx_hash in transaction_hashes:
+                raw = self.tx_cache.get(tx_hash) if use_cache else None
+                if raw is not None:
+                    c({'method': command, 'params': [tx_hash], 'result': raw})
+                else:
+                    messages.append((command, [tx_hash]))
+            if messages:
+                self.send(messages, self.cache_transactions(c, use_cache=use_cache))
 
         return Network.__with_default_synchronous_callback(invocation, callback)
 
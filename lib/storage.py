@@ -33,9 +33,10 @@ import pbkdf2, hmac, hashlib
 import base64
 import zlib
 from collections import defaultdict
+from collections.abc import Mapping, Sequence
 
 from . import util
-from .util import PrintError, profiler, InvalidPassword, WalletFileException, bfh
+from .util import PrintError, profiler, InvalidPassword, WalletFileException, bfh, bh2u
 from .plugins import run_hook, plugin_loaders
 from .keystore import bip44_derivation
 from . import bitcoin
@@ -69,6 +70,147 @@ def get_derivation_used_for_hw_device_encryption():
 # storage encryption version
 STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW = range(0, 3)
 
+# the journal is folded back into the wallet file once it is larger
+# than the wallet file itself, or than this many bytes
+JOURNAL_MIN_COMPACT_SIZE = 1024 * 1024
+
+
+def _view(value):
+    if isinstance(value, dict):
+        return DictView(value)
+    if isinstance(value, list):
+        return ListView(value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+class DictView(Mapping):
+    """Read-only view of a dict held by WalletStorage.
+    Nested containers are wrapped when they are accessed."""
+
+    __slots__ = ('_d',)
+
+    def __init__(self, d):
+        self._d = d
+
+    def __getitem__(self, key):
+        return _view(self._d[key])
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def __repr__(self):
+        return 'DictView(%r)' % self._d
+
+
+class ListView(Sequence):
+    """Read-only view of a list held by WalletStorage."""
+
+    __slots__ = ('_l',)
+
+    def __init__(self, l):
+        self._l = l
+
+    def __getitem__(self, i):
+        return _view(self._l[i])
+
+    def __len__(self):
+        return len(self._l)
+
+    def __repr__(self):
+        return 'ListView(%r)' % self._l
+
+
+class StorageJournal(PrintError):
+    """Append-only log of changes made to a wallet file.
+
+    Each line holds the changes saved by one WalletStorage.write() call,
+    so that an interrupted append only loses the last batch of changes.
+    Lines are optionally transformed by encrypt/decrypt callables.
+
+    The first line records the generation of the wallet file the journal
+    applies to. A journal left behind by a crash after the wallet file
+    was rewritten has an older generation and is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._truncate_to = None
+
+    def diagnostic_name(self):
+        return os.path.basename(self.path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def size(self):
+        return os.path.getsize(self.path) if self.exists() else 0
+
+    def read(self, decrypt=None, generation=None):
+        """Return the list of batches stored in the journal, or an
+        empty list if it does not belong to the given generation of the
+        wallet file."""
+        if not self.exists():
+            return []
+        with open(self.path, 'rb') as f:
+            lines = f.read().split(b'\n')
+        header = None
+        batches = []
+        offset = 0
+        for i, line in enumerate(lines):
+            if line:
+                try:
+                    s = decrypt(line) if decrypt else line
+                    entry = json.loads(s.decode('utf8'))
+                except InvalidPassword:
+                    raise
+                except Exception:
+                    # only the last line can be incomplete
+                    if i < len(lines) - 1:
+                        raise WalletFileException('Cannot read wallet journal %s' % self.path)
+                    self.print_error('ignoring truncated journal entry')
+                    self._truncate_to = offset
+                    break
+                if i == 0 and isinstance(entry, dict):
+                    header = entry
+                else:
+                    batches.append(entry)
+            offset += len(line) + 1
+        # journals written before generations were recorded have no header
+        if (header or {}).get('generation') != generation:
+            self.print_error('ignoring journal of another generation of the wallet file')
+            self._truncate_to = 0
+            return []
+        return batches
+
+    def append(self, batch, encrypt=None, generation=None):
+        def encode(x):
+            s = json.dumps(x, cls=util.MyEncoder).encode('utf8')
+            return (encrypt(s) if encrypt else s) + b'\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, stat.S_IREAD | stat.S_IWRITE)
+        with open(fd, 'wb') as f:
+            if self._truncate_to is not None:
+                f.truncate(self._truncate_to)
+                self._truncate_to = None
+            if f.seek(0, os.SEEK_END) == 0:
+                f.write(encode({'generation': generation}))
+            f.write(encode(batch))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self):
+        self._truncate_to = None
+        if self.exists():
+            os.remove(self.path)
+
+
 class WalletStorage(PrintError):
 
     def __init__(self, path, manual_upgrades=False):
@@ -79,6 +221,14 @@ class WalletStorage(PrintError):
         self.path = path
         self.modified = False
         self.pubkey = None
+        self.journal = StorageJournal(self.path + '.journal')
+        # keys changed since the last write
+        self._dirty_keys = set()
+        # key -> set of sub-keys changed since the last write
+        self._dirty_items = defaultdict(set)
+        # keys handed out by get_view(); copied before they are modified
+        self._shared_keys = set()
+        self._needs_full_write = False
         if self.file_exists():
             with open(self.path, "r", encoding='utf-8') as f:
                 self.raw = f.read()
@@ -90,7 +240,7 @@ class WalletStorage(PrintError):
             # avoid new wallets getting 'upgraded'
             self.put('seed_version', FINAL_SEED_VERSION)
 
-    def load_data(self, s):
+    def load_data(self, s, journal_decrypt=None):
         try:
             self.data = json.loads(s)
         except:
@@ -109,6 +259,8 @@ class WalletStorage(PrintError):
                     continue
                 self.data[key] = value
 
+        self.replay_journal(journal_decrypt)
+
         # check here if I need to load a plugin
         t = self.get('wallet_type')
         l = plugin_loaders.get(t)
@@ -189,7 +341,39 @@ class WalletStorage(PrintError):
             s = None
         self.pubkey = ec_key.get_public_key_hex()
         s = s.decode('utf8')
-        self.load_data(s)
+        self.load_data(s, self._get_journal_decrypt(ec_key))
+
+    def replay_journal(self, decrypt=None):
+        batches = self.journal.read(decrypt, self.data.get('journal_generation'))
+        for batch in batches:
+            for item in batch:
+                if 's' in item:
+                    d = self.data.setdefault(item['k'], {})
+                    if 'v' in item:
+                        d[item['s']] = item['v']
+                    else:
+                        d.pop(item['s'], None)
+                elif 'v' in item:
+                    self.data[item['k']] = item['v']
+                else:
+                    self.data.pop(item['k'], None)
+        if batches:
+            self.print_error("replayed journal", len(batches))
+            if not self.get('use_journal'):
+                # fold it into the wallet file on next write
+                self._needs_full_write = True
+                self.modified = True
+
+    def _get_journal_decrypt(self, ec_key):
+        enc_magic = self._get_encryption_magic()
+        return lambda s: zlib.decompress(ec_key.decrypt_message(s, enc_magic))
+
+    def _get_journal_encrypt(self):
+        if not self.pubkey:
+            return None
+        enc_magic = self._get_encryption_magic()
+        public_key = ecc.ECPubkey(bfh(self.pubkey))
+        return lambda s: public_key.encrypt_message(zlib.compress(s), enc_magic)
 
     def check_password(self, password):
         """Raises an InvalidPassword exception on invalid password"""
@@ -215,6 +399,23 @@ class WalletStorage(PrintError):
         # make sure next storage.write() saves changes
         with self.lock:
             self.modified = True
+            self._needs_full_write = True
+
+    def set_journal_enabled(self, enable):
+        """Append changes to a journal instead of rewriting the whole
+        wallet file on each write. The wallet file is rewritten once,
+        which also serves as migration between the two formats."""
+        with self.lock:
+            self.put('use_journal', True if enable else None)
+            self.compact()
+
+    def compact(self):
+        """Fold the journal into the wallet file."""
+        with self.lock:
+            if self.journal.exists():
+                self._needs_full_write = True
+                self.modified = True
+            self._write()
 
     def get(self, key, default=None):
         with self.lock:
@@ -225,6 +426,16 @@ class WalletStorage(PrintError):
                 v = copy.deepcopy(v)
         return v
 
+    def get_view(self, key, default=None):
+        """Like get(), but returns a read-only view instead of a copy.
+        The view is not affected by later calls to put_item()."""
+        with self.lock:
+            v = self.data.get(key)
+            if v is None:
+                return default
+            self._shared_keys.add(key)
+            return _view(v)
+
     def put(self, key, value):
         try:
             json.dumps(key, cls=util.MyEncoder)
@@ -237,9 +448,47 @@ class WalletStorage(PrintError):
                 if self.data.get(key) != value:
                     self.modified = True
                     self.data[key] = copy.deepcopy(value)
+                    self._set_key_dirty(key)
             elif key in self.data:
                 self.modified = True
                 self.data.pop(key)
+                self._set_key_dirty(key)
+
+    def put_item(self, key, subkey, value):
+        """Set self.data[key][subkey], where self.data[key] is a dict.
+        Only that item is validated, copied and written to the journal.
+        A value of None removes the item."""
+        try:
+            json.dumps(subkey, cls=util.MyEncoder)
+            json.dumps(value, cls=util.MyEncoder)
+        except:
+            self.print_error("json error: cannot save", key, subkey)
+            return
+        with self.lock:
+            d = self.data.get(key)
+            if d is None:
+                if value is None:
+                    return
+                d = self.data[key] = {}
+            elif key in self._shared_keys:
+                d = self.data[key] = dict(d)
+                self._shared_keys.discard(key)
+            if value is not None:
+                if d.get(subkey) == value:
+                    return
+                d[subkey] = copy.deepcopy(value)
+            elif subkey in d:
+                d.pop(subkey)
+            else:
+                return
+            self.modified = True
+            if key not in self._dirty_keys:
+                self._dirty_items[key].add(subkey)
+
+    def _set_key_dirty(self, key):
+        self._dirty_keys.add(key)
+        self._dirty_items.pop(key, None)
+        self._shared_keys.discard(key)
 
     @profiler
     def write(self):
@@ -252,6 +501,48 @@ class WalletStorage(PrintError):
             return
         if not self.modified:
             return
+        if self._can_append_to_journal():
+            self._append_to_journal()
+        else:
+            self._write_full()
+        self._dirty_keys = set()
+        self._dirty_items.clear()
+        self._needs_full_write = False
+        self.modified = False
+
+    def _can_append_to_journal(self):
+        if self._needs_full_write or not self.get('use_journal'):
+            return False
+        if not self.file_exists():
+            return False
+        limit = max(JOURNAL_MIN_COMPACT_SIZE, os.path.getsize(self.path))
+        return self.journal.size() < limit
+
+    def _append_to_journal(self):
+        batch = []
+        for key in sorted(self._dirty_keys):
+            if key in self.data:
+                batch.append({'k': key, 'v': self.data[key]})
+            else:
+                batch.append({'k': key})
+        for key, subkeys in sorted(self._dirty_items.items()):
+            d = self.data.get(key, {})
+            for subkey in subkeys:
+                if subkey in d:
+                    batch.append({'k': key, 's': subkey, 'v': d[subkey]})
+                else:
+                    batch.append({'k': key, 's': subkey})
+        self.journal.append(batch, self._get_journal_encrypt(),
+                            self.data.get('journal_generation'))
+        self.print_error("saved to journal", len(batch))
+
+    def _write_full(self):
+        # a journal that survives a crash before it is cleared below
+        # does not match the new generation, and is not replayed
+        if self.get('use_journal') or self.journal.exists():
+            self.data['journal_generation'] = bh2u(os.urandom(16))
+        else:
+            self.data.pop('journal_generation', None)
         s = json.dumps(self.data, indent=4, sort_keys=True, cls=util.MyEncoder)
         if self.pubkey:
             s = bytes(s, 'utf8')
@@ -275,8 +566,9 @@ class WalletStorage(PrintError):
             os.remove(self.path)
             os.rename(temp_path, self.path)
         os.chmod(self.path, mode)
+        # the wallet file now contains everything in the journal
+        self.journal.clear()
         self.print_error("saved", self.path)
-        self.modified = False
 
     def requires_split(self):
         d = self.get('accounts', {})
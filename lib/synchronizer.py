@@ -23,13 +23,26 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 from threading import Lock
+from collections import deque
 import hashlib
+import heapq
+import itertools
+import time
 
 # from .bitcoin import Hash, hash_encode
 from .transaction import Transaction
 from .util import ThreadJob, bh2u
 
 
+def history_status(h):
+    if not h:
+        return None
+    status = ''
+    for tx_hash, height in h:
+        status += tx_hash + ':%d:' % height
+    return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+
+
 class Synchronizer(ThreadJob):
     '''The synchronizer keeps the wallet up-to-date with its set of
     addresses and their transactions.  It subscribes over the network
@@ -38,18 +51,41 @@ class Synchronizer(ThreadJob):
     we don't have the full history of, and requests binary transaction
     data of any transactions the wallet doesn't have.
 
+    Requests are queued, and sent from run() so that at most 'window'
+    of them are awaiting an answer at any time.  Addresses at the end
+    of the wallet's address sequences are served first, because their
+    history decides whether the wallet creates new addresses.  A
+    request that gets an error is sent again later, with a delay that
+    doubles on each consecutive error.
+
     External interface: __init__() and add() member functions.
     '''
 
+    RETRY_DELAY = 5
+    MAX_RETRY_DELAY = 300
+
     def __init__(self, wallet, network):
         self.wallet = wallet
         self.network = network
+        self.window = network.config.get('sync_window', 500)
         self.new_addresses = set()
         # Entries are (tx_hash, tx_height) tuples
         self.requested_tx = {}
         self.requested_histories = {}
         self.requested_addrs = set()
+        # requests not sent yet; each is also in one of the dicts above
+        self.subscribe_queue = []  # heap of (priority, addr)
+        self.history_queue = []  # heap of (priority, addr)
+        self.tx_queue = deque()
+        # requests that got an error, to be queued again
+        self.retry_queue = []  # heap of (time, n, kind, key, value)
+        self.retry_counter = itertools.count()
+        self.num_errors = {}  # (kind, key) -> consecutive errors
         self.lock = Lock()
+        # throughput metrics
+        self.sync_start = None
+        self.num_addresses = 0
+        self.num_txs = 0
 
         self.initialized = False
         self.initialize()
@@ -62,7 +98,81 @@ class Synchronizer(ThreadJob):
 
     def is_up_to_date(self):
         return (not self.requested_tx and not self.requested_histories
-                and not self.requested_addrs)
+                and not self.requested_addrs and not self.retry_queue)
+
+    def num_inflight(self):
+        return (len(self.requested_addrs) - len(self.subscribe_queue)
+                + len(self.requested_histories) - len(self.history_queue)
+                + len(self.requested_tx) - len(self.tx_queue))
+
+    def get_priority(self, addr):
+        index = self.wallet.get_address_index(addr)
+        if isinstance(index, (list, tuple)) and len(index) == 2:
+            # (for_change, n): newest addresses first
+            return -index[1]
+        return 0
+
+    def get_metrics(self):
+        elapsed = time.time() - self.sync_start if self.sync_start else 0
+        return {
+            'addresses': self.num_addresses,
+            'transactions': self.num_txs,
+            'elapsed': elapsed,
+            'addresses_per_second': self.num_addresses / elapsed if elapsed else 0,
+            'transactions_per_second': self.num_txs / elapsed if elapsed else 0,
+            'inflight': self.num_inflight(),
+        }
+
+    def send_requests(self):
+        '''Send queued requests, keeping at most self.window unanswered.
+        Transactions are sent first, then histories, then subscriptions.'''
+        n = self.window - self.num_inflight()
+        if n <= 0:
+            return
+        if (self.tx_queue or self.history_queue or self.subscribe_queue) and self.sync_start is None:
+            self.sync_start = time.time()
+            self.num_addresses = self.num_txs = 0
+        tx_hashes = []
+        while self.tx_queue and len(tx_hashes) < n:
+            tx_hashes.append(self.tx_queue.popleft())
+        if tx_hashes:
+            self.network.get_transactions(tx_hashes, self.on_tx_response,
+                                          use_cache=self.wallet.use_shared_caches())
+            n -= len(tx_hashes)
+        # note: histories are sent one by one; the network batches them
+        while self.history_queue and n > 0:
+            priority, addr = heapq.heappop(self.history_queue)
+            self.network.request_address_history(addr, self.on_address_history)
+            n -= 1
+        addresses = set()
+        while self.subscribe_queue and len(addresses) < n:
+            priority, addr = heapq.heappop(self.subscribe_queue)
+            addresses.add(addr)
+        if addresses:
+            self.network.subscribe_to_addresses(addresses, self.on_address_status)
+
+    def retry_later(self, kind, key, value=None):
+        '''Queue again a request that got an error, once its delay has
+        passed.  kind is 'addr', 'history' or 'tx'.'''
+        n = self.num_errors.get((kind, key), 0)
+        self.num_errors[(kind, key)] = n + 1
+        delay = min(self.RETRY_DELAY * 2 ** n, self.MAX_RETRY_DELAY)
+        self.print_error("retrying %s %s in %ds" % (kind, key, delay))
+        heapq.heappush(self.retry_queue,
+                       (time.time() + delay, next(self.retry_counter), kind, key, value))
+
+    def requeue_failed_requests(self):
+        now = time.time()
+        while self.retry_queue and self.retry_queue[0][0] <= now:
+            t, n, kind, key, value = heapq.heappop(self.retry_queue)
+            if kind == 'addr':
+                self.subscribe_to_addresses({key})
+            elif kind == 'history':
+                if key not in self.requested_histories:
+                    self.requested_histories[key] = value
+                    heapq.heappush(self.history_queue, (self.get_priority(key), key))
+            elif kind == 'tx':
+                self.request_missing_txs([(key, value)])
 
     def release(self):
         self.network.unsubscribe(self.on_address_status)
@@ -71,35 +181,35 @@ class Synchronizer(ThreadJob):
         '''This can be called from the proxy or GUI threads.'''
         with self.lock:
             self.new_addresses.add(address)
+        self.network.wakeup()
 
     def subscribe_to_addresses(self, addresses):
-        if addresses:
-            self.requested_addrs |= addresses
-            self.network.subscribe_to_addresses(addresses, self.on_address_status)
+        for addr in addresses - self.requested_addrs:
+            heapq.heappush(self.subscribe_queue, (self.get_priority(addr), addr))
+        self.requested_addrs |= addresses
 
     def get_status(self, h):
-        if not h:
-            return None
-        status = ''
-        for tx_hash, height in h:
-            status += tx_hash + ':%d:' % height
-        return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+        return history_status(h)
 
     def on_address_status(self, response):
         if self.wallet.synchronizer is None and self.initialized:
             return  # we have been killed, this was just an orphan callback
         params, result = self.parse_response(response)
         if not params:
+            params = response.get('params')
+            if params and params[0] in self.requested_addrs:
+                self.requested_addrs.remove(params[0])
+                self.retry_later('addr', params[0])
             return
         addr = params[0]
-        history = self.wallet.history.get(addr, [])
-        if self.get_status(history) != result:
+        self.num_errors.pop(('addr', addr), None)
+        if self.wallet.get_address_status(addr) != result:
             # note that at this point 'result' can be None;
             # if we had a history for addr but now the server is telling us
             # there is no history
             if addr not in self.requested_histories:
                 self.requested_histories[addr] = result
-                self.network.request_address_history(addr, self.on_address_history)
+                heapq.heappush(self.history_queue, (self.get_priority(addr), addr))
         # remove addr from list only after it is added to requested_histories
         if addr in self.requested_addrs:  # Notifications won't be in
             self.requested_addrs.remove(addr)
@@ -109,8 +219,13 @@ class Synchronizer(ThreadJob):
             return  # we have been killed, this was just an orphan callback
         params, result = self.parse_response(response)
         if not params:
+            params = response.get('params')
+            if params and params[0] in self.requested_histories:
+                server_status = self.requested_histories.pop(params[0])
+                self.retry_later('history', params[0], server_status)
             return
         addr = params[0]
+        self.num_errors.pop(('history', addr), None)
         try:
             server_status = self.requested_histories[addr]
         except KeyError:
@@ -135,27 +250,39 @@ class Synchronizer(ThreadJob):
             self.print_error("error: status mismatch: %s" % addr)
         else:
             # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.wallet.receive_history_callback(addr, hist, tx_fees, server_status)
             # Request transactions we don't have
             self.request_missing_txs(hist)
         # Remove request; this allows up_to_date to be True
         self.requested_histories.pop(addr)
+        self.num_addresses += 1
 
     def on_tx_response(self, response):
         if self.wallet.synchronizer is None and self.initialized:
             return  # we have been killed, this was just an orphan callback
         params, result = self.parse_response(response)
         if not params:
+            params = response.get('params')
+            if params and params[0] in self.requested_tx:
+                tx_height = self.requested_tx.pop(params[0])
+                self.retry_later('tx', params[0], tx_height)
             return
         tx_hash = params[0]
-        #assert tx_hash == hash_encode(Hash(bytes.fromhex(result)))
+        if tx_hash not in self.requested_tx:
+            self.print_error("receiving tx (unsolicited)", tx_hash)
+            return
+        # the network checked that result hashes to tx_hash
         tx = Transaction(result)
         try:
             tx.deserialize()
         except Exception:
-            self.print_msg("cannot deserialize transaction, skipping", tx_hash)
+            self.print_msg("cannot deserialize transaction", tx_hash)
+            tx_height = self.requested_tx.pop(tx_hash)
+            self.retry_later('tx', tx_hash, tx_height)
             return
         tx_height = self.requested_tx.pop(tx_hash)
+        self.num_errors.pop(('tx', tx_hash), None)
+        self.num_txs += 1
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
         self.print_error("received tx %s height: %d bytes: %d" %
                          (tx_hash, tx_height, len(tx.raw)))
@@ -166,17 +293,14 @@ class Synchronizer(ThreadJob):
 
     def request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
-        transaction_hashes = []
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
             if tx_hash in self.wallet.transactions:
                 continue
-            transaction_hashes.append(tx_hash)
+            self.tx_queue.append(tx_hash)
             self.requested_tx[tx_hash] = tx_height
 
-        self.network.get_transactions(transaction_hashes, self.on_tx_response)
-
     def initialize(self):
         '''Check the initial state of the wallet.  Subscribe to all its
         addresses, and request any transactions in its address history
@@ -206,8 +330,18 @@ class Synchronizer(ThreadJob):
             self.new_addresses = set()
         self.subscribe_to_addresses(addresses)
 
-        # 3. Detect if situation has changed
+        # 3. Send queued requests, and those to retry
+        self.requeue_failed_requests()
+        self.send_requests()
+
+        # 4. Detect if situation has changed
         up_to_date = self.is_up_to_date()
         if up_to_date != self.wallet.is_up_to_date():
             self.wallet.set_up_to_date(up_to_date)
             self.network.trigger_callback('updated')
+            if up_to_date and self.sync_start is not None:
+                m = self.get_metrics()
+                self.print_error("synchronized %d addresses, %d txs in %.1fs (%.1f addr/s, %.1f tx/s)"
+                                 % (m['addresses'], m['transactions'], m['elapsed'],
+                                    m['addresses_per_second'], m['transactions_per_second']))
+                self.sync_start = None
@@ -0,0 +1,239 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from lib import blockchain, constants
+from lib.blockchain import Blockchain, serialize_header, hash_header, compact_headers, MAX_TARGET
+from lib.simple_config import SimpleConfig
+from lib.util import bfh
+
+from . import SequentialTestCase
+
+
+def make_headers(n, prev_hash='00'*32, first_height=0, timestamp=1296688602):
+    '''A synthetic regtest chain of n headers.'''
+    headers = []
+    for height in range(first_height, first_height + n):
+        header = {
+            'version': 1,
+            'prev_block_hash': prev_hash,
+            'merkle_root': '%064x' % height,
+            'timestamp': timestamp + 600 * height,
+            'bits': 0x207fffff,
+            'nonce': height,
+            'block_height': height,
+        }
+        prev_hash = hash_header(header)
+        headers.append(header)
+    return headers
+
+
+class TestBlockchain(SequentialTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        os.makedirs(os.path.join(self.electrum_path, 'forks'))
+        open(os.path.join(self.electrum_path, 'blockchain_headers'), 'wb').close()
+        blockchain.blockchains.clear()
+        self.b = blockchain.blockchains[0] = Blockchain(self.config, 0, None)
+
+    def tearDown(self):
+        blockchain.blockchains.clear()
+        blockchain.recent_hashes.clear()
+        shutil.rmtree(self.electrum_path)
+        super().tearDown()
+
+    def test_read_header_and_get_hash(self):
+        headers = make_headers(10)
+        for header in headers:
+            self.b.save_header(header)
+        self.assertEqual(9, self.b.height())
+        for header in headers[1:]:
+            height = header['block_height']
+            self.assertEqual(header, self.b.read_header(height))
+            self.assertEqual(hash_header(header), self.b.get_hash(height))
+            # cached
+            self.assertEqual(hash_header(header), self.b.get_hash(height))
+        self.assertIsNone(self.b.read_header(10))
+
+    def test_cache_invalidated_on_write(self):
+        headers = make_headers(10)
+        for header in headers:
+            self.b.save_header(header)
+        self.b.get_hash(8)
+        self.b.read_header(8)
+        other = make_headers(3, prev_hash=hash_header(headers[6]), first_height=7, timestamp=0)
+        self.b.write(b''.join(bfh(serialize_header(h)) for h in other), 7 * 80)
+        self.assertEqual(9, self.b.height())
+        self.assertEqual(other[1], self.b.read_header(8))
+        self.assertEqual(hash_header(other[1]), self.b.get_hash(8))
+        self.assertEqual(hash_header(headers[6]), self.b.get_hash(6))
+
+    def test_recent_hashes(self):
+        headers = make_headers(10)
+        for header in headers:
+            self.b.save_header(header)
+        fork = self.b.fork(make_headers(1, prev_hash=hash_header(headers[6]), first_height=7, timestamp=0)[0])
+        blockchain.blockchains[7] = fork
+        self.assertEqual(0, blockchain.recent_hashes[hash_header(headers[9])])
+        self.assertEqual(7, blockchain.recent_hashes[hash_header(fork.read_header(7))])
+        # found with a single get_hash
+        with mock.patch.object(Blockchain, 'get_hash', autospec=True, side_effect=Blockchain.get_hash) as get_hash:
+            self.assertIs(self.b, blockchain.check_header(headers[9]))
+            self.assertIs(fork, blockchain.check_header(fork.read_header(7)))
+        self.assertEqual([self.b, fork], [c[0][0] for c in get_hash.call_args_list])
+        self.assertFalse(blockchain.check_header(make_headers(1, first_height=8)[0]))
+        blockchain.recent_hashes.clear()
+        self.assertIs(self.b, blockchain.check_header(headers[9]))
+
+    def test_recent_hashes_after_swap(self):
+        main, other, longer, fork, fork2 = self.make_forks()
+        self.assertEqual(0, blockchain.recent_hashes[hash_header(longer[-1])])
+        self.assertEqual(15, blockchain.recent_hashes[hash_header(main[19])])
+        self.assertEqual(18, blockchain.recent_hashes[hash_header(other[1])])
+        self.assertIs(fork, blockchain.check_header(longer[-1]))
+        self.assertIs(self.b, blockchain.check_header(main[19]))
+        # pruned branches are removed
+        blockchain.prune_blockchains(self.config, depth=1)
+        self.assertNotIn(15, blockchain.blockchains)
+        self.assertNotIn(15, blockchain.recent_hashes.values())
+        self.assertFalse(blockchain.check_header(main[19]))
+
+    def make_forks(self):
+        '''main chain of 20 headers, a longer fork at 15 and a fork of
+        the main chain at 18.'''
+        main = make_headers(20)
+        for header in main:
+            self.b.save_header(header)
+        other = make_headers(3, prev_hash=hash_header(main[17]), first_height=18, timestamp=1)
+        fork2 = self.b.fork(other[0])
+        fork2.save_header(other[1])
+        longer = make_headers(10, prev_hash=hash_header(main[14]), first_height=15, timestamp=0)
+        fork = self.b.fork(longer[0])
+        for header in longer[1:]:
+            fork.save_header(header)
+        return main, other, longer, fork, fork2
+
+    def test_swap_with_parent(self):
+        main, other, longer, fork, fork2 = self.make_forks()
+        path = os.path.join(self.electrum_path, 'blockchain_headers')
+        self.assertEqual(20 * 80, os.path.getsize(path))
+        # the longer chain is now the main one, without copying headers
+        self.assertIs(fork, blockchain.blockchains[0])
+        self.assertIs(self.b, blockchain.blockchains[15])
+        self.assertEqual((0, None), (fork.checkpoint, fork.parent_id))
+        self.assertEqual((15, 0), (self.b.checkpoint, self.b.parent_id))
+        self.assertEqual(24, fork.height())
+        self.assertEqual(19, self.b.height())
+        self.assertEqual(main[10], fork.read_header(10))
+        self.assertEqual(longer[-1], fork.read_header(24))
+        self.assertEqual(main[17], self.b.read_header(17))
+        # the fork at 18 now forks from the old main chain
+        self.assertEqual(15, fork2.parent_id)
+        self.assertEqual(main[17], fork2.read_header(17))
+        self.assertEqual(other[1], fork2.read_header(19))
+        # both branches can still grow
+        extra = make_headers(1, prev_hash=hash_header(main[19]), first_height=20)[0]
+        self.b.save_header(extra)
+        self.assertEqual(extra, self.b.read_header(20))
+        self.assertEqual(longer[5], fork.read_header(20))
+
+    def test_read_blockchains_from_index(self):
+        main, other, longer, fork, fork2 = self.make_forks()
+        blockchain.blockchains.clear()
+        blockchains = blockchain.read_blockchains(self.config)
+        self.assertEqual([0, 15, 18], sorted(blockchains))
+        self.assertEqual(24, blockchains[0].height())
+        self.assertEqual(longer[-1], blockchains[0].read_header(24))
+        self.assertEqual(main[19], blockchains[15].read_header(19))
+        self.assertEqual(other[1], blockchains[18].read_header(19))
+
+    def test_read_blockchains_without_index(self):
+        main = make_headers(10)
+        for header in main:
+            self.b.save_header(header)
+        other = make_headers(2, prev_hash=hash_header(main[6]), first_height=7, timestamp=0)
+        fork = self.b.fork(other[0])
+        fork.save_header(other[1])
+        self.assertTrue(fork.segments[0][0].startswith(os.path.join('forks', 'seg_')))
+        fdir = os.path.join(self.electrum_path, 'forks')
+        # a fork file of older versions, and names that are not
+        with open(os.path.join(fdir, 'fork_0_7'), 'wb') as f:
+            f.write(b''.join(bfh(serialize_header(h)) for h in other))
+        open(os.path.join(fdir, 'fork_0_x'), 'wb').close()
+        open(os.path.join(fdir, 'fork_3_2'), 'wb').close()
+        os.remove(blockchain.index_path(self.config))
+        blockchain.blockchains.clear()
+        blockchains = blockchain.read_blockchains(self.config)
+        self.assertEqual([0, 7], sorted(blockchains))
+        self.assertEqual(other[1], blockchains[7].read_header(8))
+        self.assertEqual(main[9], blockchains[0].read_header(9))
+
+    def test_prune_blockchains(self):
+        main, other, longer, fork, fork2 = self.make_forks()
+        blockchain.prune_blockchains(self.config, 10)
+        self.assertEqual([0, 15, 18], sorted(blockchain.blockchains))
+        blockchain.prune_blockchains(self.config, 4)
+        self.assertEqual([0], sorted(blockchain.blockchains))
+        self.assertEqual(longer[-1], fork.read_header(24))
+        self.assertEqual(1, len(os.listdir(os.path.join(self.electrum_path, 'forks'))) - 1)
+
+    def test_verify_chunk(self):
+        headers = make_headers(2016)
+        data = b''.join(bfh(serialize_header(h)) for h in headers)
+        self.assertTrue(self.b.connect_chunk(0, data.hex()))
+        self.assertEqual(2015, self.b.height())
+        self.assertEqual(hash_header(headers[-1]), self.b.get_hash(2015))
+
+    def test_connect_compact_chunk(self):
+        headers = make_headers(2016)
+        data = b''.join(bfh(serialize_header(h)) for h in headers)
+        self.assertLess(len(compact_headers(data)), len(data) * 0.6)
+        self.assertEqual(data, self.b.verify_chunk(0, compact_headers(data), compact=True))
+        self.assertTrue(self.b.connect_chunk(0, compact_headers(data), compact=True))
+        self.assertEqual(2015, self.b.height())
+        self.assertEqual(headers[1000], self.b.read_header(1000))
+
+    def test_connect_chunk_resumed(self):
+        headers = make_headers(2016)
+        data = b''.join(bfh(serialize_header(h)) for h in headers)
+        self.assertTrue(self.b.connect_chunk(0, data[:1000 * 80]))
+        self.assertEqual(999, self.b.height())
+        self.assertTrue(self.b.connect_chunk(0, compact_headers(data[1000 * 80:]), 1000, True))
+        self.assertEqual(2015, self.b.height())
+        self.assertEqual(hash_header(headers[-1]), self.b.get_hash(2015))
+        # the missing part must follow our tip
+        self.assertFalse(self.b.connect_chunk(0, data[1001 * 80:], 1000))
+
+    def test_verify_chunk_prev_hash_mismatch(self):
+        headers = make_headers(2016)
+        headers[1000]['prev_block_hash'] = '00' * 32
+        data = b''.join(bfh(serialize_header(h)) for h in headers)
+        with self.assertRaisesRegex(Exception, 'prev hash mismatch'):
+            self.b.verify_chunk(0, data)
+
+    def test_verify_chunk_proof_of_work(self):
+        headers = make_headers(10)
+        for h in headers:
+            h['bits'] = self.b.target_to_bits(MAX_TARGET)
+        data = b''.join(bfh(serialize_header(h)) for h in headers)
+        with mock.patch.object(constants.net, 'TESTNET', False):
+            with self.assertRaisesRegex(Exception, 'insufficient proof of work'):
+                self.b.verify_chunk(0, data)
+            headers[0]['bits'] = 0x1d00fffe
+            data = b''.join(bfh(serialize_header(h)) for h in headers)
+            with self.assertRaisesRegex(Exception, 'bits mismatch'):
+                self.b.verify_chunk(0, data)
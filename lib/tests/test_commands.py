@@ -1,6 +1,9 @@
+import multiprocessing
 import unittest
 from decimal import Decimal
+from unittest import mock
 
+from lib import commands
 from lib.commands import Commands
 
 
@@ -31,3 +34,20 @@ class TestCommands(unittest.TestCase):
         self.assertEqual("2asd", Commands._setconfig_normalize_value('rpcpassword', '2asd'))
         self.assertEqual("['file:///var/www/','https://electrum.org']",
             Commands._setconfig_normalize_value('rpcpassword', "['file:///var/www/','https://electrum.org']"))
+
+    def shutdown_sign_executor(self):
+        commands.get_sign_executor(1).shutdown()
+        commands._sign_executor = None
+        commands._sign_executor_processes = None
+
+    def test_sign_executor(self):
+        get_context = mock.Mock(wraps=multiprocessing.get_context)
+        with mock.patch.object(commands.multiprocessing, 'get_context', get_context):
+            executor = commands.get_sign_executor(2)
+            self.addCleanup(self.shutdown_sign_executor)
+            # kept for later calls, and not forked from our threads
+            self.assertIs(executor, commands.get_sign_executor(2))
+            self.assertEqual(1, get_context.call_count)
+            self.assertNotEqual('fork', get_context.call_args[0][0])
+            self.assertEqual(4, executor.submit(pow, 2, 2).result())
+            self.assertIsNot(executor, commands.get_sign_executor(1))
@@ -1,3 +1,5 @@
+import json
+import socket
 import unittest
 
 from lib import interface
@@ -26,3 +28,107 @@ class TestInterface(SequentialTestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+
+class TestInterfaceBatch(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server, sock = socket.socketpair()
+        self.server.settimeout(1)
+        self.i = interface.Interface('localhost:1:t', sock)
+
+    def tearDown(self):
+        self.i.close()
+        self.server.close()
+        super().tearDown()
+
+    def read(self):
+        data = b''
+        while not data.endswith(b'\n'):
+            data += self.server.recv(65536)
+        return [json.loads(line) for line in data.decode('utf8').splitlines()]
+
+    def write(self, *messages):
+        self.server.sendall(b''.join((json.dumps(m) + '\n').encode('utf8') for m in messages))
+
+    def test_batch(self):
+        self.i.queue_request('server.ping', [], 0)
+        self.i.queue_request('server.banner', [], 1)
+        self.i.probe_batch(0)
+        self.assertTrue(self.i.send_requests())
+        probe, banner = self.read()
+        self.assertEqual([0], [r['id'] for r in probe])
+        self.assertEqual(1, banner['id'])
+        self.write({'id': 1, 'result': ''}, [{'id': 0, 'result': None}])
+        self.assertEqual([1, 0], [r[1]['id'] for r in self.i.get_responses()])
+        self.assertTrue(self.i.batch)
+        for n in range(2, 5):
+            self.i.queue_request('blockchain.scripthash.subscribe', [str(n)], n)
+        self.assertTrue(self.i.send_requests())
+        batch, = self.read()
+        self.assertEqual([2, 3, 4], [r['id'] for r in batch])
+        self.write([{'id': n, 'result': None} for n in (4, 2, 3)])
+        self.assertEqual([4, 2, 3], [r[1]['id'] for r in self.i.get_responses()])
+        self.assertEqual({}, self.i.unanswered_requests)
+
+    def test_batch_not_supported(self):
+        self.i.queue_request('server.ping', [], 0)
+        self.i.probe_batch(0)
+        self.assertTrue(self.i.send_requests())
+        self.read()
+        self.write({'id': None, 'error': {'code': -32600, 'message': 'invalid request'}})
+        self.assertEqual([], self.i.get_responses())
+        self.assertIs(False, self.i.batch)
+        self.i.queue_request('server.banner', [], 1)
+        self.i.queue_request('server.banner', [], 2)
+        self.assertTrue(self.i.send_requests())
+        self.assertEqual([1, 2], [r['id'] for r in self.read()])
+
+    def test_batch_probe_timeout(self):
+        self.i.queue_request('server.ping', [], 0)
+        self.i.probe_batch(0)
+        self.assertTrue(self.i.send_requests())
+        self.read()
+        self.assertFalse(self.i.check_batch_probe())
+        self.i.send_times[0] -= interface.BATCH_PROBE_TIMEOUT
+        self.assertTrue(self.i.check_batch_probe())
+        self.assertIs(False, self.i.batch)
+        self.assertEqual({}, self.i.unanswered_requests)
+        self.assertFalse(self.i.has_timed_out())
+        # a late answer is ignored
+        self.i.queue_request('server.banner', [], 1)
+        self.assertTrue(self.i.send_requests())
+        self.assertEqual([1], [r['id'] for r in self.read()])
+        self.write([{'id': 0, 'result': None}], {'id': 1, 'result': ''})
+        self.assertEqual([1], [r[1]['id'] for r in self.i.get_responses()])
+
+    def test_max_unanswered_requests(self):
+        self.i.max_unanswered_requests = 10
+        for n in range(20):
+            self.i.queue_request('server.ping', [], n)
+        self.assertEqual(10, self.i.num_requests())
+        self.assertTrue(self.i.send_requests())
+        self.read()
+        self.write({'id': 0, 'result': None})
+        self.i.get_responses()
+        self.assertEqual(11, self.i.max_unanswered_requests)
+        self.write({'id': 1, 'error': {'code': interface.SERVER_BUSY, 'message': 'server busy'}})
+        self.i.get_responses()
+        self.assertEqual(interface.MIN_UNANSWERED_REQUESTS, self.i.max_unanswered_requests)
+
+    def test_metrics(self):
+        self.i.queue_request('server.ping', [], 0)
+        self.i.queue_request('server.banner', [], 1)
+        self.assertTrue(self.i.send_requests())
+        self.read()
+        self.write({'id': 0, 'result': None}, {'id': 1, 'error': {'code': 1, 'message': 'no banner'}})
+        self.assertEqual(2, len(self.i.get_responses()))
+        metrics = self.i.get_metrics()
+        self.assertEqual({'requests': 1, 'responses': 1, 'errors': 0},
+                         {k: metrics['methods']['server.ping'][k] for k in ('requests', 'responses', 'errors')})
+        self.assertEqual(1, metrics['methods']['server.banner']['errors'])
+        self.assertEqual(1, metrics['methods']['server.banner']['latency']['count'])
+        self.assertEqual(0, metrics['unanswered_requests'])
+        self.assertGreater(metrics['bytes_sent'], 0)
+        self.assertGreater(metrics['bytes_received'], 0)
@@ -0,0 +1,95 @@
+import threading
+from collections import defaultdict
+from unittest import mock
+
+from lib.network import Network
+
+from . import SequentialTestCase
+
+
+class MockInterface:
+
+    def __init__(self, server):
+        self.server = server
+        self.mode = 'default'
+        self.blockchain = 'chain'
+        self.tip = 100
+        self.rtt = 0.1
+        self.unanswered_requests = {}
+        self.unsent_requests = []
+        self.compact_headers = False
+
+    def print_error(self, *msg):
+        pass
+
+    def queue_request(self, method, params, message_id):
+        self.unsent_requests.append((method, params, message_id))
+
+    def answer(self, network, method, result):
+        '''Answer the queued requests of method and process the
+        responses.  Returns the number of requests answered.'''
+        requests = [r for r in self.unsent_requests if r[0] == method]
+        self.unsent_requests = [r for r in self.unsent_requests if r[0] != method]
+        self.get_responses = lambda: [(r, {'id': r[2], 'result': result}) for r in requests]
+        network.process_responses(self)
+        return len(requests)
+
+
+class TestReadRequests(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        network = self.network = Network.__new__(Network)
+        network.debug = False
+        network.lock = threading.Lock()
+        network.config = mock.Mock()
+        network.message_id = 0
+        network.unanswered_requests = {}
+        network.read_requests = {}
+        network.sub_cache = {}
+        network.subscriptions = {}
+        network.subscribed_addresses = set()
+        network.callback_times = defaultdict(mock.Mock)
+        network.set_status = mock.Mock()
+        network.notify = mock.Mock()
+        self.interfaces = [MockInterface('server%d:50002:s' % i) for i in range(3)]
+        network.interfaces = {i.server: i for i in self.interfaces[:2]}
+        network.interface = self.interfaces[0]
+
+    def test_switch_interface_with_hedged_read(self):
+        network = self.network
+        callback = mock.Mock()
+        request = ('blockchain.scripthash.get_history', ['00' * 32], callback)
+        ids = []
+        network.send_read_request(request, ids)
+        network.send_read_request(request, ids, exclude={network.read_requests[ids[0]][0]})
+        self.assertEqual(2, len(ids))
+        # the copies are sent again as one request
+        new = self.interfaces[2]
+        network.interfaces[new.server] = new
+        network.switch_to_interface(new.server)
+        self.assertEqual(1, len(network.read_requests))
+        # late answers to the old copies are ignored
+        method = request[0]
+        for interface in self.interfaces[:2]:
+            interface.unsent_requests = [r for r in interface.unsent_requests if r[2] in ids]
+            interface.answer(network, method, [])
+        self.assertFalse(callback.called)
+        self.assertEqual(1, sum(i.answer(network, method, []) for i in self.interfaces))
+        callback.assert_called_once()
+        self.assertEqual({}, network.read_requests)
+        self.assertEqual({}, network.unanswered_requests)
+
+    def test_chunk_for_another_blockchain(self):
+        network = self.network
+        interface = network.interface
+        ours, other = mock.Mock(checkpoints=[], catch_up=None), mock.Mock()
+        ours.height.return_value = 2015
+        network.requested_chunks = {}
+        network.received_chunks = {1: (interface, other, 2016, b'', False)}
+        network.connect_received_chunks(ours, 1)
+        self.assertFalse(ours.connect_chunk.called)
+        self.assertEqual({}, network.received_chunks)
+        # the chunk is requested again for our blockchain
+        self.assertEqual((interface, ours), network.requested_chunks[1][:2])
+        self.assertEqual([('blockchain.block.headers', [2016, 2016], 0)], interface.unsent_requests)
@@ -0,0 +1,131 @@
+from unittest import mock
+
+from lib import keystore, storage, synchronizer
+from lib.synchronizer import Synchronizer, history_status
+from lib.transaction import Transaction
+
+from . import TestCaseForTestnet
+from .test_wallet_vertical import WalletIntegrityHelper
+
+
+funding_tx = '010000000001011f4db0ecd81f4388db316bc16efb4e9daf874cf4950d54ecb4c0fb372433d68500000000171600143d57fd9e88ef0e70cddb0d8b75ef86698cab0d44fdffffff0280969800000000001976a91472e34cebab371967b038ce41d0e8fa1fb983795e88ac86a0ae020000000017a9149188bc82bdcae077060ebb4f02201b73c806edc887024830450221008e0725d531bd7dee4d8d38a0f921d7b1213e5b16c05312a80464ecc2b649598d0220596d309cf66d5f47cb3df558dbb43c5023a7796a80f5a88b023287e45a4db6b9012102c34d61ceafa8c216f01e05707672354f8119334610f7933a3f80dd7fb6290296bd391400'
+
+
+class MockNetwork:
+    '''Records the requests of the synchronizer; the test answers them.'''
+
+    def __init__(self, window):
+        self.config = {'sync_window': window}
+        self.requests = []  # (kind, key, callback)
+
+    def subscribe_to_addresses(self, addresses, callback):
+        self.requests += [('addr', addr, callback) for addr in addresses]
+
+    def request_address_history(self, addr, callback):
+        self.requests.append(('history', addr, callback))
+
+    def get_transactions(self, tx_hashes, callback, use_cache=True):
+        self.use_cache = use_cache
+        self.requests += [('tx', tx_hash, callback) for tx_hash in tx_hashes]
+
+    def trigger_callback(self, *args):
+        pass
+
+    def answer(self, kind, result=None, error=None):
+        '''Answer the pending requests of kind with an error, or with
+        result(key).  Returns the keys of the requests.'''
+        requests = [r for r in self.requests if r[0] == kind]
+        self.requests = [r for r in self.requests if r[0] != kind]
+        for kind, key, callback in requests:
+            if error:
+                callback({'params': [key], 'error': error})
+            else:
+                callback({'params': [key], 'result': result(key)})
+        return [key for kind, key, callback in requests]
+
+
+class TestSynchronizer(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        ks = keystore.from_seed('fold object utility erase deputy output stadium feed stereo usage modify bean', '', False)
+        self.wallet = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2)
+        self.network = MockNetwork(window=2)
+        self.now = 1000
+        patcher = mock.patch.object(synchronizer, 'time')
+        self.addCleanup(patcher.stop)
+        patcher.start().time.side_effect = lambda: self.now
+        self.sync = Synchronizer(self.wallet, self.network)
+        self.wallet.synchronizer = self.sync
+
+    def run_until_idle(self, kind, result):
+        '''Run and answer requests of kind until no more are sent.'''
+        keys = []
+        while True:
+            self.sync.run()
+            answered = self.network.answer(kind, result)
+            if not answered:
+                return keys
+            keys += answered
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_error_responses(self, mock_write):
+        tx = Transaction(funding_tx)
+        txid = tx.txid()
+        funding_addr = self.wallet.get_txout_address(tx.outputs()[0])
+        hist = [(txid, 1325500)]
+        addresses = self.wallet.get_addresses()
+        self.assertIn(funding_addr, addresses)
+
+        # errors free the window
+        self.sync.run()
+        self.assertEqual(2, self.sync.num_inflight())
+        failed = self.network.answer('addr', error='server busy')
+        self.assertEqual(0, self.sync.num_inflight())
+        status = lambda addr: history_status(hist) if addr == funding_addr else None
+        others = self.run_until_idle('addr', status)
+        self.assertEqual(set(addresses), set(failed) | set(others))
+        self.assertFalse(self.sync.is_up_to_date())
+
+        # and are retried after a delay
+        self.sync.run()
+        self.assertNotIn('addr', [r[0] for r in self.network.requests])
+        self.now += Synchronizer.RETRY_DELAY
+        self.assertEqual(set(failed), set(self.run_until_idle('addr', status)))
+        self.sync.run()
+        self.assertEqual([('history', funding_addr)], [r[:2] for r in self.network.requests])
+
+        # the delay doubles on consecutive errors
+        self.network.answer('history', error='server busy')
+        self.now += Synchronizer.RETRY_DELAY
+        self.sync.run()
+        self.network.answer('history', error='server busy')
+        self.now += Synchronizer.RETRY_DELAY
+        self.sync.run()
+        self.assertEqual([], self.network.requests)
+        self.now += Synchronizer.RETRY_DELAY
+        self.sync.run()
+        self.network.answer('history', lambda addr: [{'tx_hash': txid, 'height': 1325500}])
+        self.assertEqual(hist, self.wallet.history[funding_addr])
+
+        self.sync.run()
+        self.network.answer('tx', error='no such transaction')
+        self.assertEqual(0, self.sync.num_inflight())
+        self.assertFalse(self.sync.is_up_to_date())
+        self.now += Synchronizer.RETRY_DELAY
+        self.sync.run()
+        self.network.answer('tx', lambda tx_hash: funding_tx)
+        self.assertIn(txid, self.wallet.transactions)
+        self.sync.run()
+        self.assertTrue(self.sync.is_up_to_date())
+        self.assertTrue(self.wallet.is_up_to_date())
+
+    def test_encrypted_wallet_does_not_use_tx_cache(self):
+        self.sync.window = 100
+        self.sync.request_missing_txs([('00' * 32, 1)])
+        self.sync.run()
+        self.assertTrue(self.network.use_cache)
+        self.sync.request_missing_txs([('11' * 32, 1)])
+        with mock.patch.object(self.wallet.storage, 'is_encrypted', return_value=True):
+            self.sync.run()
+        self.assertFalse(self.network.use_cache)
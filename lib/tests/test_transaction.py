@@ -1,7 +1,9 @@
 import unittest
+from concurrent.futures import ProcessPoolExecutor
 
 from lib import transaction
-from lib.bitcoin import TYPE_ADDRESS
+from lib import ecc
+from lib.bitcoin import TYPE_ADDRESS, TYPE_SCRIPT, Hash, pubkey_to_address
 from lib.keystore import xpubkey_to_address
 from lib.util import bh2u, bfh
 
@@ -141,6 +143,22 @@ class TestTransaction(SequentialTestCase):
         self.assertEqual(tx.estimated_weight(), 772)
         self.assertEqual(tx.estimated_size(), 193)
 
+    def test_transaction_store(self):
+        store = transaction.TransactionStore()
+        store.load_raw('a', signed_blob)
+        self.assertIn('a', store)
+        self.assertEqual(1, len(store))
+        self.assertEqual(signed_blob, store.get_raw('a'))
+        tx = store['a']
+        self.assertEqual(signed_blob, tx.raw)
+        self.assertIs(tx, store['a'])
+        store['b'] = transaction.Transaction(unsigned_blob)
+        self.assertEqual(unsigned_blob, store.get_raw('b'))
+        del store['a']
+        self.assertEqual(['b'], list(store))
+        with self.assertRaises(KeyError):
+            store['a']
+
     def test_estimated_output_size(self):
         estimated_output_size = transaction.Transaction.estimated_output_size
         self.assertEqual(estimated_output_size('14gcRovpkCoGkCNBivQBvw7eso7eiNAbxG'), 34)
@@ -158,6 +176,130 @@ class TestTransaction(SequentialTestCase):
         self.assertEqual(tx.estimated_weight(), 561)
         self.assertEqual(tx.estimated_size(), 141)
 
+    def test_serialize_preimage_bip143(self):
+        # native P2WPKH example from BIP-0143
+        inputs = [{
+            'type': 'p2pk',
+            'prevout_hash': '9f96ade4b41d5433f4eda31e1738ec2b36f6e7d1420d94a6af99801a88f7f7ff',
+            'prevout_n': 0,
+            'sequence': 0xffffffee,
+            'x_pubkeys': ['03c9f4836b9a4f77fc0d81f7bcb01b7f1b35916864b9476c241ce9fc198bd25432'],
+            'pubkeys': ['03c9f4836b9a4f77fc0d81f7bcb01b7f1b35916864b9476c241ce9fc198bd25432'],
+            'signatures': [None],
+            'num_sig': 1,
+            'value': 625000000,
+        }, {
+            'type': 'p2wpkh',
+            'prevout_hash': '8ac60eb9575db5b2d987e29f301b5b819ea83a5c6579d282d189cc04b8e151ef',
+            'prevout_n': 1,
+            'sequence': 0xffffffff,
+            'x_pubkeys': ['025476c2e83188368da1ff3e292e7acafcdb3566bb0ad253f62fc70f07aeee6357'],
+            'pubkeys': ['025476c2e83188368da1ff3e292e7acafcdb3566bb0ad253f62fc70f07aeee6357'],
+            'signatures': [None],
+            'num_sig': 1,
+            'value': 600000000,
+        }]
+        outputs = [(TYPE_SCRIPT, '76a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac', 112340000),
+                   (TYPE_SCRIPT, '76a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa815988ac', 223450000)]
+        tx = transaction.Transaction.from_io(inputs, outputs, locktime=17)
+        self.assertEqual('0100000096b827c8483d4e9b96712b6713a7b68d6e8003a781feba36c31143470b4efd3752b0a642eea2fb7ae638c36f6252b6750293dbe574a806984b8e4d8548339a3bef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a010000001976a9141d0f172a0ecb48aee1be1f2687d2963ae33f71a188ac0046c32300000000ffffffff863ef3e1a92afbfdb97f31ad0fc7683ee943e9abcf2501590ff8f6551f47e5e51100000001000000',
+                         tx.serialize_preimage(1))
+        self.assertEqual('c37af31116d1b27caf68aae9e3ac82f1477929014d5b917657d0eb49478cb670',
+                         bh2u(Hash(tx.serialize_preimage_bytes(1))))
+        self.assertEqual('0100000002fff7f7881a8099afa6940d42d1e7f6362bec38171ea3edf433541db4e4ad969f00000000232103c9f4836b9a4f77fc0d81f7bcb01b7f1b35916864b9476c241ce9fc198bd25432aceeffffffef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a0100000000ffffffff02202cb206000000001976a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac9093510d000000001976a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa815988ac1100000001000000',
+                         tx.serialize_preimage(0))
+        # the shared hashes are recomputed after the transaction changes
+        preimage = tx.serialize_preimage(1)
+        tx.set_rbf(True)
+        self.assertNotEqual(preimage, tx.serialize_preimage(1))
+        self.assertEqual(transaction.Transaction.from_io(inputs, outputs, locktime=17).serialize_preimage(1),
+                         tx.serialize_preimage(1))
+        tx.add_outputs([(TYPE_SCRIPT, '6a', 0)])
+        self.assertEqual(transaction.Transaction.from_io(inputs, tx.outputs(), locktime=17).serialize_preimage(1),
+                         tx.serialize_preimage(1))
+
+    def test_memoized_until_mutated(self):
+        tx = transaction.Transaction(signed_segwit_blob)
+        txid = tx.txid()
+        self.assertEqual(txid, tx.txid())
+        self.assertEqual(141, tx.estimated_size())
+        tx.locktime += 1
+        self.assertNotEqual(txid, tx.txid())
+        self.assertEqual(transaction.Transaction(tx.serialize()).txid(), tx.txid())
+        tx.add_outputs([(TYPE_SCRIPT, '6a', 0)])
+        self.assertEqual(151, tx.estimated_size())
+        self.assertEqual(transaction.Transaction(tx.serialize()).wtxid(), tx.wtxid())
+
+    def test_scan_transaction(self):
+        raw = bfh(signed_segwit_blob)
+        d = transaction.scan_transaction(raw)
+        self.assertTrue(d['segwit_ser'])
+        self.assertEqual([(7, 44, 44)], d['inputs'])
+        self.assertEqual(2, len(d['outputs']))
+        self.assertEqual(raw[d['witnesses'][0][0]:d['witnesses'][0][1]],
+                         bfh(transaction.Transaction(signed_segwit_blob).inputs()[0]['witness']))
+        self.assertEqual(transaction.Transaction(signed_segwit_blob).txid(),
+                         transaction.txid_from_raw(raw))
+        with self.assertRaises(transaction.SerializationError):
+            transaction.scan_transaction(raw[:-1])
+        with self.assertRaises(transaction.SerializationError):
+            transaction.scan_transaction(raw + b'\x00')
+        with self.assertRaises(transaction.SerializationError):
+            transaction.scan_transaction(raw[:60])
+
+    def test_memoized_values_follow_input_changes(self):
+        pubkey = ecc.ECPrivkey(bytes([1]) * 32).get_public_key_hex(compressed=True)
+        def make_input(txin_type):
+            return {
+                'type': txin_type,
+                'address': pubkey_to_address(txin_type, pubkey),
+                'prevout_hash': '00' * 32,
+                'prevout_n': 0,
+                'x_pubkeys': [pubkey],
+                'pubkeys': [pubkey],
+                'signatures': [None],
+                'num_sig': 1,
+                'value': 100000,
+            }
+        outputs = [(TYPE_SCRIPT, '6a', 90000)]
+        tx = transaction.Transaction.from_io([make_input('p2pkh')], list(outputs))
+        self.assertIsNone(tx.txid())
+        p2pkh_size = tx.estimated_size()
+        # completed in place, as add_input_info does
+        tx.inputs()[0].update(make_input('p2wpkh'))
+        expected = transaction.Transaction.from_io([make_input('p2wpkh')], list(outputs))
+        self.assertLess(tx.estimated_size(), p2pkh_size)
+        self.assertEqual(expected.estimated_size(), tx.estimated_size())
+        self.assertEqual(expected.txid(), tx.txid())
+        tx.inputs()[0]['prevout_n'] = 1
+        self.assertNotEqual(expected.txid(), tx.txid())
+
+    def test_sign_with_executor(self):
+        privkeys = [bytes([i + 1]) * 32 for i in range(4)]
+        pubkeys = [ecc.ECPrivkey(k).get_public_key_hex(compressed=True) for k in privkeys]
+        def make_tx():
+            inputs = [{
+                'type': 'p2wpkh',
+                'address': pubkey_to_address('p2wpkh', pubkeys[i % 4]),
+                'prevout_hash': '%064x' % i,
+                'prevout_n': i,
+                'x_pubkeys': [pubkeys[i % 4]],
+                'pubkeys': [pubkeys[i % 4]],
+                'signatures': [None],
+                'num_sig': 1,
+                'value': 100000,
+            } for i in range(8)]
+            outputs = [(TYPE_SCRIPT, '6a', 790000)]
+            return transaction.Transaction.from_io(inputs, outputs)
+        keypairs = {pubkey: (k, True) for k, pubkey in zip(privkeys, pubkeys)}
+        tx = make_tx()
+        tx.sign(keypairs)
+        self.assertTrue(tx.is_complete())
+        tx2 = make_tx()
+        with ProcessPoolExecutor(2) as executor:
+            tx2.sign(keypairs, executor)
+        self.assertEqual(tx.raw, tx2.raw)
+
     def test_errors(self):
         with self.assertRaises(TypeError):
             transaction.Transaction.pay_script(output_type=None, addr='')
@@ -199,6 +341,7 @@ class TestTransaction(SequentialTestCase):
         tx = transaction.Transaction(raw_tx)
         self.assertEqual(txid, tx.txid())
         self.assertEqual(raw_tx, tx.serialize())
+        self.assertEqual(txid, tx.txid())  # from the parsed transaction
         self.assertTrue(tx.estimated_size() >= 0)
 
     def test_txid_coinbase_to_p2pk(self):
@@ -780,6 +923,7 @@ class TestTransactionTestnet(TestCaseForTestnet):
         tx = transaction.Transaction(raw_tx)
         self.assertEqual(txid, tx.txid())
         self.assertEqual(raw_tx, tx.serialize())
+        self.assertEqual(txid, tx.txid())  # from the parsed transaction
         self.assertTrue(tx.estimated_size() >= 0)
 
 # partial txns using our partial format --->
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from lib.network import Network
+from lib.tx_cache import TxCache
+
+from . import SequentialTestCase
+
+
+p2pkh_tx = '0100000001f9dd7d33f315617530dd72264b5d9c69b815626cce3f66266d1015b1a590ba90000000006a4730440220699bfee3d280a499daf4af5593e8750b54fef0557f3c9f717bfa909493a84f60022057718eec7985b7796bb8630bf6ea2e9bf2892ac21bd6ab8f741a008537139ffe012103b4289890b40590447b57f773b5843bf0400e9cead08be225fac587b3c2a8e973fdffffff01ec24052a010000001976a914ce9ff3d15ed5f3a3d94b583b12796d063879b11588ac00000000'
+p2pkh_txid = '24737c68f53d4b519939119ed83b2a8d44d716d7f3ca98bcecc0fbb92c2085ce'
+p2wpkh_tx = '010000000001010d350cefa29138de18a2d63a93cffda63721b07a6ecfa80a902f9514104b55ca0000000000fdffffff012a4a824a00000000160014b869999d342a5d42d6dc7af1efc28456da40297a024730440220475bb55814a52ea1036919e4408218c693b8bf93637b9f54c821b5baa3b846e102207276ed7a79493142c11fb01808a4142bbdd525ae7bdccdf8ecb7b8e3c856b4d90121024cdeaca7a53a7e23a1edbe9260794eaa83063534b5f111ee3c67d8b0cb88f0eec8010000'
+p2wpkh_txid = '51087ece75c697cc872d2e643d646b0f3e1f2666fa1820b7bff4343d50dd680e'
+
+
+class TestTxCache(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super().tearDown()
+
+    def test_put_get(self):
+        cache = TxCache(self.path, 1000000)
+        self.assertIsNone(cache.get(p2pkh_txid))
+        self.assertTrue(cache.put(p2pkh_txid, p2pkh_tx))
+        self.assertTrue(cache.put(p2wpkh_txid, p2wpkh_tx))
+        self.assertEqual(p2pkh_tx, cache.get(p2pkh_txid))
+        # persisted
+        cache = TxCache(self.path, 1000000)
+        self.assertIn(p2wpkh_txid, cache)
+        self.assertEqual(p2wpkh_tx, cache.get(p2wpkh_txid))
+        self.assertEqual(p2pkh_tx, cache.get(p2pkh_txid))
+
+    def test_txid_mismatch(self):
+        cache = TxCache(self.path, 1000000)
+        self.assertFalse(cache.put(p2wpkh_txid, p2pkh_tx))
+        self.assertFalse(cache.put(p2pkh_txid, 'not a transaction'))
+        self.assertNotIn(p2wpkh_txid, cache)
+        self.assertNotIn(p2pkh_txid, cache)
+
+    def test_eviction(self):
+        cache = TxCache(self.path, len(p2pkh_tx) // 2 + 10)
+        cache.put(p2pkh_txid, p2pkh_tx)
+        cache.put(p2wpkh_txid, p2wpkh_tx)
+        self.assertFalse(os.path.exists(cache.filename(p2pkh_txid)))
+        self.assertTrue(os.path.exists(cache.filename(p2wpkh_txid)))
+        cache = TxCache(self.path, len(p2pkh_tx) // 2 + 10)
+        self.assertIsNone(cache.get(p2pkh_txid))
+        self.assertEqual(p2wpkh_tx, cache.get(p2wpkh_txid))
+
+    def test_network_txid_mismatch(self):
+        network = Network.__new__(Network)
+        network.tx_cache = TxCache(self.path, 1000000)
+        network.send = mock.Mock()
+        callback = mock.Mock()
+        command = 'blockchain.transaction.get'
+        # a transaction that does not match is requested again
+        cb = network.cache_transactions(callback)
+        cb({'method': command, 'params': [p2wpkh_txid], 'result': p2pkh_tx})
+        self.assertFalse(callback.called)
+        (messages, cb2), kwargs = network.send.call_args
+        self.assertEqual([(command, [p2wpkh_txid])], messages)
+        cb2({'method': command, 'params': [p2wpkh_txid], 'result': p2wpkh_tx})
+        callback.assert_called_once_with({'method': command, 'params': [p2wpkh_txid], 'result': p2wpkh_tx})
+        self.assertIn(p2wpkh_txid, network.tx_cache)
+        # then becomes an error
+        callback.reset_mock()
+        network.send.reset_mock()
+        cb = network.cache_transactions(callback, retries=0)
+        cb({'method': command, 'params': [p2pkh_txid], 'result': p2wpkh_tx})
+        self.assertFalse(network.send.called)
+        self.assertTrue(callback.call_args[0][0]['error'])
+        # other servers than the main one are not trusted either
+        request = (command, [p2pkh_txid], 1)
+        self.assertFalse(network.check_read_response(request, {'result': p2wpkh_tx}))
+        self.assertFalse(network.check_read_response(request, {'result': 'not a transaction'}))
+        self.assertTrue(network.check_read_response(request, {'result': p2pkh_tx}))
+
+    def test_network_without_cache(self):
+        network = Network.__new__(Network)
+        network.tx_cache = TxCache(self.path, 1000000)
+        network.tx_cache.put(p2pkh_txid, p2pkh_tx)
+        network.send = mock.Mock()
+        callback = mock.Mock()
+        command = 'blockchain.transaction.get'
+        network.get_transactions([p2pkh_txid, p2wpkh_txid], callback, use_cache=False)
+        self.assertFalse(callback.called)
+        (messages, cb), kwargs = network.send.call_args
+        self.assertEqual([(command, [p2pkh_txid]), (command, [p2wpkh_txid])], messages)
+        cb({'method': command, 'params': [p2wpkh_txid], 'result': p2wpkh_tx})
+        callback.assert_called_once_with({'method': command, 'params': [p2wpkh_txid], 'result': p2wpkh_tx})
+        self.assertNotIn(p2wpkh_txid, TxCache(self.path, 1000000))
+
+    def test_network_get_transactions_without_callback(self):
+        network = Network.__new__(Network)
+        network.tx_cache = TxCache(self.path, 1000000)
+        network.tx_cache.put(p2pkh_txid, p2pkh_tx)
+        network.send = mock.Mock()
+        # synchronous, as before
+        self.assertEqual(p2pkh_tx, network.get_transactions([p2pkh_txid]))
+        self.assertFalse(network.send.called)
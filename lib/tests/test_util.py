@@ -1,5 +1,7 @@
+import json
+import socket
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import format_satoshis, parse_URI, SocketPipe, Histogram
 
 from . import SequentialTestCase
 
@@ -107,3 +109,63 @@ class TestUtil(SequentialTestCase):
 
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
+
+
+class TestHistogram(SequentialTestCase):
+
+    def test_percentiles(self):
+        h = Histogram()
+        for i in range(1, 101):
+            h.add(i / 1000)
+        self.assertEqual(100, h.count)
+        self.assertAlmostEqual(5.05, h.sum)
+        self.assertEqual(0.1, h.max)
+        for p in (50, 90, 99):
+            self.assertLessEqual(p / 1000, h.percentile(p))
+            self.assertLess(h.percentile(p), p / 1000 * 1.2)
+        d = h.to_dict()
+        self.assertEqual(100, d['buckets'][-1][1])
+        self.assertEqual(0.1, d['max'])
+
+    def test_out_of_range(self):
+        h = Histogram()
+        h.add(0)
+        h.add(1000)
+        self.assertEqual(1, h.counts[0])
+        self.assertEqual(1, h.counts[-1])
+        self.assertEqual(1000, h.percentile(100))
+
+
+class TestSocketPipe(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.a, self.b = socket.socketpair()
+        self.pipe = SocketPipe(self.b)
+        self.pipe.recv_size = 7
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        super().tearDown()
+
+    def test_get(self):
+        messages = [{'id': i, 'result': 'x' * i} for i in range(20)]
+        lines = [(json.dumps(m) + '\n').encode('utf8') for m in messages]
+        self.a.sendall(lines[0] + lines[1][:5])
+        self.assertEqual(messages[0], self.pipe.get())
+        # invalid messages are skipped
+        self.a.sendall(lines[1][5:] + b'not json\n' + b''.join(lines[2:]))
+        for m in messages[1:]:
+            self.assertEqual(m, self.pipe.get())
+        self.a.close()
+        self.assertIsNone(self.pipe.get())
+
+    def test_get_all(self):
+        self.pipe.set_timeout(0.0)
+        self.a.sendall(b'{"id": 1}\n{"id": 2}\n{"id"')
+        self.assertEqual([{'id': 1}, {'id': 2}], self.pipe.get_all())
+        self.assertEqual([], self.pipe.get_all())
+        self.a.sendall(b': 3}\n')
+        self.a.close()
+        self.assertEqual([{'id': 3}, None], self.pipe.get_all())
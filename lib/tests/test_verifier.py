@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from lib.verifier import MerkleProofStore, SPV
+
+from . import SequentialTestCase
+
+
+# block 100000 (mainnet)
+MERKLE_ROOT = 'f3e94742aca4b5ef85488dc37c06c3282295ffec960994b2c0d5ac2a25a95766'
+TX_HASH = 'fff2525b8931402dd09222c50775608f75787bd2b87e56995a7bdd30f79702c4'
+POS = 1
+MERKLE = [
+    '8c14f0db3df150123e6f3dbbf30f8b955a8249b62ac1d1ff16284aefa3d06d87',
+    '8e30899078ca1813be036a073bbf80b86cdddde1c96e9e9c99e9e3782df4ae49',
+]
+
+
+class MockStorage(dict):
+
+    def put(self, key, value):
+        self[key] = value
+
+
+class TestMerkleProofStore(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'merkle_proofs')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        super().tearDown()
+
+    def test_hash_merkle_root(self):
+        self.assertEqual(MERKLE_ROOT, SPV.hash_merkle_root(MERKLE, TX_HASH, POS))
+
+    def test_put_get(self):
+        store = MerkleProofStore(self.path)
+        self.assertIsNone(store.get(TX_HASH))
+        store.put(TX_HASH, 100000, POS, MERKLE)
+        store.put('00' * 32, 1, 0, [])
+        self.assertEqual((100000, POS, MERKLE), store.get(TX_HASH))
+        store = MerkleProofStore(self.path)
+        self.assertEqual((100000, POS, MERKLE), store.get(TX_HASH))
+        self.assertEqual((1, 0, []), store.get('00' * 32))
+        # reorg
+        store.put(TX_HASH, 100001, 0, MERKLE[:1])
+        store = MerkleProofStore(self.path)
+        self.assertEqual((100001, 0, MERKLE[:1]), store.get(TX_HASH))
+
+    def test_truncated_record(self):
+        store = MerkleProofStore(self.path)
+        store.put(TX_HASH, 100000, POS, MERKLE)
+        store.put('00' * 32, 1, 0, MERKLE)
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(size - 10)
+        store = MerkleProofStore(self.path)
+        self.assertEqual((100000, POS, MERKLE), store.get(TX_HASH))
+        self.assertIsNone(store.get('00' * 32))
+        store.put('00' * 32, 1, 0, [])
+        store = MerkleProofStore(self.path)
+        self.assertEqual((1, 0, []), store.get('00' * 32))
+
+    def test_remove(self):
+        store = MerkleProofStore(self.path)
+        store.put(TX_HASH, 100000, POS, MERKLE)
+        store.put('00' * 32, 1, 0, [])
+        store.remove(TX_HASH)
+        store.remove('11' * 32)
+        self.assertIsNone(store.get(TX_HASH))
+        store = MerkleProofStore(self.path)
+        self.assertIsNone(store.get(TX_HASH))
+        self.assertEqual((1, 0, []), store.get('00' * 32))
+        store.put(TX_HASH, 100000, POS, MERKLE)
+        store = MerkleProofStore(self.path)
+        self.assertEqual((100000, POS, MERKLE), store.get(TX_HASH))
+
+    def test_compaction(self):
+        store = MerkleProofStore(self.path)
+        store.COMPACT_MIN_SIZE = 1000
+        for i in range(100):
+            store.put(TX_HASH, 100000 + i, POS, MERKLE)
+            store.remove(TX_HASH)
+        store.put('00' * 32, 1, 0, MERKLE)
+        self.assertLessEqual(os.path.getsize(self.path), 1000)
+        self.assertEqual(os.path.getsize(self.path), store.file_size)
+        store = MerkleProofStore(self.path)
+        self.assertIsNone(store.get(TX_HASH))
+        self.assertEqual((1, 0, MERKLE), store.get('00' * 32))
+
+    def test_for_wallet(self):
+        wallet = mock.Mock()
+        wallet.storage = MockStorage()
+        wallet.use_shared_caches.return_value = True
+        store = MerkleProofStore.for_wallet(self.tmp, wallet)
+        self.assertEqual(store.path, MerkleProofStore.for_wallet(self.tmp, wallet).path)
+        store.put(TX_HASH, 100000, POS, MERKLE)
+        self.assertTrue(os.path.exists(store.path))
+        other = mock.Mock(storage=MockStorage(), use_shared_caches=wallet.use_shared_caches)
+        self.assertIsNone(MerkleProofStore.for_wallet(self.tmp, other).get(TX_HASH))
+        # encrypted wallets have no store, and lose the one they had
+        wallet.use_shared_caches.return_value = False
+        self.assertIsNone(MerkleProofStore.for_wallet(self.tmp, wallet))
+        self.assertFalse(os.path.exists(store.path))
+        self.assertIsNone(wallet.storage.get('merkle_proofs_id'))
@@ -2,11 +2,12 @@ import shutil
 import tempfile
 import sys
 import unittest
+from unittest import mock
 import os
 import json
 
 from io import StringIO
-from lib.storage import WalletStorage, FINAL_SEED_VERSION
+from lib.storage import WalletStorage, FINAL_SEED_VERSION, STO_EV_USER_PW
 
 from . import SequentialTestCase
 
@@ -69,3 +70,100 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+    def test_journal_replayed_on_load(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.put("c", "d")
+        storage.set_journal_enabled(True)
+        storage.put("a", "x")
+        storage.put("c", None)
+        storage.write()
+        self.assertTrue(storage.journal.exists())
+        # the wallet file itself is untouched
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual("b", json.loads(f.read())["a"])
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual("x", storage.get("a"))
+        self.assertEqual(None, storage.get("c"))
+
+    def test_journal_truncated_entry_is_ignored(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.put("a", "b")
+        storage.write()
+        storage.put("a", "c")
+        storage.write()
+        with open(storage.journal.path, "rb+") as f:
+            f.truncate(os.path.getsize(storage.journal.path) - 5)
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual("b", storage.get("a"))
+        storage.put("a", "d")
+        storage.write()
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual("d", storage.get("a"))
+
+    def test_journal_compact(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.put("a", "b")
+        storage.write()
+        storage.compact()
+        self.assertFalse(storage.journal.exists())
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual("b", json.loads(f.read())["a"])
+
+    def test_journal_stale_after_crash_during_compact(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.put("a", "x")
+        storage.write()
+        self.assertTrue(storage.journal.exists())
+        storage.put("a", "y")
+        # crash after the wallet file was replaced, before the journal is removed
+        with mock.patch.object(storage.journal, 'clear'):
+            storage.compact()
+        self.assertTrue(storage.journal.exists())
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual("y", storage.get("a"))
+        # the stale journal is discarded by the next append
+        storage.put("b", "z")
+        storage.write()
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual("y", storage.get("a"))
+        self.assertEqual("z", storage.get("b"))
+
+    def test_journal_encrypted(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_password("secret", enc_version=STO_EV_USER_PW)
+        storage.set_journal_enabled(True)
+        storage.put("a", "b")
+        storage.write()
+        with open(storage.journal.path, "rb") as f:
+            self.assertNotIn(b'"a"', f.read())
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(storage.is_encrypted())
+        storage.decrypt("secret")
+        self.assertEqual("b", storage.get("a"))
+
+    def test_put_item_journaled(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.put("d", {"x": [1], "y": [2]})
+        storage.write()
+        view = storage.get_view("d")
+        storage.put_item("d", "x", [3])
+        storage.put_item("d", "y", None)
+        storage.write()
+        # views are not affected by later changes
+        self.assertEqual([1], list(view["x"]))
+        self.assertIn("y", view)
+        with self.assertRaises(TypeError):
+            view["x"] = 4
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"x": [3]}, storage.get("d"))
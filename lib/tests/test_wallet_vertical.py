@@ -8,8 +8,9 @@ import lib
 from lib import storage, bitcoin, keystore, constants
 from lib.transaction import Transaction
 from lib.simple_config import SimpleConfig
+from lib.synchronizer import history_status
 from lib.wallet import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT, sweep
-from lib.util import bfh, bh2u
+from lib.util import bfh, bh2u, InvalidPassword
 
 from plugins.trustedcoin import trustedcoin
 
@@ -1439,3 +1440,168 @@ class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
                                    {})
         w.synchronize()
         self.assertEqual(9999788, sum(w.get_balance()))
+
+        addr = 'tb1qr0qjp99ygawul0eylxfqmt7alygye22mj33vej'
+        self.assertEqual(history_status(w.history[addr]), w.get_address_status(addr))
+        self.assertIsNone(w.get_address_status(w.get_receiving_addresses()[0]))
+        w.save_transactions()
+        self.assertEqual(w.get_address_status(addr), w.storage.get('addr_status')[addr])
+
+
+class TestWalletCaches(TestCaseForTestnet):
+    # funding tx, a payment spending it, and the same payment with a bumped fee
+    funding_tx = '010000000001011f4db0ecd81f4388db316bc16efb4e9daf874cf4950d54ecb4c0fb372433d68500000000171600143d57fd9e88ef0e70cddb0d8b75ef86698cab0d44fdffffff0280969800000000001976a91472e34cebab371967b038ce41d0e8fa1fb983795e88ac86a0ae020000000017a9149188bc82bdcae077060ebb4f02201b73c806edc887024830450221008e0725d531bd7dee4d8d38a0f921d7b1213e5b16c05312a80464ecc2b649598d0220596d309cf66d5f47cb3df558dbb43c5023a7796a80f5a88b023287e45a4db6b9012102c34d61ceafa8c216f01e05707672354f8119334610f7933a3f80dd7fb6290296bd391400'
+    payment_tx = '01000000016207d958dc46508d706e4cd7d3bc46c5c2b02160e2578e5fad2efafc39270503000000006b483045022100df74e6a88085be1ff3a3fd96cf2ef03b5e33fa06788f56aa71649f0177d1bfc402206e36a7e6124863ac746d5288d6d47c1d1eac5d4ac3818e561a7a0f2c0a269429012102a807c07bd7975211078e916bdda061d97e98d59a3631a804aada2f9a3f5b587afdffffff02a02526000000000017a9145a71fc1a7a98ddd67be935ade1600981c0d066f987585d7200000000001976a914aab9af3fbee0ab4e5c00d53e92f66d4bcb44f1bd88acbd391400'
+    bumped_tx = '01000000016207d958dc46508d706e4cd7d3bc46c5c2b02160e2578e5fad2efafc39270503000000006a473044022055b7e6b7e89a55740f7aa2ad1ffcd4b5c913f0de63cf512438921534bc9c3a8d022043b3b27bdc2da4cc6265e4cc9673a3780ccd5cd6f0ee2eaedb51720c15b7a00a012102a807c07bd7975211078e916bdda061d97e98d59a3631a804aada2f9a3f5b587afdffffff02a02526000000000017a9145a71fc1a7a98ddd67be935ade1600981c0d066f987d0497200000000001976a914aab9af3fbee0ab4e5c00d53e92f66d4bcb44f1bd88acbd391400'
+
+    def create_wallet(self):
+        ks = keystore.from_seed('fold object utility erase deputy output stadium feed stereo usage modify bean', '', False)
+        wallet = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2)
+        # add_verified_tx notifies the network
+        wallet.network = mock.Mock()
+        wallet.network.get_local_height.return_value = 1325600
+        return wallet
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_utxo_and_balance_caches(self, mock_write):
+        wallet = self.create_wallet()
+        funding_tx = Transaction(self.funding_tx)
+        payment_tx = Transaction(self.payment_tx)
+        funding_addr = wallet.get_txout_address(funding_tx.outputs()[0])
+        change_addr = wallet.get_txout_address(payment_tx.outputs()[1])
+
+        def check(balance, utxos):
+            for i in range(2):  # computed, then cached
+                self.assertEqual(balance, wallet.get_balance())
+                self.assertEqual(utxos, sorted(x['prevout_hash'] for x in wallet.get_utxos()))
+            self.assertIn(funding_addr, wallet._addr_balance_cache)
+            self.assertIn(funding_addr, wallet._addr_utxo_cache)
+
+        # add
+        wallet.receive_tx_callback(funding_tx.txid(), funding_tx, TX_HEIGHT_UNCONFIRMED)
+        check((0, 10000000, 0), [funding_tx.txid()])
+        wallet.receive_tx_callback(payment_tx.txid(), payment_tx, TX_HEIGHT_UNCONFIRMED)
+        self.assertNotIn(funding_addr, wallet._addr_balance_cache)
+        self.assertNotIn(funding_addr, wallet._addr_utxo_cache)
+        check((0, 10000000 - 2505000, 0), [payment_tx.txid()])
+        self.assertIn(change_addr, wallet._addr_balance_cache)
+
+        # height change
+        wallet.add_verified_tx(funding_tx.txid(), (1325500, 0, 0))
+        self.assertNotIn(funding_addr, wallet._addr_balance_cache)
+        check((10000000, -2505000, 0), [payment_tx.txid()])
+        wallet.add_unverified_tx(payment_tx.txid(), 1325502)
+        check((10000000 - 2505000, 0, 0), [payment_tx.txid()])
+        wallet.add_unverified_tx(payment_tx.txid(), TX_HEIGHT_UNCONFIRMED)
+        check((10000000, -2505000, 0), [payment_tx.txid()])
+        wallet.add_verified_tx(payment_tx.txid(), (1325502, 0, 0))
+        check((10000000 - 2505000, 0, 0), [payment_tx.txid()])
+
+        # remove
+        wallet.remove_transaction(payment_tx.txid())
+        self.assertNotIn(change_addr, wallet._addr_balance_cache)
+        check((10000000, 0, 0), [funding_tx.txid()])
+        self.assertEqual((0, 0, 0), wallet.get_addr_balance(change_addr))
+
+    def check_history(self, wallet, txids):
+        history = wallet.get_history()
+        self.assertEqual(txids, [item[0] for item in history])
+        self.assertEqual(sum(wallet.get_balance()), history[-1][5])
+        # same as the history computed from the addresses
+        self.assertEqual(history, wallet.get_history(domain=wallet.get_addresses()))
+        return history
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_paging(self, mock_write):
+        wallet = self.create_wallet()
+        funding_tx = Transaction(self.funding_tx)
+        payment_tx = Transaction(self.payment_tx)
+        wallet.receive_tx_callback(funding_tx.txid(), funding_tx, 1325500)
+        wallet.receive_tx_callback(payment_tx.txid(), payment_tx, TX_HEIGHT_UNCONFIRMED)
+        history = self.check_history(wallet, [funding_tx.txid(), payment_tx.txid()])
+        self.assertEqual([10000000, 10000000 - 2505000], [item[5] for item in history])
+        self.assertEqual(history[:1], wallet.get_history(limit=1))
+        self.assertEqual(history[1:], wallet.get_history(offset=1, limit=5))
+        self.assertEqual(history[1:], wallet.get_history(offset=1))
+        self.assertEqual([], wallet.get_history(offset=2, limit=1))
+        domain = wallet.get_addresses()
+        self.assertEqual(history[1:], wallet.get_history(domain=domain, offset=1, limit=1))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_incremental_updates(self, mock_write):
+        wallet = self.create_wallet()
+        funding_tx = Transaction(self.funding_tx)
+        payment_tx = Transaction(self.payment_tx)
+        bumped_tx = Transaction(self.bumped_tx)
+        wallet.receive_tx_callback(payment_tx.txid(), payment_tx, TX_HEIGHT_UNCONF_PARENT)
+        wallet.receive_tx_callback(funding_tx.txid(), funding_tx, TX_HEIGHT_UNCONFIRMED)
+        self.check_history(wallet, [funding_tx.txid(), payment_tx.txid()])
+
+        def deltas_computed(f):
+            # txids whose delta is computed when the history is updated;
+            # the history is not rebuilt
+            f()
+            with mock.patch.object(wallet, 'get_tx_delta', wraps=wallet.get_tx_delta) as get_tx_delta, \
+                    mock.patch.object(wallet, '_build_wallet_history') as build:
+                wallet.get_history()
+            self.assertFalse(build.called)
+            return set(args[0] for args, kwargs in get_tx_delta.call_args_list)
+
+        # height changes move the entries, deltas are not recomputed
+        self.assertEqual(set(), deltas_computed(
+            lambda: wallet.add_unverified_tx(payment_tx.txid(), 1325499)))
+        self.check_history(wallet, [payment_tx.txid(), funding_tx.txid()])
+        self.assertEqual(set(), deltas_computed(
+            lambda: wallet.add_verified_tx(funding_tx.txid(), (1325400, 0, 0))))
+        self.check_history(wallet, [funding_tx.txid(), payment_tx.txid()])
+        self.assertEqual(set(), deltas_computed(
+            lambda: wallet.add_unverified_tx(payment_tx.txid(), TX_HEIGHT_UNCONF_PARENT)))
+        self.check_history(wallet, [funding_tx.txid(), payment_tx.txid()])
+
+        # the bumped tx replaces the payment: one entry removed, one added
+        self.assertEqual({bumped_tx.txid()}, deltas_computed(
+            lambda: wallet.receive_tx_callback(bumped_tx.txid(), bumped_tx, TX_HEIGHT_UNCONFIRMED)))
+        history = self.check_history(wallet, [funding_tx.txid(), bumped_tx.txid()])
+        self.assertEqual(10000000 - 2510000, history[-1][5])
+        self.assertEqual(set(), deltas_computed(
+            lambda: wallet.add_verified_tx(bumped_tx.txid(), (1325402, 0, 0))))
+        self.check_history(wallet, [funding_tx.txid(), bumped_tx.txid()])
+
+        deltas_computed(lambda: wallet.remove_transaction(bumped_tx.txid()))
+        history = self.check_history(wallet, [funding_tx.txid()])
+        self.assertEqual(10000000, history[-1][5])
+
+
+class TestBIP32SigningSession(SequentialTestCase):
+
+    def test_signing_session(self):
+        ks = keystore.from_seed('cycle rocket west magnet parrot shuffle foot correct salt library feed song', '', False)
+        ks.update_password(None, 'secret')
+        sequences = [(c, n) for c in (0, 1) for n in range(3)]
+        expected = [ks.get_private_key(s, 'secret') for s in sequences]
+        with mock.patch.object(keystore, 'pw_decode', wraps=keystore.pw_decode) as pw_decode, \
+                mock.patch.object(keystore, 'CKD_priv', wraps=keystore.CKD_priv) as ckd_priv:
+            with ks.signing_session('secret') as session:
+                keys = [ks.get_session_private_key(session, s, 'secret') for s in sequences]
+        self.assertEqual(expected, keys)
+        # one decryption, and one derivation per branch
+        self.assertEqual(1, pw_decode.call_count)
+        self.assertEqual(2, ckd_priv.call_count)
+        # cached keys are wiped at the end of the session
+        self.assertEqual(bytes(32), bytes(session[()][0]))
+        self.assertEqual(bytes(32), bytes(session[(1,)][0]))
+        with self.assertRaises(InvalidPassword):
+            with ks.signing_session('wrong'):
+                pass
+
+    def test_wrong_password_in_open_session(self):
+        ks = keystore.from_seed('cycle rocket west magnet parrot shuffle foot correct salt library feed song', '', False)
+        ks.update_password(None, 'secret')
+        with ks.signing_session('secret'):
+            with self.assertRaises(InvalidPassword):
+                with ks.signing_session('wrong'):
+                    pass
+            with self.assertRaises(InvalidPassword):
+                ks.get_private_key((0, 0), 'wrong')
+            with self.assertRaises(InvalidPassword):
+                ks.sign_transaction(mock.Mock(), 'wrong')
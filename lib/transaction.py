@@ -28,6 +28,9 @@
 # Note: The deserialization code originally comes from ABE.
 
 from typing import Sequence, Union
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import threading
 
 from .util import print_error, profiler
 
@@ -72,7 +75,7 @@ class BCDataStream(object):
         if self.input is None:
             self.input = bytearray(_bytes)
         else:
-            self.input += bytearray(_bytes)
+            self.input += _bytes
 
     def read_string(self, encoding='ascii'):
         # Strings are encoded depending on length:
@@ -411,6 +414,15 @@ def parse_redeemScript_multisig(redeem_script: bytes):
 
 
 def get_address_from_output_script(_bytes, *, net=None):
+    # standard templates, matched without decoding the script
+    n = len(_bytes)
+    if n == 25 and _bytes[:3] == b'\x76\xa9\x14' and _bytes[23:] == b'\x88\xac':
+        return TYPE_ADDRESS, hash160_to_p2pkh(_bytes[3:23], net=net)
+    if n == 23 and _bytes[:2] == b'\xa9\x14' and _bytes[22] == opcodes.OP_EQUAL:
+        return TYPE_ADDRESS, hash160_to_p2sh(_bytes[2:22], net=net)
+    if (n == 22 or n == 34) and _bytes[0] == opcodes.OP_0 and _bytes[1] == n - 2:
+        return TYPE_ADDRESS, hash_to_segwit_addr(_bytes[2:], witver=0, net=net)
+
     decoded = [x for x in script_GetOp(_bytes)]
 
     # The Genesis Block, self-payments, and pay-by-IP-address payments look like:
@@ -440,12 +452,100 @@ def get_address_from_output_script(_bytes, *, net=None):
     return TYPE_SCRIPT, bh2u(_bytes)
 
 
-def parse_input(vds, full_parse: bool):
+def read_compact_size(buf, pos):
+    """Read a compact size from buf at pos. Return it together with the
+    position of the next field."""
+    size = buf[pos]
+    if size < 253:
+        return size, pos + 1
+    elif size == 253:
+        return struct.unpack_from('<H', buf, pos + 1)[0], pos + 3
+    elif size == 254:
+        return struct.unpack_from('<I', buf, pos + 1)[0], pos + 5
+    else:
+        return struct.unpack_from('<Q', buf, pos + 1)[0], pos + 9
+
+
+def scan_transaction(buf) -> dict:
+    """Find the fields of a serialized transaction without decoding them.
+
+    'inputs' holds (start, script_start, script_end) for each input,
+    'outputs' holds (start, script_start, script_end) for each output and
+    'witnesses' holds (start, end) for each input of a segwit
+    transaction. The txid commits to buf[:4], buf[body_start:body_end]
+    and buf[-4:].
+    """
+    try:
+        version, = struct.unpack_from('<i', buf, 0)
+        pos = body_start = 4
+        n_vin, pos = read_compact_size(buf, pos)
+        is_segwit = (n_vin == 0)
+        if is_segwit:
+            marker = bytes(buf[pos:pos + 1])
+            if marker != b'\x01':
+                raise ValueError('invalid txn marker byte: {}'.format(marker))
+            pos = body_start = pos + 1
+            n_vin, pos = read_compact_size(buf, pos)
+        inputs = []
+        for i in range(n_vin):
+            # outpoint, script, sequence
+            script_len, script_start = read_compact_size(buf, pos + 36)
+            inputs.append((pos, script_start, script_start + script_len))
+            pos = script_start + script_len + 4
+        n_vout, pos = read_compact_size(buf, pos)
+        outputs = []
+        for i in range(n_vout):
+            # value, script
+            script_len, script_start = read_compact_size(buf, pos + 8)
+            outputs.append((pos, script_start, script_start + script_len))
+            pos = script_start + script_len
+        body_end = pos
+        witnesses = []
+        if is_segwit:
+            for i in range(n_vin):
+                start = pos
+                n, pos = read_compact_size(buf, pos)
+                if n == 0xffffffff:
+                    # partial format: value and witness version
+                    n, pos = read_compact_size(buf, pos + 10)
+                for j in range(n):
+                    item_len, pos = read_compact_size(buf, pos)
+                    pos += item_len
+                witnesses.append((start, pos))
+        lock_time, = struct.unpack_from('<I', buf, pos)
+    except (IndexError, struct.error):
+        raise SerializationError("attempt to read past end of buffer")
+    if pos + 4 != len(buf):
+        raise SerializationError('extra junk at the end')
+    return {
+        'version': version,
+        'segwit_ser': is_segwit,
+        'inputs': inputs,
+        'outputs': outputs,
+        'witnesses': witnesses,
+        'body_start': body_start,
+        'body_end': body_end,
+        'lockTime': lock_time,
+    }
+
+
+def txid_from_raw(raw_bytes: bytes) -> str:
+    """The txid of a transaction in network serialization, computed
+    without parsing its inputs and outputs."""
+    if raw_bytes[4:6] == b'\x00\x01':
+        # segwit: the txid does not commit to the witness
+        d = scan_transaction(memoryview(raw_bytes))
+        raw_bytes = raw_bytes[:4] + raw_bytes[d['body_start']:d['body_end']] + raw_bytes[-4:]
+    return hash_encode(Hash(raw_bytes))
+
+
+def parse_input(buf, offsets, full_parse: bool):
+    start, script_start, script_end = offsets
     d = {}
-    prevout_hash = hash_encode(vds.read_bytes(32))
-    prevout_n = vds.read_uint32()
-    scriptSig = vds.read_bytes(vds.read_compact_size())
-    sequence = vds.read_uint32()
+    prevout_hash = hash_encode(bytes(buf[start:start + 32]))
+    prevout_n, = struct.unpack_from('<I', buf, start + 32)
+    scriptSig = bytes(buf[script_start:script_end])
+    sequence, = struct.unpack_from('<I', buf, script_end)
     d['prevout_hash'] = prevout_hash
     d['prevout_n'] = prevout_n
     d['scriptSig'] = bh2u(scriptSig)
@@ -479,20 +579,27 @@ def construct_witness(items: Sequence[Union[str, int, bytes]]) -> str:
     return witness
 
 
-def parse_witness(vds, txin, full_parse: bool):
-    n = vds.read_compact_size()
+def parse_witness(buf, offsets, txin, full_parse: bool):
+    start, end = offsets
+    n, pos = read_compact_size(buf, start)
     if n == 0:
         txin['witness'] = '00'
         return
     if n == 0xffffffff:
-        txin['value'] = vds.read_uint64()
-        txin['witness_version'] = vds.read_uint16()
-        n = vds.read_compact_size()
-    # now 'n' is the number of items in the witness
-    w = list(bh2u(vds.read_bytes(vds.read_compact_size())) for i in range(n))
-    txin['witness'] = construct_witness(w)
+        txin['value'], = struct.unpack_from('<Q', buf, pos)
+        txin['witness_version'], = struct.unpack_from('<H', buf, pos + 8)
+        start = pos + 10
+        n, pos = read_compact_size(buf, start)
+    # the witness is kept as serialized: item count and pushes
+    txin['witness'] = bh2u(buf[start:end])
     if not full_parse:
         return
+    # now 'n' is the number of items in the witness
+    w = []
+    for i in range(n):
+        item_len, pos = read_compact_size(buf, pos)
+        w.append(bh2u(buf[pos:pos + item_len]))
+        pos += item_len
 
     try:
         if txin.get('witness_version', 0) != 0:
@@ -531,14 +638,15 @@ def parse_witness(vds, txin, full_parse: bool):
         print_error('failed to parse witness', txin.get('witness'))
 
 
-def parse_output(vds, i):
+def parse_output(buf, offsets, i):
+    start, script_start, script_end = offsets
     d = {}
-    d['value'] = vds.read_int64()
+    d['value'], = struct.unpack_from('<q', buf, start)
     if d['value'] > TOTAL_COIN_SUPPLY_LIMIT_IN_BTC * COIN:
         raise SerializationError('invalid output amount (too large)')
     if d['value'] < 0:
         raise SerializationError('invalid output amount (negative)')
-    scriptPubKey = vds.read_bytes(vds.read_compact_size())
+    scriptPubKey = bytes(buf[script_start:script_end])
     d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
     d['scriptPubKey'] = bh2u(scriptPubKey)
     d['prevout_n'] = i
@@ -554,31 +662,19 @@ def deserialize(raw: str, force_full_parse=False) -> dict:
         if partial_format_version != 0:
             raise SerializationError('unknown tx partial serialization format version: {}'
                                      .format(partial_format_version))
-        raw_bytes = raw_bytes[6:]
+        buf = memoryview(raw_bytes)[6:]
     else:
         d['partial'] = is_partial = False
+        buf = memoryview(raw_bytes)
     full_parse = force_full_parse or is_partial
-    vds = BCDataStream()
-    vds.write(raw_bytes)
-    d['version'] = vds.read_int32()
-    n_vin = vds.read_compact_size()
-    is_segwit = (n_vin == 0)
-    if is_segwit:
-        marker = vds.read_bytes(1)
-        if marker != b'\x01':
-            raise ValueError('invalid txn marker byte: {}'.format(marker))
-        n_vin = vds.read_compact_size()
-    d['segwit_ser'] = is_segwit
-    d['inputs'] = [parse_input(vds, full_parse=full_parse) for i in range(n_vin)]
-    n_vout = vds.read_compact_size()
-    d['outputs'] = [parse_output(vds, i) for i in range(n_vout)]
-    if is_segwit:
-        for i in range(n_vin):
-            txin = d['inputs'][i]
-            parse_witness(vds, txin, full_parse=full_parse)
-    d['lockTime'] = vds.read_uint32()
-    if vds.can_read_more():
-        raise SerializationError('extra junk at the end')
+    layout = scan_transaction(buf)
+    d['version'] = layout['version']
+    d['segwit_ser'] = layout['segwit_ser']
+    d['inputs'] = [parse_input(buf, x, full_parse=full_parse) for x in layout['inputs']]
+    d['outputs'] = [parse_output(buf, x, i) for i, x in enumerate(layout['outputs'])]
+    for txin, offsets in zip(d['inputs'], layout['witnesses']):
+        parse_witness(buf, offsets, txin, full_parse=full_parse)
+    d['lockTime'] = layout['lockTime']
     return d
 
 
@@ -598,6 +694,16 @@ def multisig_script(public_keys: Sequence[str], m: int) -> str:
 
 
 
+def sign_pre_hash(sec: bytes, compressed: bool, pre_hash: bytes):
+    """Sign a signature hash. Return the public key and the signature
+    followed by SIGHASH_ALL, both in hex. This is the work done per
+    input by Transaction.sign, possibly in another process."""
+    privkey = ecc.ECPrivkey(sec)
+    pubkey = privkey.get_public_key_hex(compressed=compressed)
+    sig = bh2u(privkey.sign_transaction(pre_hash)) + '01'
+    return pubkey, sig
+
+
 class Transaction:
 
     def __str__(self):
@@ -622,12 +728,39 @@ class Transaction:
         # this value will get properly set when deserializing
         self.is_partial_originally = True
         self._segwit_ser = None  # None means "don't know"
+        self._sighash_cache = None
+        self._memo = {}
+        self._memo_state = None
 
     def update(self, raw):
         self.raw = raw
         self._inputs = None
+        self._invalidate_caches()
         self.deserialize()
 
+    def _invalidate_caches(self):
+        # must be called whenever inputs, outputs or their order change
+        self._sighash_cache = None
+        self._memo = {}
+
+    def _memoize(self, key, func):
+        # Values derived from the serialization are kept until the
+        # transaction is mutated. Signing always ends by updating raw,
+        # and version and locktime are plain attributes, so they are
+        # part of the state checked here. The inputs and outputs of
+        # partial transactions are also completed in place, e.g. by
+        # add_input_info, so their contents are part of it too.
+        self.deserialize()
+        state = (self.raw, self.version, self.locktime)
+        if self.is_partial_originally:
+            state += (repr(self._inputs), repr(self._outputs))
+        if state != self._memo_state:
+            self._memo = {}
+            self._memo_state = state
+        if key not in self._memo:
+            self._memo[key] = func()
+        return self._memo[key]
+
     def inputs(self):
         if self._inputs is None:
             self.deserialize()
@@ -668,7 +801,7 @@ class Transaction:
             sig = signatures[i]
             if sig in txin.get('signatures'):
                 continue
-            pre_hash = Hash(bfh(self.serialize_preimage(i)))
+            pre_hash = Hash(self.serialize_preimage_bytes(i))
             sig_string = ecc.sig_string_from_der_sig(bfh(sig[:-2]))
             for recid in range(4):
                 try:
@@ -704,6 +837,7 @@ class Transaction:
         if self._inputs is not None:
             return
         d = deserialize(self.raw, force_full_parse)
+        self._invalidate_caches()
         self._inputs = d['inputs']
         self._outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
         self.locktime = d['lockTime']
@@ -905,57 +1039,103 @@ class Transaction:
         return prevout_hash + ':%d' % prevout_n
 
     @classmethod
-    def serialize_input(self, txin, script):
+    def write_input(self, vds, txin, script: bytes):
         # Prev hash and index
-        s = self.serialize_outpoint(txin)
+        vds.write(bfh(txin['prevout_hash'])[::-1])
+        vds.write_uint32(txin['prevout_n'])
         # Script length, script, sequence
-        s += var_int(len(script)//2)
-        s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-        return s
+        vds.write_compact_size(len(script))
+        vds.write(script)
+        vds.write_uint32(txin.get('sequence', 0xffffffff - 1))
+
+    @classmethod
+    def serialize_input(self, txin, script):
+        vds = BCDataStream()
+        self.write_input(vds, txin, bfh(script))
+        return bh2u(vds.input)
 
     def set_rbf(self, rbf):
         nSequence = 0xffffffff - (2 if rbf else 1)
         for txin in self.inputs():
             txin['sequence'] = nSequence
+        self._invalidate_caches()
 
     def BIP_LI01_sort(self):
         # See https://github.com/kristovatlas/rfc/blob/master/bips/bip-li01.mediawiki
         self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
         self._outputs.sort(key = lambda o: (o[2], self.pay_script(o[0], o[1])))
+        self._invalidate_caches()
 
-    def serialize_output(self, output):
+    def write_output(self, vds, output):
         output_type, addr, amount = output
-        s = int_to_hex(amount, 8)
-        script = self.pay_script(output_type, addr)
-        s += var_int(len(script)//2)
-        s += script
-        return s
+        script = bfh(self.pay_script(output_type, addr))
+        vds.write_int64(amount)
+        vds.write_compact_size(len(script))
+        vds.write(script)
 
-    def serialize_preimage(self, i):
-        nVersion = int_to_hex(self.version, 4)
-        nHashType = int_to_hex(1, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+    def serialize_output(self, output):
+        vds = BCDataStream()
+        self.write_output(vds, output)
+        return bh2u(vds.input)
+
+    def _get_sighash_cache(self):
+        """Return the serialized outpoints, sequences and outputs, and the
+        BIP143 hashes over them. These are shared by the signature hashes
+        of all inputs, so they are computed once per transaction.
+        """
+        if self._sighash_cache is None:
+            inputs = self.inputs()
+            outpoints = [bfh(txin['prevout_hash'])[::-1] + struct.pack('<I', txin['prevout_n'])
+                         for txin in inputs]
+            sequences = [struct.pack('<I', txin.get('sequence', 0xffffffff - 1))
+                         for txin in inputs]
+            vds = BCDataStream()
+            for o in self.outputs():
+                self.write_output(vds, o)
+            outputs = bytes(vds.input or b'')
+            self._sighash_cache = {
+                'outpoints': outpoints,
+                'sequences': sequences,
+                'outputs': outputs,
+                'hashPrevouts': Hash(b''.join(outpoints)),
+                'hashSequence': Hash(b''.join(sequences)),
+                'hashOutputs': Hash(outputs),
+            }
+        return self._sighash_cache
+
+    def serialize_preimage_bytes(self, i) -> bytes:
+        nVersion = bfh(int_to_hex(self.version, 4))
+        nHashType = struct.pack('<I', 1)
+        nLocktime = struct.pack('<I', self.locktime)
         inputs = self.inputs()
         outputs = self.outputs()
         txin = inputs[i]
-        # TODO: py3 hex
+        cache = self._get_sighash_cache()
         if self.is_segwit_input(txin):
-            hashPrevouts = bh2u(Hash(bfh(''.join(self.serialize_outpoint(txin) for txin in inputs))))
-            hashSequence = bh2u(Hash(bfh(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs))))
-            hashOutputs = bh2u(Hash(bfh(''.join(self.serialize_output(o) for o in outputs))))
-            outpoint = self.serialize_outpoint(txin)
             preimage_script = self.get_preimage_script(txin)
-            scriptCode = var_int(len(preimage_script) // 2) + preimage_script
-            amount = int_to_hex(txin['value'], 8)
-            nSequence = int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-            preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
+            scriptCode = bfh(var_int(len(preimage_script) // 2) + preimage_script)
+            amount = struct.pack('<q', txin['value'])
+            preimage = b''.join((
+                nVersion, cache['hashPrevouts'], cache['hashSequence'],
+                cache['outpoints'][i], scriptCode, amount, cache['sequences'][i],
+                cache['hashOutputs'], nLocktime, nHashType))
         else:
-            txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.get_preimage_script(txin) if i==k else '') for k, txin in enumerate(inputs))
-            txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
+            preimage_script = self.get_preimage_script(txin)
+            parts = [nVersion, bfh(var_int(len(inputs)))]
+            for k, (outpoint, sequence) in enumerate(zip(cache['outpoints'], cache['sequences'])):
+                parts.append(outpoint)
+                if k == i:
+                    parts.append(bfh(var_int(len(preimage_script) // 2) + preimage_script))
+                else:
+                    parts.append(b'\x00')
+                parts.append(sequence)
+            parts += [bfh(var_int(len(outputs))), cache['outputs'], nLocktime, nHashType]
+            preimage = b''.join(parts)
         return preimage
 
+    def serialize_preimage(self, i):
+        return bh2u(self.serialize_preimage_bytes(i))
+
     def is_segwit(self):
         if not self.is_partial_originally:
             return self._segwit_ser
@@ -971,43 +1151,63 @@ class Transaction:
         else:
             return network_ser
 
-    def serialize_to_network(self, estimate_size=False, witness=True):
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+    def serialize_to_network_bytes(self, estimate_size=False, witness=True) -> bytes:
         inputs = self.inputs()
         outputs = self.outputs()
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.input_script(txin, estimate_size)) for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-        if witness and self.is_segwit():
-            marker = '00'
-            flag = '01'
-            witness = ''.join(self.serialize_witness(x, estimate_size) for x in inputs)
-            return nVersion + marker + flag + txins + txouts + witness + nLocktime
-        else:
-            return nVersion + txins + txouts + nLocktime
+        vds = BCDataStream()
+        vds.write_int32(self.version)
+        witness = witness and self.is_segwit()
+        if witness:
+            # marker and flag
+            vds.write(b'\x00\x01')
+        vds.write_compact_size(len(inputs))
+        for txin in inputs:
+            self.write_input(vds, txin, bfh(self.input_script(txin, estimate_size)))
+        vds.write_compact_size(len(outputs))
+        for o in outputs:
+            self.write_output(vds, o)
+        if witness:
+            for txin in inputs:
+                vds.write(bfh(self.serialize_witness(txin, estimate_size)))
+        vds.write_uint32(self.locktime)
+        return bytes(vds.input)
+
+    def serialize_to_network(self, estimate_size=False, witness=True):
+        return bh2u(self.serialize_to_network_bytes(estimate_size, witness))
 
     def txid(self):
-        self.deserialize()
+        if self._inputs is None and self.raw is not None:
+            raw_bytes = bfh(self.raw)
+            if raw_bytes[:5] != PARTIAL_TXN_HEADER_MAGIC:
+                # complete and not parsed yet: hash the raw bytes
+                return txid_from_raw(raw_bytes)
+        return self._memoize('txid', self._compute_txid)
+
+    def _compute_txid(self):
         all_segwit = all(self.is_segwit_input(x) for x in self.inputs())
         if not all_segwit and not self.is_complete():
             return None
-        ser = self.serialize_to_network(witness=False)
-        return bh2u(Hash(bfh(ser))[::-1])
+        ser = self.serialize_to_network_bytes(witness=False)
+        return bh2u(Hash(ser)[::-1])
 
     def wtxid(self):
-        self.deserialize()
+        return self._memoize('wtxid', self._compute_wtxid)
+
+    def _compute_wtxid(self):
         if not self.is_complete():
             return None
-        ser = self.serialize_to_network(witness=True)
-        return bh2u(Hash(bfh(ser))[::-1])
+        ser = self.serialize_to_network_bytes(witness=True)
+        return bh2u(Hash(ser)[::-1])
 
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
         self.raw = None
+        self._invalidate_caches()
 
     def add_outputs(self, outputs):
         self._outputs.extend(outputs)
         self.raw = None
+        self._invalidate_caches()
 
     def input_value(self):
         return sum(x['value'] for x in self.inputs())
@@ -1035,8 +1235,9 @@ class Transaction:
     @classmethod
     def estimated_input_weight(cls, txin, is_segwit_tx):
         '''Return an estimate of serialized input weight in weight units.'''
-        script = cls.input_script(txin, True)
-        input_size = len(cls.serialize_input(txin, script)) // 2
+        script_size = len(cls.input_script(txin, True)) // 2
+        # outpoint, script length, script, sequence
+        input_size = 36 + len(var_int(script_size)) // 2 + script_size + 4
 
         if cls.is_segwit_input(txin):
             assert is_segwit_tx
@@ -1059,7 +1260,9 @@ class Transaction:
 
     def estimated_total_size(self):
         """Return an estimated total transaction size in bytes."""
-        return len(self.serialize(True)) // 2 if not self.is_complete() or self.raw is None else len(self.raw) // 2  # ASCII hex string
+        if not self.is_complete() or self.raw is None:
+            return len(self.serialize_to_network_bytes(True))
+        return len(self.raw) // 2  # ASCII hex string
 
     def estimated_witness_size(self):
         """Return an estimate of witness size in bytes."""
@@ -1077,6 +1280,9 @@ class Transaction:
 
     def estimated_weight(self):
         """Return an estimate of transaction weight."""
+        return self._memoize('estimated_weight', self._compute_estimated_weight)
+
+    def _compute_estimated_weight(self):
         total_tx_size = self.estimated_total_size()
         base_tx_size = self.estimated_base_size()
         return 3 * base_tx_size + total_tx_size
@@ -1098,12 +1304,19 @@ class Transaction:
         s, r = self.signature_count()
         return r == s
 
-    def sign(self, keypairs) -> None:
+    def sign(self, keypairs, executor=None) -> None:
         # keypairs:  (x_)pubkey -> secret_bytes
+        # If an executor is given, e.g. a ProcessPoolExecutor, signatures
+        # are computed with executor.map. The signature hashes are
+        # computed here, so workers only get keys and hashes.
+        jobs = []
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
+            num_sig = txin.get('num_sig', 1)
+            signed = set(j for j, sig in enumerate(txin.get('signatures', [])) if sig)
+            pre_hash = None
             for j, (pubkey, x_pubkey) in enumerate(zip(pubkeys, x_pubkeys)):
-                if self.is_txin_complete(txin):
+                if num_sig == 0 or len(signed) == num_sig:
                     break
                 if pubkey in keypairs:
                     _pubkey = pubkey
@@ -1113,18 +1326,25 @@ class Transaction:
                     continue
                 print_error("adding signature for", _pubkey)
                 sec, compressed = keypairs.get(_pubkey)
-                # pubkey might not actually be a 02-04 pubkey for fd keys; so:
-                pubkey = ecc.ECPrivkey(sec).get_public_key_hex(compressed=compressed)
-                # add signature
-                sig = self.sign_txin(i, sec)
-                self.add_signature_to_txin(txin, j, sig)
-                txin['pubkeys'][j] = pubkey  # needed for fd keys
-                self._inputs[i] = txin
+                if pre_hash is None:
+                    pre_hash = Hash(self.serialize_preimage_bytes(i))
+                jobs.append((i, j, sec, compressed, pre_hash))
+                signed.add(j)
+        args = [x[2:] for x in jobs]
+        if executor is not None and len(jobs) > 1:
+            results = executor.map(sign_pre_hash, *zip(*args), chunksize=max(1, len(jobs) // 64))
+        else:
+            results = (sign_pre_hash(*x) for x in args)
+        for (i, j, *_), (pubkey, sig) in zip(jobs, results):
+            txin = self._inputs[i]
+            self.add_signature_to_txin(txin, j, sig)
+            # pubkey might not actually be a 02-04 pubkey for fd keys
+            txin['pubkeys'][j] = pubkey
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
 
     def sign_txin(self, txin_index, privkey_bytes) -> str:
-        pre_hash = Hash(bfh(self.serialize_preimage(txin_index)))
+        pre_hash = Hash(self.serialize_preimage_bytes(txin_index))
         privkey = ecc.ECPrivkey(privkey_bytes)
         sig = privkey.sign_transaction(pre_hash)
         sig = bh2u(sig) + '01'
@@ -1163,6 +1383,64 @@ class Transaction:
         return out
 
 
+class TransactionStore(MutableMapping):
+    """txid -> Transaction map that keeps transactions as raw hex.
+
+    Transaction objects are only created when an entry is accessed; the
+    most recently used ones are cached. The raw strings are those loaded
+    from the wallet file, so they are not duplicated in memory.
+    """
+
+    MAX_CACHED = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._raw = {}  # txid -> raw hex
+        self._cache = OrderedDict()  # txid -> Transaction
+
+    def load_raw(self, txid, raw):
+        self._raw[txid] = raw
+        with self.lock:
+            self._cache.pop(txid, None)
+
+    def get_raw(self, txid):
+        return self._raw[txid]
+
+    def _add_to_cache(self, txid, tx):
+        self._cache[txid] = tx
+        if len(self._cache) > self.MAX_CACHED:
+            self._cache.popitem(last=False)
+
+    def __getitem__(self, txid):
+        with self.lock:
+            tx = self._cache.get(txid)
+            if tx is not None:
+                self._cache.move_to_end(txid)
+                return tx
+            tx = Transaction(self.get_raw(txid))
+            self._add_to_cache(txid, tx)
+            return tx
+
+    def __setitem__(self, txid, tx):
+        self.load_raw(txid, str(tx))
+        with self.lock:
+            self._add_to_cache(txid, tx)
+
+    def __delitem__(self, txid):
+        del self._raw[txid]
+        with self.lock:
+            self._cache.pop(txid, None)
+
+    def __contains__(self, txid):
+        return txid in self._raw
+
+    def __iter__(self):
+        return iter(list(self._raw))
+
+    def __len__(self):
+        return len(self._raw)
+
+
 def tx_from_str(txt):
     "json or raw hexadecimal"
     import json
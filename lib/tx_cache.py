@@ -0,0 +1,158 @@
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from .transaction import txid_from_raw
+from .util import PrintError, bfh, bh2u, make_dir
+
+
+def raw_tx_hash(raw):
+    '''The txid of a raw transaction (hex).'''
+    return txid_from_raw(bfh(raw))
+
+
+def check_raw_tx(txid, raw):
+    '''Returns True if raw (hex) is the transaction txid.'''
+    try:
+        return raw_tx_hash(raw) == txid
+    except Exception:
+        return False
+
+
+class TxCache(PrintError):
+    """Raw transactions by txid, shared by the wallets of a network.
+
+    Transactions are stored as one file per txid under the data
+    directory, and evicted least recently used first when the cache
+    exceeds max_size bytes.  The most recently used ones are also kept
+    in memory.  Transactions are only inserted if they hash to their
+    txid.
+
+    The files are not encrypted, and their names and access times tell
+    which transactions were used, so wallets with an encrypted file do
+    not use the cache (see Abstract_Wallet.use_shared_caches).
+    """
+
+    MAX_CACHED = 1000
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self._memory = OrderedDict()  # txid -> raw hex
+        self._files = None  # txid -> size, least recently used first
+        self._size = 0
+
+    def filename(self, txid):
+        return os.path.join(self.path, txid[0:2], txid)
+
+    def _load_index(self):
+        # called with lock held
+        if self._files is not None:
+            return
+        entries = []
+        make_dir(self.path)
+        for d in os.listdir(self.path):
+            dirname = os.path.join(self.path, d)
+            if not os.path.isdir(dirname):
+                continue
+            for txid in os.listdir(dirname):
+                if not re.match('^[0-9a-f]{64}$', txid):
+                    continue
+                st = os.stat(os.path.join(dirname, txid))
+                entries.append((st.st_mtime, txid, st.st_size))
+        entries.sort()
+        self._files = OrderedDict((txid, size) for _, txid, size in entries)
+        self._size = sum(self._files.values())
+
+    def _remember(self, txid, raw):
+        self._memory[txid] = raw
+        self._memory.move_to_end(txid)
+        if len(self._memory) > self.MAX_CACHED:
+            self._memory.popitem(last=False)
+
+    def get(self, txid):
+        '''Returns the raw transaction, or None.'''
+        with self.lock:
+            raw = self._memory.get(txid)
+            if raw is not None:
+                self._memory.move_to_end(txid)
+                return raw
+            self._load_index()
+            if txid not in self._files:
+                return None
+            filename = self.filename(txid)
+            try:
+                with open(filename, 'rb') as f:
+                    raw = bh2u(f.read())
+                os.utime(filename)
+            except OSError as e:
+                self.print_error("cannot read", txid, e)
+                self._size -= self._files.pop(txid)
+                return None
+            self._files.move_to_end(txid)
+            self._remember(txid, raw)
+            return raw
+
+    def put(self, txid, raw):
+        '''Adds a raw transaction.  Returns False if it does not match
+        txid.'''
+        if not check_raw_tx(txid, raw):
+            self.print_error("not caching", txid, "txid mismatch")
+            return False
+        with self.lock:
+            self._remember(txid, raw)
+            self._load_index()
+            if txid in self._files:
+                return True
+            data = bfh(raw)
+            filename = self.filename(txid)
+            try:
+                make_dir(os.path.dirname(filename))
+                tmp = filename + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, filename)
+            except OSError as e:
+                self.print_error("cannot write", txid, e)
+                return True
+            self._files[txid] = len(data)
+            self._size += len(data)
+            while self._size > self.max_size and len(self._files) > 1:
+                old, size = self._files.popitem(last=False)
+                self._size -= size
+                try:
+                    os.unlink(self.filename(old))
+                except OSError:
+                    pass
+        return True
+
+    def __contains__(self, txid):
+        with self.lock:
+            if txid in self._memory:
+                return True
+            self._load_index()
+            return txid in self._files
@@ -731,16 +731,83 @@ def parse_json(message):
 class timeout(Exception):
     pass
 
+import math
 import socket
 import json
 import ssl
 import time
 
 
+class Histogram:
+    """Histogram of durations in seconds, with log-linear buckets in the
+    spirit of HdrHistogram: SUB buckets per power of two from 100 us to
+    about 100 s, so percentiles are exact to within 19%."""
+
+    MIN = 0.0001
+    SUB = 4
+    NUM = 4 * 20
+
+    def __init__(self):
+        self.counts = [0] * (self.NUM + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def upper_bound(self, i):
+        return self.MIN * 2 ** (i / self.SUB)
+
+    def add(self, value):
+        if value <= self.MIN:
+            i = 0
+        else:
+            i = min(self.NUM, math.ceil(math.log2(value / self.MIN) * self.SUB))
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n and n >= p / 100 * self.count:
+                # the last bucket also holds everything above its bound
+                return self.max if i == self.NUM else min(self.upper_bound(i), self.max)
+        return 0.0
+
+    def to_dict(self):
+        '''Summary, and cumulative counts at each power of two.'''
+        buckets = []
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if i % self.SUB == 0:
+                buckets.append((self.upper_bound(i), n))
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'buckets': buckets,
+        }
+
+
 class SocketPipe:
+    # bytes read from the socket at once
+    recv_size = 65536
+
     def __init__(self, socket):
         self.socket = socket
-        self.message = b''
+        # received data.  Messages before self.offset have been parsed;
+        # there is no newline in buffer[offset:scan_offset].
+        self.buffer = bytearray()
+        self.offset = 0
+        self.scan_offset = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
         self.set_timeout(0.1)
         self.recv_time = time.time()
 
@@ -750,13 +817,32 @@ class SocketPipe:
     def idle_time(self):
         return time.time() - self.recv_time
 
+    def next_message(self):
+        '''Returns (found, message) for the next complete message in the
+        buffer.  message is None if it is not valid JSON.'''
+        n = self.buffer.find(b'\n', self.scan_offset)
+        if n == -1:
+            self.scan_offset = len(self.buffer)
+            return False, None
+        try:
+            j = json.loads(self.buffer[self.offset:n].decode('utf8'))
+        except:
+            j = None
+        self.offset = self.scan_offset = n + 1
+        return True, j
+
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
-            if response is not None:
+            found, response = self.next_message()
+            if found and response is not None:
                 return response
+            if self.offset:
+                # only the start of a message is left; drop the rest
+                del self.buffer[:self.offset]
+                self.scan_offset -= self.offset
+                self.offset = 0
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(self.recv_size)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
@@ -765,8 +851,8 @@ class SocketPipe:
                 if err.errno == 60:
                     raise timeout
                 elif err.errno in [11, 35, 10035]:
-                    print_error("socket errno %d (resource temporarily unavailable)"% err.errno)
-                    time.sleep(0.2)
+                    # no more data on a non-blocking socket; the caller
+                    # waits with select()
                     raise timeout
                 else:
                     print_error("pipe: socket error", err)
@@ -777,9 +863,24 @@ class SocketPipe:
 
             if not data:  # Connection closed remotely
                 return None
-            self.message += data
+            self.buffer += data
+            self.bytes_received += len(data)
             self.recv_time = time.time()
 
+    def get_all(self):
+        '''Returns all the messages that can be read without waiting.
+        None is appended if the connection was closed.'''
+        responses = []
+        while True:
+            try:
+                response = self.get()
+            except timeout:
+                break
+            responses.append(response)
+            if response is None:
+                break
+        return responses
+
     def send(self, request):
         out = json.dumps(request) + '\n'
         out = out.encode('utf8')
@@ -794,6 +895,7 @@ class SocketPipe:
             try:
                 sent = self.socket.send(out)
                 out = out[sent:]
+                self.bytes_sent += sent
             except ssl.SSLError as e:
                 print_error("SSLError:", e)
                 time.sleep(0.1)
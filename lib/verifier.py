@@ -20,10 +20,152 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-from .util import ThreadJob
+import os
+import struct
+import threading
+from collections import defaultdict
+
+from .util import ThreadJob, PrintError, bfh, bh2u, make_dir
 from .bitcoin import *
 
 
+class MerkleProofStore(PrintError):
+    """Merkle branches of the transactions of a wallet.
+
+    Proofs are appended to a file as records of txid, height, position
+    and branch; the last record of a txid wins, and a record at height
+    0 removes it.  The file is rewritten once less than half of it is
+    live.  Proofs are checked against the headers before use, so a
+    proof made stale by a reorg only costs a request to the server.
+
+    The file is not encrypted: wallets with an encrypted file have no
+    store (see for_wallet).
+    """
+
+    COMPACT_MIN_SIZE = 100000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.proofs = None  # txid -> (height, pos, branch bytes)
+        self.file_size = 0
+
+    @classmethod
+    def for_wallet(cls, config_path, wallet):
+        '''The store of wallet, under config_path.  Returns None, and
+        deletes the file of the wallet if it has one, if the wallet file
+        is encrypted.'''
+        store_id = wallet.storage.get('merkle_proofs_id')
+        if not wallet.use_shared_caches():
+            if store_id is not None:
+                cls(os.path.join(config_path, 'merkle_proofs', store_id)).delete()
+                wallet.storage.put('merkle_proofs_id', None)
+            return None
+        if store_id is None:
+            store_id = bh2u(os.urandom(16))
+            wallet.storage.put('merkle_proofs_id', store_id)
+        return cls(os.path.join(config_path, 'merkle_proofs', store_id))
+
+    @staticmethod
+    def record_size(branch):
+        return 41 + len(branch)
+
+    def live_size(self):
+        return sum(self.record_size(x[2]) for x in self.proofs.values())
+
+    def _load(self):
+        # called with lock held
+        if self.proofs is not None:
+            return
+        self.proofs = {}
+        self.file_size = 0
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + 41 <= len(data):
+            height, pos, n = struct.unpack_from('<IIB', data, offset + 32)
+            end = offset + 41 + 32 * n
+            if end > len(data):
+                break
+            txid = bh2u(data[offset:offset + 32])
+            if height == 0:
+                self.proofs.pop(txid, None)
+            else:
+                self.proofs[txid] = (height, pos, data[offset + 41:end])
+            offset = end
+        if offset < len(data):
+            self.print_error("ignoring truncated record at", offset)
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+        self.file_size = offset
+
+    def _append(self, record):
+        # called with lock held
+        try:
+            make_dir(os.path.dirname(self.path))
+            with open(self.path, 'ab') as f:
+                f.write(record)
+        except OSError as e:
+            self.print_error("cannot write", e)
+            return
+        self.file_size += len(record)
+        if self.file_size > max(self.COMPACT_MIN_SIZE, 2 * self.live_size()):
+            self._compact()
+
+    def _compact(self):
+        # called with lock held
+        data = b''.join(bfh(txid) + struct.pack('<IIB', height, pos, len(branch) // 32) + branch
+                        for txid, (height, pos, branch) in self.proofs.items())
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            self.print_error("cannot write", e)
+            return
+        self.file_size = len(data)
+
+    def get(self, tx_hash):
+        '''Returns (height, pos, merkle branch) or None.'''
+        with self.lock:
+            self._load()
+            proof = self.proofs.get(tx_hash)
+        if proof is None:
+            return None
+        height, pos, branch = proof
+        return height, pos, [bh2u(branch[i:i + 32]) for i in range(0, len(branch), 32)]
+
+    def put(self, tx_hash, height, pos, merkle):
+        branch = b''.join(bfh(x) for x in merkle)
+        with self.lock:
+            self._load()
+            if self.proofs.get(tx_hash) == (height, pos, branch):
+                return
+            self.proofs[tx_hash] = (height, pos, branch)
+            self._append(bfh(tx_hash) + struct.pack('<IIB', height, pos, len(merkle)) + branch)
+
+    def remove(self, tx_hash):
+        with self.lock:
+            self._load()
+            if self.proofs.pop(tx_hash, None) is None:
+                return
+            self._append(bfh(tx_hash) + struct.pack('<IIB', 0, 0, 0))
+
+    def delete(self):
+        with self.lock:
+            self.proofs = {}
+            self.file_size = 0
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.print_error("cannot delete", e)
+
+
 class SPV(ThreadJob):
     """ Simple Payment Verification """
 
@@ -31,8 +173,11 @@ class SPV(ThreadJob):
         self.wallet = wallet
         self.network = network
         self.blockchain = network.blockchain()
+        self.proof_store = MerkleProofStore.for_wallet(network.config.path, wallet)
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        # (tx_hash, height, pos, merkle) received, verified in run()
+        self.received_proofs = []
 
     def run(self):
         interface = self.network.interface
@@ -41,9 +186,15 @@ class SPV(ThreadJob):
         blockchain = interface.blockchain
         if not blockchain:
             return
+        # proofs received since the last run
+        proofs, self.received_proofs = self.received_proofs, []
+        self.verify_proofs(proofs)
         lh = self.network.get_local_height()
         unverified = self.wallet.get_unverified_txs()
+        stored = []
         for tx_hash, tx_height in unverified.items():
+            if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
+                continue
             # do not request merkle branch before headers are available
             if (tx_height > 0) and (tx_height <= lh):
                 header = blockchain.read_header(tx_height)
@@ -52,20 +203,30 @@ class SPV(ThreadJob):
                     if index < len(blockchain.checkpoints):
                         self.network.request_chunk(interface, index)
                 else:
-                    if (tx_hash not in self.requested_merkle
-                            and tx_hash not in self.merkle_roots):
-
-                        self.network.get_merkle_for_transaction(
-                                tx_hash,
-                                tx_height,
-                                self.verify_merkle)
-                        self.print_error('requested merkle', tx_hash)
-                        self.requested_merkle.add(tx_hash)
+                    proof = self.proof_store.get(tx_hash) if self.proof_store else None
+                    if proof and proof[0] == tx_height:
+                        stored.append((tx_hash,) + proof)
+                    else:
+                        self.request_merkle(tx_hash, tx_height)
+        if stored:
+            self.print_error("verifying %d stored proofs" % len(stored))
+            # proofs that do not match our headers are requested again
+            for tx_hash in self.verify_proofs(stored, stored=True):
+                self.proof_store.remove(tx_hash)
+                self.request_merkle(tx_hash, unverified[tx_hash])
 
         if self.network.blockchain() != self.blockchain:
             self.blockchain = self.network.blockchain()
             self.undo_verifications()
 
+    def request_merkle(self, tx_hash, tx_height):
+        self.network.get_merkle_for_transaction(
+                tx_hash,
+                tx_height,
+                self.verify_merkle)
+        self.print_error('requested merkle', tx_hash)
+        self.requested_merkle.add(tx_hash)
+
     def verify_merkle(self, r):
         if self.wallet.verifier is None:
             return  # we have been killed, this was just an orphan callback
@@ -74,37 +235,54 @@ class SPV(ThreadJob):
             return
         params = r['params']
         merkle = r['result']
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
         tx_hash = params[0]
-        tx_height = merkle.get('block_height')
-        pos = merkle.get('pos')
-        merkle_root = self.hash_merkle_root(merkle['merkle'], tx_hash, pos)
-        header = self.network.blockchain().read_header(tx_height)
-        # FIXME: if verification fails below,
-        # we should make a fresh connection to a server to
-        # recover from this, as this TX will now never verify
-        if not header:
-            self.print_error(
-                "merkle verification failed for {} (missing header {})"
-                .format(tx_hash, tx_height))
-            return
-        if header.get('merkle_root') != merkle_root:
-            self.print_error(
-                "merkle verification failed for {} (merkle root mismatch {} != {})"
-                .format(tx_hash, header.get('merkle_root'), merkle_root))
-            return
-        # we passed all the tests
-        self.merkle_roots[tx_hash] = merkle_root
-        try:
-            # note: we could pop in the beginning, but then we would request
-            # this proof again in case of verification failure from the same server
-            self.requested_merkle.remove(tx_hash)
-        except KeyError: pass
-        self.print_error("verified %s" % tx_hash)
-        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
-        if self.is_up_to_date() and self.wallet.is_up_to_date():
+        self.received_proofs.append((tx_hash, merkle.get('block_height'),
+                                     merkle.get('pos'), merkle['merkle']))
+
+    def verify_proofs(self, proofs, stored=False):
+        '''Verify that the merkle branches of proofs, a list of
+        (tx_hash, height, pos, merkle), lead to the merkle roots of
+        their blocks.  Proofs at the same height share one header read.
+        Returns the tx hashes that failed.'''
+        by_height = defaultdict(list)
+        for proof in proofs:
+            by_height[proof[1]].append(proof)
+        failed = []
+        blockchain = self.network.blockchain()
+        for tx_height, items in sorted(by_height.items()):
+            header = blockchain.read_header(tx_height)
+            for tx_hash, tx_height, pos, merkle in items:
+                merkle_root = self.hash_merkle_root(merkle, tx_hash, pos)
+                # FIXME: if verification of a server proof fails below,
+                # we should make a fresh connection to a server to
+                # recover from this, as this TX will now never verify
+                if not header:
+                    if not stored:
+                        self.print_error(
+                            "merkle verification failed for {} (missing header {})"
+                            .format(tx_hash, tx_height))
+                    failed.append(tx_hash)
+                    continue
+                if header.get('merkle_root') != merkle_root:
+                    if not stored:
+                        self.print_error(
+                            "merkle verification failed for {} (merkle root mismatch {} != {})"
+                            .format(tx_hash, header.get('merkle_root'), merkle_root))
+                    failed.append(tx_hash)
+                    continue
+                # we passed all the tests
+                self.merkle_roots[tx_hash] = merkle_root
+                # note: we could pop in the beginning, but then we would request
+                # this proof again in case of verification failure from the same server
+                self.requested_merkle.discard(tx_hash)
+                if not stored:
+                    if self.proof_store:
+                        self.proof_store.put(tx_hash, tx_height, pos, merkle)
+                    self.print_error("verified %s" % tx_hash)
+                self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
+        if len(failed) < len(proofs) and self.is_up_to_date() and self.wallet.is_up_to_date():
             self.wallet.save_verified_tx(write=True)
+        return failed
 
     @classmethod
     def hash_merkle_root(cls, merkle_s, target_hash, pos):
@@ -121,8 +299,12 @@ class SPV(ThreadJob):
             self.print_error("redoing", tx_hash)
             self.remove_spv_proof_for_tx(tx_hash)
 
-    def remove_spv_proof_for_tx(self, tx_hash):
+    def remove_spv_proof_for_tx(self, tx_hash, keep_stored=False):
+        # keep_stored: the tx is still in the history, at another height;
+        # its stored proof is checked against its new height before use
         self.merkle_roots.pop(tx_hash, None)
+        if self.proof_store and not keep_stored:
+            self.proof_store.remove(tx_hash)
         try:
             self.requested_merkle.remove(tx_hash)
         except KeyError:
@@ -37,6 +37,7 @@ import errno
 import traceback
 from functools import partial
 from collections import defaultdict
+from bisect import bisect_left
 from numbers import Number
 from decimal import Decimal
 import itertools
@@ -51,15 +52,15 @@ from .util import (NotEnoughFunds, PrintError, UserCancelled, profiler,
 
 from .bitcoin import *
 from .version import *
-from .keystore import load_keystore, Hardware_KeyStore
+from .keystore import load_keystore, Hardware_KeyStore, Software_KeyStore
 from .storage import multisig_type, STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW
 
 from . import transaction
-from .transaction import Transaction
+from .transaction import Transaction, TransactionStore
 from .plugins import run_hook
 from . import bitcoin
 from . import coinchooser
-from .synchronizer import Synchronizer
+from .synchronizer import Synchronizer, history_status
 from .verifier import SPV
 
 from . import paymentrequest
@@ -201,6 +202,7 @@ class Abstract_Wallet(PrintError):
         self.labels                = storage.get('labels', {})
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
         self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        self._addr_status          = storage.get('addr_status', {})        # address -> status of history
         self.fiat_value            = storage.get('fiat_value', {})
         self.receive_requests      = storage.get('payment_requests', {})
 
@@ -209,6 +211,21 @@ class Abstract_Wallet(PrintError):
         # Transactions pending verification.  txid -> tx_height. Access with self.lock.
         self.unverified_tx = defaultdict(int)
 
+        # Keys of the history maps modified since the last save_transactions.
+        # Access with self.transaction_lock.
+        self._changed_txids = set()     # transactions, txi, txo, tx_fees
+        self._changed_addrs = set()     # addr_history
+        self._changed_prevouts = set()  # spent_outpoints
+
+        # Per-address caches, invalidated when a transaction touching the
+        # address is added, removed, or changes height.
+        # Access with self.lock and self.transaction_lock.
+        self._addr_utxo_cache = {}     # addr -> {prevout: utxo}
+        self._addr_balance_cache = {}  # addr -> (c, u, x, local_height or None)
+        # Wallet history, invalidated on the same events.
+        self._tx_delta_cache = {}      # txid -> delta on wallet addresses
+        self._reset_wallet_history()
+
         self.load_keystore()
         self.load_addresses()
         self.test_addresses_sanity()
@@ -247,23 +264,25 @@ class Abstract_Wallet(PrintError):
     @profiler
     def load_transactions(self):
         # load txi, txo, tx_fees
-        self.txi = self.storage.get('txi', {})
-        for txid, d in list(self.txi.items()):
-            for addr, lst in d.items():
-                self.txi[txid][addr] = set([tuple(x) for x in lst])
-        self.txo = self.storage.get('txo', {})
-        self.tx_fees = self.storage.get('tx_fees', {})
-        tx_list = self.storage.get('transactions', {})
-        # load transactions
-        self.transactions = {}
+        # note: views avoid copying the storage; we build our own dicts
+        self.txi = {}
+        for txid, d in self.storage.get_view('txi', {}).items():
+            self.txi[txid] = {addr: set(tuple(x) for x in lst) for addr, lst in d.items()}
+        self.txo = {}
+        for txid, d in self.storage.get_view('txo', {}).items():
+            self.txo[txid] = {addr: [tuple(x) for x in lst] for addr, lst in d.items()}
+        self.tx_fees = dict(self.storage.get_view('tx_fees', {}))
+        tx_list = self.storage.get_view('transactions', {})
+        # load transactions; they are deserialized when accessed
+        self.transactions = TransactionStore()
         for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
             if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None:
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                self._changed_txids.add(tx_hash)
+                continue
+            self.transactions.load_raw(tx_hash, raw)
         # load spent_outpoints
-        _spent_outpoints = self.storage.get('spent_outpoints', {})
+        _spent_outpoints = self.storage.get_view('spent_outpoints', {})
         self.spent_outpoints = defaultdict(dict)
         for prevout_hash, d in _spent_outpoints.items():
             for prevout_n_str, spending_txid in d.items():
@@ -273,6 +292,10 @@ class Abstract_Wallet(PrintError):
     @profiler
     def load_local_history(self):
         self._history_local = {}  # address -> set(txid)
+        self._addr_utxo_cache = {}
+        self._addr_balance_cache = {}
+        self._tx_delta_cache = {}
+        self._reset_wallet_history()
         for txid in itertools.chain(self.txi, self.txo):
             self._add_tx_to_local_history(txid)
 
@@ -284,17 +307,36 @@ class Abstract_Wallet(PrintError):
                 self.remove_transaction(txid)
 
     @profiler
-    def save_transactions(self, write=False):
+    def save_transactions(self, write=False, full=False):
+        """Save the history maps to storage. Unless full is set, only the
+        entries recorded as changed since the last call are saved."""
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('addr_history', self.history)
-            self.storage.put('spent_outpoints', self.spent_outpoints)
+            if full:
+                tx = {}
+                for k in self.transactions:
+                    tx[k] = self.transactions.get_raw(k)
+                self.storage.put('transactions', tx)
+                self.storage.put('txi', self.txi)
+                self.storage.put('txo', self.txo)
+                self.storage.put('tx_fees', self.tx_fees)
+                self.storage.put('addr_history', self.history)
+                self.storage.put('addr_status', self._addr_status)
+                self.storage.put('spent_outpoints', self.spent_outpoints)
+            else:
+                for txid in self._changed_txids:
+                    raw = self.transactions.get_raw(txid) if txid in self.transactions else None
+                    self.storage.put_item('transactions', txid, raw)
+                    self.storage.put_item('txi', txid, self.txi.get(txid))
+                    self.storage.put_item('txo', txid, self.txo.get(txid))
+                    self.storage.put_item('tx_fees', txid, self.tx_fees.get(txid))
+                for addr in self._changed_addrs:
+                    self.storage.put_item('addr_history', addr, self.history.get(addr))
+                    self.storage.put_item('addr_status', addr, self._addr_status.get(addr))
+                for prevout_hash in self._changed_prevouts:
+                    self.storage.put_item('spent_outpoints', prevout_hash, self.spent_outpoints.get(prevout_hash))
+            self._changed_txids.clear()
+            self._changed_addrs.clear()
+            self._changed_prevouts.clear()
             if write:
                 self.storage.write()
 
@@ -312,9 +354,14 @@ class Abstract_Wallet(PrintError):
                 self.tx_fees = {}
                 self.spent_outpoints = defaultdict(dict)
                 self.history = {}
+                self._addr_status = {}
                 self.verified_tx = {}
-                self.transactions = {}
-                self.save_transactions()
+                self.transactions = TransactionStore()
+                self._addr_utxo_cache = {}
+                self._addr_balance_cache = {}
+                self._tx_delta_cache = {}
+                self._reset_wallet_history()
+                self.save_transactions(full=True)
 
     @profiler
     def check_history(self):
@@ -325,6 +372,8 @@ class Abstract_Wallet(PrintError):
 
         for addr in hist_addrs_not_mine:
             self.history.pop(addr)
+            self._changed_addrs.add(addr)
+            self._addr_status.pop(addr, None)
             save = True
 
         for addr in hist_addrs_mine:
@@ -452,12 +501,15 @@ class Abstract_Wallet(PrintError):
                 and tx_hash in self.verified_tx:
             with self.lock:
                 self.verified_tx.pop(tx_hash)
+                self._invalidate_addr_cache(tx_hash)
             if self.verifier:
                 self.verifier.remove_spv_proof_for_tx(tx_hash)
 
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
             with self.lock:
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self._invalidate_addr_cache(tx_hash)
                 self.unverified_tx[tx_hash] = tx_height
 
     def add_verified_tx(self, tx_hash, info):
@@ -465,6 +517,7 @@ class Abstract_Wallet(PrintError):
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            self._invalidate_addr_cache(tx_hash)
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
@@ -484,6 +537,7 @@ class Abstract_Wallet(PrintError):
                     # fixme: use block hash, not timestamp
                     if not header or header.get('timestamp') != timestamp:
                         self.verified_tx.pop(tx_hash, None)
+                        self._invalidate_addr_cache(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -664,23 +718,28 @@ class Abstract_Wallet(PrintError):
         return received, sent
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-        out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out[txo] = x
-        return out
+        with self.lock, self.transaction_lock:
+            out = self._addr_utxo_cache.get(address)
+            if out is None:
+                coins, spent = self.get_addr_io(address)
+                for txi in spent:
+                    coins.pop(txi)
+                out = {}
+                for txo, v in coins.items():
+                    tx_height, value, is_cb = v
+                    prevout_hash, prevout_n = txo.split(':')
+                    x = {
+                        'address':address,
+                        'value':value,
+                        'prevout_n':int(prevout_n),
+                        'prevout_hash':prevout_hash,
+                        'height':tx_height,
+                        'coinbase':is_cb
+                    }
+                    out[txo] = x
+                self._addr_utxo_cache[address] = out
+            # callers may modify the coins
+            return {txo: dict(x) for txo, x in out.items()}
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
@@ -689,22 +748,30 @@ class Abstract_Wallet(PrintError):
 
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     def get_addr_balance(self, address):
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
         local_height = self.get_local_height()
-        for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > local_height:
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
+        with self.lock, self.transaction_lock:
+            cached = self._addr_balance_cache.get(address)
+            # coinbase maturity depends on the local height
+            if cached is not None and cached[3] in (None, local_height):
+                return cached[:3]
+            received, sent = self.get_addr_io(address)
+            c = u = x = 0
+            has_coinbase = False
+            for txo, (tx_height, v, is_cb) in received.items():
+                has_coinbase |= bool(is_cb)
+                if is_cb and tx_height + COINBASE_MATURITY > local_height:
+                    x += v
+                elif tx_height > 0:
+                    c += v
                 else:
-                    u -= v
-        return c, u, x
+                    u += v
+                if txo in sent:
+                    if sent[txo] > 0:
+                        c -= v
+                    else:
+                        u -= v
+            self._addr_balance_cache[address] = (c, u, x, local_height if has_coinbase else None)
+            return c, u, x
 
     def get_spendable_coins(self, domain, config):
         confirmed_only = config.get('confirmed_only', False)
@@ -752,6 +819,19 @@ class Abstract_Wallet(PrintError):
             xx += x
         return cc, uu, xx
 
+    def get_address_status(self, addr):
+        """Status of the history of addr, as defined by the Electrum
+        protocol. Cached, and saved with the history."""
+        with self.lock:
+            status = self._addr_status.get(addr)
+            if status is None:
+                status = history_status(self.history.get(addr, []))
+                if status is not None:
+                    self._addr_status[addr] = status
+                    with self.transaction_lock:
+                        self._changed_addrs.add(addr)
+            return status
+
     def get_address_history(self, addr):
         h = []
         # we need self.transaction_lock but get_tx_height will take self.lock
@@ -769,6 +849,17 @@ class Abstract_Wallet(PrintError):
                 cur_hist = self._history_local.get(addr, set())
                 cur_hist.add(txid)
                 self._history_local[addr] = cur_hist
+                self._addr_utxo_cache.pop(addr, None)
+                self._addr_balance_cache.pop(addr, None)
+            self._tx_delta_cache.pop(txid, None)
+            self._invalidate_wallet_history(txid)
+
+    def _invalidate_addr_cache(self, txid):
+        with self.transaction_lock:
+            for addr in itertools.chain(self.txi.get(txid, []), self.txo.get(txid, [])):
+                self._addr_utxo_cache.pop(addr, None)
+                self._addr_balance_cache.pop(addr, None)
+            self._invalidate_wallet_history(txid)
 
     def _remove_tx_from_local_history(self, txid):
         with self.transaction_lock:
@@ -780,6 +871,10 @@ class Abstract_Wallet(PrintError):
                     pass
                 else:
                     self._history_local[addr] = cur_hist
+                self._addr_utxo_cache.pop(addr, None)
+                self._addr_balance_cache.pop(addr, None)
+            self._tx_delta_cache.pop(txid, None)
+            self._invalidate_wallet_history(txid)
 
     def get_txin_address(self, txi):
         addr = txi.get('address')
@@ -901,6 +996,7 @@ class Abstract_Wallet(PrintError):
                 prevout_n = txi['prevout_n']
                 ser = prevout_hash + ':%d' % prevout_n
                 self.spent_outpoints[prevout_hash][prevout_n] = tx_hash
+                self._changed_prevouts.add(prevout_hash)
                 add_value_from_prev_output()
             # add outputs
             self.txo[tx_hash] = d = {}
@@ -920,11 +1016,13 @@ class Abstract_Wallet(PrintError):
                             dd[addr] = set()
                         if (ser, v) not in dd[addr]:
                             dd[addr].add((ser, v))
+                            self._changed_txids.add(next_tx)
                         self._add_tx_to_local_history(next_tx)
             # add to local history
             self._add_tx_to_local_history(tx_hash)
             # save
             self.transactions[tx_hash] = tx
+            self._changed_txids.add(tx_hash)
             return True
 
     def remove_transaction(self, tx_hash):
@@ -937,13 +1035,15 @@ class Abstract_Wallet(PrintError):
                     prevout_hash = txin['prevout_hash']
                     prevout_n = txin['prevout_n']
                     self.spent_outpoints[prevout_hash].pop(prevout_n, None)
+                    self._changed_prevouts.add(prevout_hash)
                     if not self.spent_outpoints[prevout_hash]:
                         self.spent_outpoints.pop(prevout_hash)
             else:  # expensive but always works
                 for prevout_hash, d in list(self.spent_outpoints.items()):
-                    for prevout_n, spending_txid in d.items():
+                    for prevout_n, spending_txid in list(d.items()):
                         if spending_txid == tx_hash:
                             self.spent_outpoints[prevout_hash].pop(prevout_n, None)
+                            self._changed_prevouts.add(prevout_hash)
                             if not self.spent_outpoints[prevout_hash]:
                                 self.spent_outpoints.pop(prevout_hash)
             # Remove this tx itself; if nothing spends from it.
@@ -951,6 +1051,7 @@ class Abstract_Wallet(PrintError):
             # removed when those other txns are removed.
             if not self.spent_outpoints[tx_hash]:
                 self.spent_outpoints.pop(tx_hash)
+                self._changed_prevouts.add(tx_hash)
 
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
@@ -959,22 +1060,34 @@ class Abstract_Wallet(PrintError):
             self._remove_tx_from_local_history(tx_hash)
             self.txi.pop(tx_hash, None)
             self.txo.pop(tx_hash, None)
+            self._changed_txids.add(tx_hash)
+        if self.verifier:
+            self.verifier.remove_spv_proof_for_tx(tx_hash)
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_unverified_tx(tx_hash, tx_height)
         self.add_transaction(tx_hash, tx, allow_unrelated=True)
 
-    def receive_history_callback(self, addr, hist, tx_fees):
+    def receive_history_callback(self, addr, hist, tx_fees, status=None):
+        # status: the status of hist, if known
         with self.lock:
             old_hist = self.get_address_history(addr)
+            new_txids = set(tx_hash for tx_hash, height in hist)
             for tx_hash, height in old_hist:
                 if (tx_hash, height) not in hist:
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.verified_tx.pop(tx_hash, None)
+                    self._invalidate_addr_cache(tx_hash)
                     if self.verifier:
-                        self.verifier.remove_spv_proof_for_tx(tx_hash)
+                        self.verifier.remove_spv_proof_for_tx(
+                            tx_hash, keep_stored=tx_hash in new_txids)
             self.history[addr] = hist
+            with self.transaction_lock:
+                self._changed_addrs.add(addr)
+                self._addr_status.pop(addr, None)
+                if status is not None:
+                    self._addr_status[addr] = status
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -986,12 +1099,116 @@ class Abstract_Wallet(PrintError):
             self.add_transaction(tx_hash, tx, allow_unrelated=True)
 
         # Store fees
-        self.tx_fees.update(tx_fees)
+        with self.transaction_lock:
+            self.tx_fees.update(tx_fees)
+            self._changed_txids |= set(tx_fees)
+
+    def _get_wallet_tx_delta(self, tx_hash):
+        """Effect of tx on the addresses of the wallet, or None if the
+        tx does not touch any of them."""
+        delta = self._tx_delta_cache.get(tx_hash)
+        if delta is None:
+            addrs = set(self.txi.get(tx_hash, {})) | set(self.txo.get(tx_hash, {}))
+            addrs = [addr for addr in addrs if self.is_mine(addr)]
+            if not addrs:
+                return None
+            delta = sum(self.get_tx_delta(tx_hash, addr) for addr in addrs)
+            self._tx_delta_cache[tx_hash] = delta
+        return delta
 
-    def get_history(self, domain=None):
-        # get domain
+    def _reset_wallet_history(self):
+        # list of (tx_hash, delta, balance), sorted by txpos
+        self._history_cache = None
+        # sort keys of _history_cache: list of (txpos, tx_hash)
+        self._history_keys = []
+        self._history_txpos = {}      # txid -> txpos in _history_keys
+        self._history_pending = set()  # txids to update in _history_cache
+        self._history_ok = False
+
+    def _invalidate_wallet_history(self, txid):
+        if self._history_cache is not None:
+            self._history_pending.add(txid)
+
+    def _get_wallet_history(self):
+        """Returns the history of the whole wallet, as a list of
+        (tx_hash, delta, balance) sorted by txpos.
+        The list is built once, then updated for the transactions
+        invalidated since the last call."""
+        with self.lock, self.transaction_lock:
+            if self._history_cache is None:
+                self._build_wallet_history()
+            elif self._history_pending:
+                self._update_wallet_history()
+            else:
+                return self._history_cache if self._history_ok else []
+            h = self._history_cache
+            balance = h[-1][2] if h else 0
+            # fixme: this may happen if history is incomplete
+            self._history_ok = balance == sum(self.get_balance())
+            if not self._history_ok:
+                self.print_error("Error: history not synchronized")
+                return []
+            return h
+
+    def _build_wallet_history(self):
+        items = []
+        for tx_hash in set(self.txi) | set(self.txo):
+            delta = self._get_wallet_tx_delta(tx_hash)
+            if delta is not None:
+                items.append((self.get_txpos(tx_hash), tx_hash, delta))
+        items.sort()
+        h = []
+        balance = 0
+        for txpos, tx_hash, delta in items:
+            balance += delta
+            h.append((tx_hash, delta, balance))
+        self._history_cache = h
+        self._history_keys = [(txpos, tx_hash) for txpos, tx_hash, delta in items]
+        self._history_txpos = {tx_hash: txpos for txpos, tx_hash, delta in items}
+        self._history_pending.clear()
+
+    def _update_wallet_history(self):
+        h = self._history_cache
+        keys = self._history_keys
+        # entries before start are not modified
+        start = len(h)
+        for tx_hash in self._history_pending:
+            txpos = self._history_txpos.pop(tx_hash, None)
+            if txpos is not None:
+                i = bisect_left(keys, (txpos, tx_hash))
+                del keys[i]
+                del h[i]
+                start = min(start, i)
+            delta = self._get_wallet_tx_delta(tx_hash)
+            if delta is not None:
+                txpos = self.get_txpos(tx_hash)
+                i = bisect_left(keys, (txpos, tx_hash))
+                keys.insert(i, (txpos, tx_hash))
+                h.insert(i, (tx_hash, delta, None))
+                self._history_txpos[tx_hash] = txpos
+                start = min(start, i)
+        self._history_pending.clear()
+        # fix up the balances of the following entries
+        balance = h[start - 1][2] if start > 0 else 0
+        for i in range(start, len(h)):
+            tx_hash, delta, _ = h[i]
+            balance += delta
+            h[i] = (tx_hash, delta, balance)
+
+    def get_history(self, domain=None, offset=0, limit=None):
+        """Returns the history of domain, oldest first, as a list of
+        (tx_hash, height, conf, timestamp, delta, balance).
+        offset and limit select a page of that list; for the whole
+        wallet, paging is served from a cache."""
         if domain is None:
-            domain = self.get_addresses()
+            end = None if limit is None else offset + limit
+            with self.lock, self.transaction_lock:
+                h = self._get_wallet_history()[offset:end]
+            out = []
+            for tx_hash, delta, balance in h:
+                height, conf, timestamp = self.get_tx_height(tx_hash)
+                out.append((tx_hash, height, conf, timestamp, delta, balance))
+            return out
         domain = set(domain)
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
@@ -1031,7 +1248,8 @@ class Abstract_Wallet(PrintError):
             self.print_error("Error: history not synchronized")
             return []
 
-        return h2
+        end = None if limit is None else offset + limit
+        return h2[offset:end]
 
     def balance_at_timestamp(self, domain, target_timestamp):
         h = self.get_history(domain)
@@ -1330,7 +1548,7 @@ class Abstract_Wallet(PrintError):
             self.storage.put('stored_height', self.get_local_height())
         self.save_transactions()
         self.save_verified_tx()
-        self.storage.write()
+        self.storage.compact()
 
     def wait_until_synchronized(self, callback=None):
         def wait_for_wallet():
@@ -1463,6 +1681,12 @@ class Abstract_Wallet(PrintError):
                 return True
         return False
 
+    def use_shared_caches(self):
+        """Whether the unencrypted on-disk caches, such as the tx cache
+        shared by wallets and the merkle proofs of this wallet, may be
+        used.  They are not used if the wallet file is encrypted."""
+        return not self.storage.is_encrypted()
+
     def get_input_tx(self, tx_hash, ignore_timeout=False):
         # First look up an input transaction in the wallet where it
         # will likely be.  If co-signing a transaction it may not have
@@ -1470,7 +1694,8 @@ class Abstract_Wallet(PrintError):
         tx = self.transactions.get(tx_hash, None)
         if not tx and self.network:
             try:
-                tx = Transaction(self.network.get_transaction(tx_hash))
+                tx = Transaction(self.network.get_transaction(
+                    tx_hash, use_cache=self.use_shared_caches()))
             except TimeoutException as e:
                 self.print_error('getting input txn from network timed out for {}'.format(tx_hash))
                 if not ignore_timeout:
@@ -1497,7 +1722,7 @@ class Abstract_Wallet(PrintError):
                 info[addr] = index, sorted_xpubs, self.m if isinstance(self, Multisig_Wallet) else None
         tx.output_info = info
 
-    def sign_transaction(self, tx, password):
+    def sign_transaction(self, tx, password, executor=None):
         if self.is_watching_only():
             return
         # hardware wallets require extra info
@@ -1506,7 +1731,12 @@ class Abstract_Wallet(PrintError):
         # sign. start with ready keystores.
         for k in sorted(self.get_keystores(), key=lambda ks: ks.ready_to_sign(), reverse=True):
             try:
-                if k.can_sign(tx):
+                if not k.can_sign(tx):
+                    continue
+                if isinstance(k, Software_KeyStore):
+                    # software keys may be used from a process pool
+                    k.sign_transaction(tx, password, executor)
+                else:
                     k.sign_transaction(tx, password)
             except UserCancelled:
                 continue
@@ -1708,6 +1938,9 @@ class Abstract_Wallet(PrintError):
     def add_address(self, address):
         if address not in self.history:
             self.history[address] = []
+            with self.transaction_lock:
+                self._changed_addrs.add(address)
+                self._addr_status.pop(address, None)
         if self.synchronizer:
             self.synchronizer.add(address)
 
@@ -1784,12 +2017,9 @@ class Abstract_Wallet(PrintError):
     def get_depending_transactions(self, tx_hash):
         """Returns all (grand-)children of tx_hash in this wallet."""
         children = set()
-        # TODO rewrite this to use self.spent_outpoints
-        for other_hash, tx in self.transactions.items():
-            for input in (tx.inputs()):
-                if input["prevout_hash"] == tx_hash:
-                    children.add(other_hash)
-                    children |= self.get_depending_transactions(other_hash)
+        for other_hash in self.spent_outpoints.get(tx_hash, {}).values():
+            children.add(other_hash)
+            children |= self.get_depending_transactions(other_hash)
         return children
 
     def txin_value(self, txin):
@@ -1966,6 +2196,12 @@ class Imported_Wallet(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self.history.pop(address, None)
+            self._changed_addrs.add(address)
+            self._addr_status.pop(address, None)
+            with self.transaction_lock:
+                # deltas of the remaining txs no longer include this address
+                self._tx_delta_cache = {}
+                self._reset_wallet_history()
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
@@ -0,0 +1,214 @@
+'''A minimal ElectrumX-style server, serving synthetic histories for a
+given set of scripts and a synthetic header chain.  Only the methods used
+by the client when syncing a wallet are implemented.  Meant for
+benchmarks, on regtest.'''
+
+import base64
+import hashlib
+import json
+import socketserver
+import struct
+import threading
+import time
+from collections import Counter
+
+from electrum.bitcoin import Hash, hash_encode, hash_decode, int_to_hex, var_int
+from electrum.blockchain import serialize_header, deserialize_header, compact_headers
+from electrum.util import bh2u, bfh
+
+
+def regtest_genesis_header():
+    return serialize_header({
+        'version': 1,
+        'prev_block_hash': '00' * 32,
+        'merkle_root': '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b',
+        'timestamp': 1296688602,
+        'bits': 0x207fffff,
+        'nonce': 2,
+    })
+
+
+def make_chain(n, merkle_roots={}):
+    '''A synthetic regtest chain of n raw headers, starting at genesis.
+    merkle_roots: height -> merkle root (hex)'''
+    out = bytearray(bfh(regtest_genesis_header()))
+    prev = Hash(out)
+    for height in range(1, n):
+        root = hash_decode(merkle_roots[height]) if height in merkle_roots else height.to_bytes(32, 'little')
+        raw = struct.pack('<I32s32sIII', 1, prev, root,
+                          1296688602 + 600 * height, 0x207fffff, height)
+        prev = Hash(raw)
+        out += raw
+    return bytes(out)
+
+
+def merkle_tree(tx_hashes):
+    '''Returns the merkle root and the branch of each tx of a block.'''
+    level = [hash_decode(h) for h in tx_hashes]
+    branches = [[] for h in tx_hashes]
+    positions = list(range(len(tx_hashes)))
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        for i, pos in enumerate(positions):
+            branches[i].append(hash_encode(level[pos ^ 1]))
+            positions[i] = pos // 2
+        level = [Hash(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+    return hash_encode(level[0]), branches
+
+
+def make_tx(script, value, seed):
+    '''A transaction paying value to script, spending a made-up outpoint.'''
+    prevout = hashlib.sha256(seed.encode('ascii')).hexdigest()
+    return ('01000000' + '01' + prevout + '00000000' + '00' + 'ffffffff'
+            + '01' + int_to_hex(value, 8) + var_int(len(script) // 2) + script
+            + '00000000')
+
+
+class MockServer(socketserver.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, scripts=(), txs_per_address=2, used_ratio=0.5, latency=0.0,
+                 headers=None, txs_per_block=0, service_time=0.0, host='127.0.0.1', port=0,
+                 compact=False):
+        '''scripts: list of output scripts (hex).  The first used_ratio of
+        them get txs_per_address transactions each.  If txs_per_block is
+        set, transactions are mined in blocks of that many; otherwise they
+        are unconfirmed.  headers: raw headers of the chain, see
+        make_chain.  Every response is delayed by latency seconds, and
+        each connection processes one request per service_time seconds.
+        If compact is set, header chunks can be sent in compact format.'''
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), MockHandler)
+        self.latency = latency
+        self.service_time = service_time
+        self.compact = compact
+        self.headers = headers or bfh(regtest_genesis_header())
+        self.peers = []
+        self.requests = Counter()  # method -> number of requests
+        self.histories = {}  # scripthash -> list of (tx_hash, height)
+        self.transactions = {}  # tx_hash -> raw
+        self.proofs = {}  # tx_hash -> (height, pos, branch)
+        num_used = int(len(scripts) * used_ratio)
+        for i, script in enumerate(scripts):
+            scripthash = bh2u(hashlib.sha256(bfh(script)).digest()[::-1])
+            hist = []
+            if i < num_used:
+                for j in range(txs_per_address):
+                    raw = make_tx(script, 100000, '%s:%d' % (script, j))
+                    tx_hash = hash_encode(Hash(bfh(raw)))
+                    self.transactions[tx_hash] = raw
+                    height = (len(self.transactions) - 1) // txs_per_block + 1 if txs_per_block else 0
+                    hist.append((tx_hash, height))
+            self.histories[scripthash] = hist
+        if txs_per_block:
+            self.mine(txs_per_block)
+
+    def mine(self, txs_per_block):
+        blocks = [list(self.transactions)[i:i + txs_per_block]
+                  for i in range(0, len(self.transactions), txs_per_block)]
+        roots = {}
+        for i, block in enumerate(blocks):
+            height = i + 1
+            roots[height], branches = merkle_tree(block)
+            for pos, tx_hash in enumerate(block):
+                self.proofs[tx_hash] = (height, pos, branches[pos])
+        self.headers = make_chain(len(blocks) + 10, roots)
+
+    def height(self):
+        return len(self.headers) // 80 - 1
+
+    def raw_header(self, height):
+        return self.headers[height * 80:(height + 1) * 80]
+
+    def get_status(self, scripthash):
+        h = self.histories.get(scripthash)
+        if not h:
+            return None
+        status = ''.join(tx_hash + ':%d:' % height for tx_hash, height in h)
+        return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+
+    def dispatch(self, method, params):
+        self.requests[method] += 1
+        if method == 'server.version':
+            return ['MockServer 1.0', '1.2']
+        if method == 'server.features':
+            return {'header_formats': ['hex', 'compact'] if self.compact else ['hex']}
+        if method == 'blockchain.headers.subscribe':
+            return {'hex': bh2u(self.raw_header(self.height())), 'height': self.height()}
+        if method == 'blockchain.block.get_header':
+            return deserialize_header(self.raw_header(params[0]), params[0])
+        if method == 'blockchain.block.headers':
+            start, count = params[:2]
+            count = max(0, min(count, 2016, self.height() + 1 - start))
+            data = self.headers[start * 80:(start + count) * 80]
+            if self.compact and params[3:] == ['compact']:
+                return {'compact': base64.b64encode(compact_headers(data)).decode('ascii'),
+                        'count': count, 'max': 2016}
+            return {'hex': bh2u(data), 'count': count, 'max': 2016}
+        if method in ('server.banner', 'server.donation_address'):
+            return ''
+        if method == 'server.peers.subscribe':
+            return [[host, host, ['v1.2', 't%d' % port]] for host, port in self.peers]
+        if method == 'server.ping':
+            return None
+        if method == 'blockchain.relayfee':
+            return 0.00001
+        if method == 'blockchain.estimatefee':
+            return 0.0001
+        if method == 'blockchain.scripthash.subscribe':
+            return self.get_status(params[0])
+        if method == 'blockchain.scripthash.get_history':
+            return [{'tx_hash': tx_hash, 'height': height}
+                    for tx_hash, height in self.histories.get(params[0], [])]
+        if method == 'blockchain.transaction.get':
+            return self.transactions[params[0]]
+        if method == 'blockchain.transaction.get_merkle':
+            height, pos, branch = self.proofs[params[0]]
+            return {'block_height': height, 'pos': pos, 'merkle': branch}
+        raise Exception('unknown method %s' % method)
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self.server_address[1]
+
+    def server_string(self):
+        return '%s:%d:t' % self.server_address
+
+
+class MockHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.write_lock = threading.Lock()
+        for line in self.rfile:
+            request = json.loads(line.decode('utf8'))
+            if type(request) is list:
+                response = list(map(self.respond, request))
+            else:
+                response = self.respond(request)
+            out = (json.dumps(response) + '\n').encode('utf8')
+            if self.server.latency:
+                # simulate round-trip time without serializing requests
+                threading.Timer(self.server.latency, self.write, (out,)).start()
+            else:
+                self.write(out)
+
+    def respond(self, request):
+        if self.server.service_time:
+            time.sleep(self.server.service_time)
+        response = {'id': request['id'], 'jsonrpc': '2.0'}
+        try:
+            response['result'] = self.server.dispatch(request['method'], request['params'])
+        except Exception as e:
+            response['error'] = {'code': 1, 'message': str(e)}
+        return response
+
+    def write(self, out):
+        with self.write_lock:
+            try:
+                self.wfile.write(out)
+            except OSError:
+                pass